@@ -0,0 +1,185 @@
+from copy import deepcopy
+import hashlib
+import json
+import os
+from pathlib import Path
+import shutil
+import uuid
+
+from nipype.interfaces.base import BaseInterface, DynamicTraitedSpec, isdefined
+
+from . import logger
+from .interfaces import _link_or_copy
+
+
+# names of the nodes whose results are cached by cache_workflow
+CACHED_NODES = ['nu_correct', 'inorm', 'bet', 'linreg', 'nlreg', 'classify']
+# inputs which do not change the results
+IGNORED_INPUTS = ['num_threads', 'environ', 'verbose']
+# change to invalidate every cache entry
+CACHE_VERSION = 1
+_hashes = {}
+
+
+def file_hash(path):
+    """The sha256 of the contents of path, remembered for the
+    path, size, and modification time"""
+    stat = os.stat(path)
+    memo = (os.path.realpath(path), stat.st_size, stat.st_mtime_ns)
+    if memo not in _hashes:
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha.update(chunk)
+        _hashes[memo] = sha.hexdigest()
+    return _hashes[memo]
+
+
+def _content(value):
+    """value with every existing file replaced by its hash"""
+    if isinstance(value, (list, tuple)):
+        return [_content(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _content(v) for k, v in sorted(value.items())}
+    if isinstance(value, str) and os.path.isfile(value):
+        return {'sha256': file_hash(value)}
+    return value
+
+
+def cache_key(interface):
+    """The key of the results of interface, from its type, the contents of
+    its input files, and its other inputs (except IGNORED_INPUTS). It does not
+    depend on the paths of the files"""
+    inputs = {name: _content(value) for name, value in interface.inputs.get().items()
+              if name not in IGNORED_INPUTS and isdefined(value)}
+    key = {'version': CACHE_VERSION,
+           'interface': f'{type(interface).__module__}.{type(interface).__name__}',
+           'inputs': inputs}
+    return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _store(outputs, entry, files):
+    """outputs with every existing file replaced by {'file': name}, copying
+    the file to entry"""
+    if isinstance(outputs, (list, tuple)):
+        return [_store(v, entry, files) for v in outputs]
+    if isinstance(outputs, dict):
+        return {k: _store(v, entry, files) for k, v in outputs.items()}
+    if isinstance(outputs, str) and os.path.isfile(outputs):
+        if outputs not in files:
+            files[outputs] = f'{len(files)}_{os.path.basename(outputs)}'
+            _link_or_copy(outputs, entry / files[outputs])
+        return {'file': files[outputs]}
+    return outputs
+
+
+def _restore(outputs, entry, cwd):
+    """The inverse of _store, linking (or copying) each file from entry
+    to cwd"""
+    if isinstance(outputs, list):
+        return [_restore(v, entry, cwd) for v in outputs]
+    if isinstance(outputs, dict) and set(outputs) == {'file'}:
+        out_file = Path(cwd) / outputs['file'].split('_', 1)[1]
+        _link_or_copy(entry / outputs['file'], out_file)
+        return str(out_file)
+    if isinstance(outputs, dict):
+        return {k: _restore(v, entry, cwd) for k, v in outputs.items()}
+    return outputs
+
+
+class ResultCache(object):
+    """A directory of interface results keyed by cache_key, which may be
+    shared by runs with different working directories or machines"""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = Path(cache_dir)
+
+    def entry(self, key):
+        return self.cache_dir / key[:2] / key
+
+    def get(self, key, cwd):
+        """The outputs stored for key, with the files linked to cwd, or None"""
+        entry = self.entry(key)
+        try:
+            with open(entry / 'outputs.json', 'r') as f:
+                outputs = json.load(f)
+        except FileNotFoundError:
+            return None
+        return _restore(outputs, entry, cwd)
+
+    def put(self, key, outputs):
+        """Store outputs (a dictionary of the output values) for key. Entries
+        are written to a temporary directory and renamed, so concurrent runs
+        never see a partial entry"""
+        entry = self.entry(key)
+        if entry.exists():
+            return
+        tmp = self.cache_dir / f'tmp-{uuid.uuid4().hex}'
+        tmp.mkdir(parents=True)
+        try:
+            stored = _store(outputs, tmp, {})
+            with open(tmp / 'outputs.json', 'w') as f:
+                json.dump(stored, f, default=str)
+            entry.parent.mkdir(exist_ok=True)
+            os.rename(str(tmp), str(entry))
+        except OSError:
+            # another run stored the same entry first
+            if not entry.exists():
+                raise
+        finally:
+            if tmp.exists():
+                shutil.rmtree(str(tmp))
+
+
+class CachedInterface(BaseInterface):
+    """Run interface, unless its results are in cache. The inputs (and
+    therefore the hash of the node) and outputs are those of interface"""
+    input_spec = DynamicTraitedSpec
+    output_spec = DynamicTraitedSpec
+
+    def __init__(self, interface, cache):
+        super(CachedInterface, self).__init__()
+        self.inputs = interface.inputs
+        self._interface = interface
+        self._cache = cache
+        self._results = {}
+
+    def _get_filecopy_info(self):
+        return type(self._interface)._get_filecopy_info()
+
+    def _check_mandatory_inputs(self):
+        self._interface._check_mandatory_inputs()
+
+    def _check_version_requirements(self, trait_object, permissive=False):
+        return []
+
+    def _outputs(self):
+        return deepcopy(self._interface._outputs())
+
+    def _run_interface(self, runtime):
+        key = cache_key(self._interface)
+        outputs = self._cache.get(key, runtime.cwd)
+        if outputs is not None:
+            logger.info(f'Using cached results {key} of {type(self._interface).__name__}')
+        else:
+            result = self._interface.run(cwd=runtime.cwd)
+            outputs = {name: value for name, value in result.outputs.get().items() if isdefined(value)}
+            self._cache.put(key, outputs)
+        self._results = outputs
+        return runtime
+
+    def _list_outputs(self):
+        return self._results
+
+
+def cache_workflow(wf, cache_dir, names=CACHED_NODES):
+    """Cache the results of every node of wf named one of names in
+    cache_dir. Returns the number of nodes cached"""
+    cache = ResultCache(cache_dir)
+    count = 0
+    for name in wf.list_node_names():
+        node = wf.get_node(name)
+        if node.name in names and not isinstance(node.interface, CachedInterface):
+            node._interface = CachedInterface(node.interface, cache)
+            count += 1
+    return count
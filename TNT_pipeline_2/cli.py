@@ -1,20 +1,24 @@
 import argparse
+from contextlib import ExitStack
 import errno
 import json
-import nipype
+import os
 from pathlib import Path
-from PipelineQC.main import qc_all
-from pkg_resources import resource_filename
-from pndniworkflows import utils
 import warnings
 import logging
 
-from .group import group_workflow
-from .participant import participant_workflow
-from .utils import Labels, load_resources_file, calc_opt_resources
-from . import qc
+from .profiler import ProcProfiler
+from .trace import TraceRecorder
+from .utils import parse_statistic, chain_callbacks, run_workflow, DEFAULT_STATISTICS
 from . import logger
 
+# nipype, pybids, pndniworkflows, and PipelineQC take several seconds to
+# import, so they (and the modules using them) are imported by the analysis
+# level which needs them
+
+
+DATA_DIR = Path(__file__).parent / 'data'
+
 
 def get_parser():
     return _get_parser()
@@ -22,17 +26,44 @@ def get_parser():
 
 def main():
     args = parse_args()
+    logger.setLevel(getattr(logging, args.loglevel))
+    profiler = None
+    if args.profiling_output_file and args.profiler == 'proc':
+        profiler = ProcProfiler(args.profiling_output_file, interval=args.profiling_interval)
+    trace = None
+    if args.trace_output_file and args.analysis_level != 'create_resource_file':
+        trace = TraceRecorder(args.trace_output_file, n_procs=_n_procs(args), memory_gb=args.memory_gb)
+        args.plugin_args['status_callback'] = chain_callbacks(
+            args.plugin_args.get('status_callback'), trace)
+    with ExitStack() as stack:
+        for context in [profiler, trace]:
+            if context is not None:
+                stack.enter_context(context)
+        _run(args)
+
+
+def _n_procs(args):
+    """The number of processors used by the plugin, if known"""
+    if args.n_proc is None and args.nipype_plugin == 'MultiProc':
+        return os.cpu_count()
+    return args.n_proc
+
+
+def _configure_nipype(args):
+    import nipype
     nipype.config.update_config({'execution': {'crashfile_format': 'txt'},
                                  'logging': {'workflow_level': args.loglevel,
                                              'utils_level': args.loglevel,
                                              'interface_level': args.loglevel}})
-    logger.setLevel(getattr(logging, args.loglevel))
-    if args.profiling_output_file:
+    if args.profiling_output_file and args.profiler == 'nipype':
         with warnings.catch_warnings():
             warnings.simplefilter('error')
             nipype.config.enable_resource_monitor()
         nipype.config.set('monitoring', 'summary_file', str(args.profiling_output_file))
     nipype.logging.update_logging(nipype.config)  # needed so log level takes effect
+
+
+def _run(args):
     if args.analysis_level == 'participant':
         run_participant(args)
     elif args.analysis_level == 'group':
@@ -53,45 +84,120 @@ def parse_args():
 
 
 def run_create_resource_file(args):
-    out = calc_opt_resources(load_resources_file(args.profiling_input_file))
+    from .trace import trace_from_resources
+    from .utils import load_resources_file, calc_opt_resources
+    resources = [load_resources_file(fname) for fname in args.profiling_input_file]
+    if args.trace_output_file:
+        trace_from_resources(resources[0], args.trace_output_file)
+    out = calc_opt_resources(resources,
+                             statistics=args.resource_statistics,
+                             statistic=args.resource_statistic or 'max')
     with open(args.resource_output_file, 'w') as f:
         json.dump(out, f, indent=4)
 
 
 def run_group(args):
-    wf = group_workflow(args)
-    wf.run(plugin=args.nipype_plugin, plugin_args=args.plugin_args)
+    from .group import group_workflow, incremental_group, streaming_group, summary_group
+    _configure_nipype(args)
+    if args.incremental:
+        incremental_group(args)
+    elif args.streaming:
+        streaming_group(args)
+    else:
+        wf = group_workflow(args)
+        run_workflow(wf, args.nipype_plugin, args.plugin_args)
+    if not args.skip_summary:
+        summary_group(args)
 
 
 def run_participant(args):
+    from .participant import participant_workflow
+    _configure_nipype(args)
     wf = participant_workflow(args)
+    if args.cache_dir is not None:
+        from .cache import cache_workflow
+        n_cached = cache_workflow(wf, args.cache_dir)
+        logger.info(f'Caching the results of {n_cached} nodes in {args.cache_dir}')
     if args.graph_output is not None:
         wf.write_graph(graph2use='hierarchical',
                        dotfilename=args.graph_output,
                        format='dot')
         return
-    wf.run(plugin=args.nipype_plugin, plugin_args=args.plugin_args)
+    callbacks = []
+    if args.metrics_file is not None:
+        from .metrics import MetricsWriter, subject_nodes
+        nodes = subject_nodes(wf)
+        logger.info(f'Writing the progress of {len(nodes)} T1s to {args.metrics_file} '
+                    f'every {args.metrics_interval} seconds')
+        callbacks.append(MetricsWriter(args.metrics_file, nodes, n_procs=_n_procs(args),
+                                       memory_gb=args.memory_gb, interval=args.metrics_interval))
+    if args.export_threads > 0:
+        from .export import ExportQueue
+        callbacks.append(ExportQueue(n_threads=args.export_threads,
+                                     max_bytes=int(args.export_buffer_gb * 1024 ** 3)))
+    if args.staging_dir is not None:
+        from .staging import StagingTier, stage_workflow
+        tier = StagingTier(args.staging_dir,
+                           budget=int(args.staging_budget_gb * 1024 ** 3),
+                           max_file_size=int(args.staging_max_file_mb * 1024 ** 2),
+                           journal_dir=Path(wf.base_dir, wf.name, '.staging') if wf.base_dir else None)
+        n_staged = stage_workflow(wf, tier)
+        logger.info(f'Staging the outputs of {n_staged} nodes in {tier.run_dir}')
+        callbacks.append(tier)
+    if args.prefetch_dir is not None:
+        from .prefetch import Prefetcher, prefetch_files
+        files = prefetch_files(wf)
+        logger.info(f'Prefetching {len(files)} files to {args.prefetch_dir}, '
+                    f'{args.prefetch_ahead} ahead of the nodes reading them')
+        callbacks.append(Prefetcher(files, str(args.prefetch_dir), ahead=args.prefetch_ahead,
+                                    n_threads=args.prefetch_threads))
+    plugin_args = args.plugin_args
+    if callbacks:
+        plugin_args = dict(plugin_args,
+                           status_callback=chain_callbacks(plugin_args.get('status_callback'), *callbacks))
+    with ExitStack() as stack:
+        for callback in callbacks:
+            stack.enter_context(callback)
+        run_workflow(wf, args.nipype_plugin, plugin_args)
 
 
 def run_qc(args):
+    from . import qc
     if args.qc_config_file is None:
         conf = qc.make_config(args.model_space,
                               args.subcortical,
                               args.subcortical_model_space,
                               args.intracranial_volume)
+        if args.qc_snapshots:
+            from .snapshots import snapshot_config
+            conf = snapshot_config(conf)
         if args.qc_config_file_out:
             with open(args.qc_config_file_out, 'w') as f:
                 json.dump(conf, f, indent=4)
             return
     else:
         conf = args.qc_config_file
-    qc_all([args.output_folder],
-           args.output_folder / 'QC',
-           conf,
-           plugin=args.nipype_plugin,
-           working_directory=args.working_directory,
-           plugin_args=args.plugin_args,
-           bids_validate=not args.skip_validation)
+    _configure_nipype(args)
+    kwargs = dict(plugin=args.nipype_plugin,
+                  working_directory=args.working_directory,
+                  plugin_args=args.plugin_args,
+                  bids_validate=not args.skip_validation)
+    qc_dir = args.output_folder / 'QC'
+    if not isinstance(conf, dict) and (args.qc_snapshots or args.incremental or
+                                       args.shard or args.merge_shards):
+        conf = json.load(conf)
+        if args.qc_snapshots:
+            from .snapshots import snapshot_config
+            conf = snapshot_config(conf)
+    if args.merge_shards:
+        qc.merge_shards(qc_dir, conf)
+    elif args.shard:
+        qc.sharded_qc(args.output_folder, qc_dir, conf, args.shard, **kwargs)
+    elif args.incremental:
+        qc.incremental_qc(args.output_folder, qc_dir, conf, **kwargs)
+    else:
+        from PipelineQC.main import qc_all
+        qc_all([args.output_folder], qc_dir, conf, **kwargs)
 
 
 def _get_parser(for_doc=False):
@@ -142,6 +248,25 @@ def _get_parser(for_doc=False):
         type=Path,
         help='If set, set resource monitoring in nipype and save results to'
              'this file (JSON format).')
+    parser_b.add_argument(
+        '--profiler',
+        choices=['nipype', 'proc'],
+        help='Profiler used with --profiling_output_file (default "nipype"). "nipype" uses nipype\'s resource monitor. '
+             '"proc" samples the processes of each node from /proc in a background thread '
+             '(Linux only), additionally recording bytes read and written, '
+             'and saves the samples as newline-delimited JSON.')
+    parser_b.add_argument(
+        '--profiling_interval',
+        type=float,
+        default=1.0,
+        help='Seconds between samples of the "proc" profiler.')
+    parser_b.add_argument(
+        '--trace_output_file',
+        type=Path,
+        help='If set, record the start and end of every node, grouped by T1 workflow, '
+             'with the processors and memory reserved over time, '
+             'and save them to this file as a Chrome trace (which can be opened in Perfetto). '
+             'At the create_resource_file level, rebuild the trace from --profiling_input_file instead.')
     parser_b.add_argument('--loglevel',
                           type=str,
                           default='INFO',
@@ -168,7 +293,50 @@ def _get_parser(for_doc=False):
     parser_qcp.add_argument('--intracranial_volume',
                             action='store_true',
                             help='Calculate intracranial volume')
-    # parser_g = parser.add_argument_group('group', description='Arguments for group analysis level')
+    parser_qcp.add_argument('--qc_snapshots',
+                            action='store_true',
+                            help='At the participant level, render the images of the QC pages '
+                            'as soon as the outputs of each scan exist (requires matplotlib), '
+                            'and save them with the outputs. At the qcpages level, show these images '
+                            'in the QC pages instead of reading the outputs.')
+    parser_pg = parser.add_argument_group(
+        'Participant and group arguments',
+        description='Arguments for "participant" and "group"')
+    parser_pg.add_argument('--columnar_stats',
+                           action='store_true',
+                           help='At the participant level, also write the stats of each scan '
+                           'to a Parquet table (requires pyarrow). At the group level, '
+                           'combine these tables into group/group.parquet instead of '
+                           'combining the stats TSV files.')
+    parser_gq = parser.add_argument_group(
+        'Group and QC pages arguments',
+        description='Arguments for "group" and "qcpages"')
+    parser_gq.add_argument('--incremental',
+                           action='store_true',
+                           help='Only process files that are new or have changed '
+                           '(by modification time and size) since the last incremental run. '
+                           'For "group", only these stats files are read and merged into group/group.tsv, '
+                           'and the files read are recorded in group/group_index.json. '
+                           'The output folder is not indexed or validated with pybids, '
+                           'and files are read by a pool of --n_proc processes. '
+                           'For "qcpages", only the pages of subjects with new or changed files '
+                           'are rebuilt, the files of each page are recorded in QC/qc_manifest.json, '
+                           'and QC/index.html lists every page.')
+    parser_g = parser.add_argument_group('Group Arguments', description='Arguments for group analysis level')
+    parser_g.add_argument('--streaming',
+                          action='store_true',
+                          help='Instead of combining the stats files in a single nipype node, '
+                          'read them with a pool of --n_proc processes and stream the rows '
+                          'into group/group.tsv with bounded memory. '
+                          'The output folder is not indexed or validated with pybids.')
+    parser_g.add_argument('--skip_summary',
+                          action='store_true',
+                          help='Do not write group/group_summary.tsv and group/group_outliers.tsv')
+    parser_g.add_argument('--outlier_threshold',
+                          type=float,
+                          default=3.5,
+                          help='Stats with an absolute robust z-score greater than this '
+                          'are counted in the n_outliers column of group/group_outliers.tsv')
     parser_p = parser.add_argument_group(
         'Participant Arguments',
         description='Arguments for participant analysis level')
@@ -221,17 +389,36 @@ def _get_parser(for_doc=False):
                           help='Brain mask in model/template space.')
     parser_p.add_argument('--bet_frac',
                           type=float,
-                          default=0.5,
-                          help='Argument passed to FSL\'s BET')
+                          default=[0.5],
+                          nargs='+',
+                          help='Argument passed to FSL\'s BET. '
+                          'If more than one value is given, run a parameter sweep')
     parser_p.add_argument('--bet_vertical_gradient',
                           type=float,
-                          default=0.0,
-                          help='Argument passed to FSL\'s BET')
+                          default=[0.0],
+                          nargs='+',
+                          help='Argument passed to FSL\'s BET. '
+                          'If more than one value is given, run a parameter sweep')
     parser_p.add_argument('--inormalize_const2',
                           type=float,
                           default=[0.0, 5000.0],
-                          nargs=2,
-                          help='Passed to inormalize --const2 parameter')
+                          nargs='+',
+                          help='Passed to inormalize --const2 parameter. '
+                          'If more than one pair of values is given, run a parameter sweep. '
+                          'The outputs of every combination of the swept BET and inormalize '
+                          'parameters are saved in derivatives/sweep/<setting> of the output folder, '
+                          'and the preprocessing before BET and inormalize is shared')
+    parser_p.add_argument('--longitudinal',
+                          action='store_true',
+                          help='For subjects with more than one T1, build a template of the subject\'s '
+                          'T1s and register the model (and subcortical model) to it once. Each T1 is '
+                          'then only registered (affinely) to the subject template')
+    parser_p.add_argument('--deduplicate',
+                          action='store_true',
+                          help='Process identical T1s (e.g. the same image under two BIDS names) once, '
+                          'and save the outputs under the name of each. The T1s are hashed by --n_proc '
+                          'threads, and the hashes are saved in logs/T1_hashes.json of the output folder '
+                          'so that unchanged files are not hashed again')
     parser_p.add_argument('--inormalize_range',
                           type=float,
                           default=1.0,
@@ -313,6 +500,61 @@ def _get_parser(for_doc=False):
                           type=int,
                           default=1,
                           help='Number of processors to use for ANTs tools.')
+    parser_p.add_argument('--cache_dir',
+                          type=lambda p: Path(p).resolve(),
+                          help='Directory in which the results of the expensive nodes (nu_correct, inorm, '
+                          'bet, linreg, nlreg, and classify) are cached, by the contents of their input '
+                          'files and their parameters. It may be shared by runs with different working '
+                          'directories, output folders, or machines.')
+    parser_p.add_argument('--export_threads',
+                          type=int,
+                          default=0,
+                          help='Copy the outputs to the output folder with this many background threads, '
+                          'instead of in nodes which occupy a processor. The run waits for the copies to '
+                          'finish before exiting')
+    parser_p.add_argument('--export_buffer_gb',
+                          type=float,
+                          default=2.0,
+                          help='Maximum size of the files being copied by --export_threads at once. When '
+                          'reached, further files are queued until copies finish, without holding up '
+                          'the scheduler')
+    parser_p.add_argument('--metrics_file',
+                          type=Path,
+                          help='Keep the progress of the run (T1s and nodes completed, failed and running, '
+                          'processors and memory reserved, throughput and estimated time remaining) in this '
+                          'file, in the Prometheus text format. Use a name ending in .prom for the textfile '
+                          'collector of node-exporter')
+    parser_p.add_argument('--metrics_interval',
+                          type=float,
+                          default=10.0,
+                          help='Seconds between updates of --metrics_file')
+    parser_p.add_argument('--prefetch_dir',
+                          type=_resolve_existing_path,
+                          help='Local directory (e.g. node-local scratch) to which the T1s and models are '
+                          'copied by background threads before the nodes reading them are run, instead '
+                          'of reading them from the input dataset and models folder. Copies are reused '
+                          'by later runs while they are up to date, and are not removed')
+    parser_p.add_argument('--prefetch_ahead',
+                          type=int,
+                          default=2,
+                          help='Number of files copied to --prefetch_dir ahead of the last one read')
+    parser_p.add_argument('--prefetch_threads',
+                          type=int,
+                          default=2,
+                          help='Number of threads copying files to --prefetch_dir')
+    parser_p.add_argument('--staging_dir',
+                          type=_resolve_existing_path,
+                          help='Fast directory (e.g. /dev/shm) in which the short-lived files of the '
+                          'format conversion nodes are written. They are moved to the working directory '
+                          'once they have been read, or when --staging_budget_gb is used')
+    parser_p.add_argument('--staging_budget_gb',
+                          type=float,
+                          default=2.0,
+                          help='Maximum size of the files in --staging_dir, shared by every run using it')
+    parser_p.add_argument('--staging_max_file_mb',
+                          type=float,
+                          default=256.0,
+                          help='Larger files are written to the working directory instead of --staging_dir')
     parser_q = parser.add_argument_group(
         'QC Pages Arguments',
         description='Arguments for qcpages analysis level')
@@ -322,13 +564,42 @@ def _get_parser(for_doc=False):
     parser_q.add_argument('--qc_config_file_out',
                           type=Path,
                           help='Output file name for qc config (JSON)')
+    parser_q.add_argument('--shard',
+                          type=_shard,
+                          metavar='INDEX/COUNT',
+                          help='Only create the pages of shard INDEX of COUNT (0 <= INDEX < COUNT), '
+                          'e.g. from an array job. Pages are assigned to shards by subject. '
+                          'The pages of each shard are recorded in QC/shards, and the index is not created. '
+                          'Run with --merge_shards once every shard has finished to create the index.')
+    parser_q.add_argument('--merge_shards',
+                          action='store_true',
+                          help='Create the index from the pages of every shard created with --shard')
+    parser_pr = parser.add_argument_group(
+        'Participant and create resource file arguments',
+        description='Arguments for "participant" and "create_resource_file"')
+    parser_pr.add_argument('--resource_statistic',
+                           type=_statistic,
+                           help='At the participant level, the statistic from --resource_input_file to use '
+                                '(by default the one recorded in the file). '
+                                'At the create_resource_file level, the statistic to record in '
+                                'the resource file (default "max").')
     parser_r = parser.add_argument_group(
         'Create resource file arguments',
         description='Arguments for the create_resource_file analysis level')
     parser_r.add_argument(
         '--profiling_input_file',
         type=_resolve_existing_path,
-        help='Output from --profiling_output_file')
+        nargs='+',
+        help='Output from --profiling_output_file. If more than one file is given, '
+        'the nodes of every profiling run are combined.')
+    parser_r.add_argument(
+        '--resource_statistics',
+        type=_statistic,
+        nargs='+',
+        default=DEFAULT_STATISTICS,
+        help='Statistics of the processor usage, memory, and duration of the instances '
+        'of each node (in every scan and profiling run) to save in the resource file. '
+        'Either "max" or percentiles such as "p95".')
     parser_r.add_argument(
         '--resource_output_file',
         type=Path,
@@ -364,7 +635,7 @@ def _get_plugin_args(args):
 
 
 def _model(name, for_doc=False):
-    p = Path(resource_filename('TNT_pipeline_2', f'data/{name}'))
+    p = DATA_DIR / name
     if for_doc:
         p = Path('$INSTALLDIR', p.relative_to(Path(__file__).parent.parent))
     return p
@@ -377,9 +648,57 @@ def _resolve_existing_path(p):
     return p
 
 
+def _statistic(value):
+    try:
+        parse_statistic(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    return value
+
+
+def _shard(value):
+    from . import qc
+    try:
+        return qc.parse_shard(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
 def _update_args(args):
     args.plugin_args = _get_plugin_args(args)
+    if args.profiler is not None and not args.profiling_output_file:
+        raise ValueError('--profiler may only be used with --profiling_output_file')
+    args.profiler = args.profiler or 'nipype'
+    if args.analysis_level == 'create_resource_file':
+        if args.trace_output_file and len(args.profiling_input_file or []) > 1:
+            raise ValueError('--trace_output_file may only be used with one --profiling_input_file')
+    if args.analysis_level == 'group':
+        if sum([args.incremental, args.streaming, args.columnar_stats]) > 1:
+            raise ValueError('Only one of --incremental, --streaming, and --columnar_stats may be used')
+    if args.analysis_level == 'qcpages':
+        if args.incremental and (args.shard or args.merge_shards):
+            raise ValueError('--incremental may not be used with --shard or --merge_shards')
+        if args.shard and args.merge_shards:
+            raise ValueError('Only one of --shard and --merge_shards may be used')
     if args.analysis_level == 'participant':
+        from pndniworkflows import utils
+        from .core_workflows import sweep_settings
+        from .utils import Labels
+        if len(args.inormalize_const2) % 2:
+            raise ValueError('--inormalize_const2 must be given pairs of values')
+        const2 = [args.inormalize_const2[i:i + 2] for i in range(0, len(args.inormalize_const2), 2)]
+        args.inormalize_const2 = const2[0] if len(const2) == 1 else const2
+        if len(sweep_settings(args.bet_frac, args.bet_vertical_gradient, args.inormalize_const2)) > 1:
+            if args.debug_io or args.qc_snapshots or args.longitudinal or args.deduplicate:
+                raise ValueError('A parameter sweep may not be used with --debug_io, --qc_snapshots, '
+                                 '--longitudinal, or --deduplicate')
+        if args.longitudinal and args.debug_io:
+            raise ValueError('--longitudinal may not be used with --debug_io')
+        if args.deduplicate and args.debug_io:
+            raise ValueError('--deduplicate may not be used with --debug_io')
+        for par in ['bet_frac', 'bet_vertical_gradient']:
+            if len(getattr(args, par)) == 1:
+                setattr(args, par, getattr(args, par)[0])
         if args.subcortical:
             for req in [
                     'subcortical_model',
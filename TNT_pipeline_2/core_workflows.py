@@ -1,15 +1,65 @@
 from collections import OrderedDict
+from itertools import product
 
 from nipype.pipeline import engine as pe
 from nipype import IdentityInterface, Merge
 from pndniworkflows.interfaces import utils  # import GunzipOrIdent, MergeDictionaries, DictToString, Minc2AntsPoints, Ants2MincPoints
 from pndniworkflows.interfaces import minc  # .minc import Nii2mnc, NUCorrect, Mnc2nii, INormalize, Classify
 from nipype.interfaces import fsl
-from nipype.interfaces.ants import resampling
+from nipype.interfaces.ants import resampling, AverageImages, CompositeTransformUtil
 from pndniworkflows.registration import ants_registration_syn_no_affine_node, ants_registration_affine_node
 from pndniworkflows.interfaces import pndni_utils
 from pndniworkflows.postprocessing import image_stats_wf
 
+from .interfaces import ApplyMask
+
+
+# names of the iterable nodes of a parameter sweep
+INORM_SWEEP = 'inorm_sweep'
+BET_SWEEP = 'bet_sweep'
+# outputs of main_workflow computed before each iterable node of a parameter
+# sweep, which are therefore shared by its settings
+SWEEP_SHARED = {INORM_SWEEP: ['T1', 'nu'], BET_SWEEP: ['T1', 'nu', 'normalized']}
+# outputs of session_preproc_workflow, which are inputs of a longitudinal main_workflow
+PREPROC_OUTPUTS = ['T1', 'nu', 'nu_bet', 'normalized', 'brain_mask', 'normalized_brain']
+TRANSFORMS = ['linear_transform', 'transform', 'inverse_transform']
+SUBCORTICAL_TRANSFORMS = ['subcortical_linear_transform', 'subcortical_transform',
+                          'subcortical_inverse_transform']
+
+
+def _as_list(value):
+    return list(value) if isinstance(value, (list, tuple)) else [value]
+
+
+def bet_settings(bet_frac, bet_vertical_gradient):
+    """Every combination of the BET fractional intensity thresholds and
+    vertical gradients, each of which is a value or a list"""
+    return list(product(_as_list(bet_frac), _as_list(bet_vertical_gradient)))
+
+
+def inorm_settings(inormalize_const2):
+    """The inormalize const2 values, given as a pair or a list of pairs"""
+    if inormalize_const2 and isinstance(inormalize_const2[0], (list, tuple)):
+        return [tuple(pair) for pair in inormalize_const2]
+    return [tuple(inormalize_const2)]
+
+
+def sweep_settings(bet_frac, bet_vertical_gradient, inormalize_const2):
+    """Every setting of a parameter sweep, as dictionaries with const2,
+    frac, and vertical_gradient, in the order of the nested join over the
+    iterables of preproc_workflow (const2 outer, BET inner)"""
+    return [{'const2': const2, 'frac': frac, 'vertical_gradient': vertical_gradient}
+            for const2 in inorm_settings(inormalize_const2)
+            for frac, vertical_gradient in bet_settings(bet_frac, bet_vertical_gradient)]
+
+
+def _sweep_node(name, fields, values):
+    """An iterable node over values (tuples with one element per field)"""
+    node = pe.Node(IdentityInterface(fields=fields), name)
+    node.iterables = [(field, [v[i] for v in values]) for i, field in enumerate(fields)]
+    node.synchronize = True
+    return node
+
 
 def forceqform_workflow(files, max_shear_angle):
     wf = pe.Workflow(name='forceqform')
@@ -57,22 +107,32 @@ def preproc_workflow(bet_frac,
                      inormalize_const2,
                      inormalize_range,
                      max_shear_angle):
+    """bet_frac, bet_vertical_gradient, and inormalize_const2 may be lists
+    (of pairs for inormalize_const2), in which case inorm and bet are run for
+    every setting (see sweep_settings) using iterables, while the nodes
+    before them are run once"""
     wf = pe.Workflow(name="preproc")
     inputspec = pe.Node(IdentityInterface(fields=['T1']), 'inputspec')
     tomnc_wf = tomnc_workflow('to_mnc')
     nu_correct = pe.Node(minc.NUCorrect(), 'nu_correct')
     nuc_mnc_to_nii = toniigz_workflow('nuc_mnc_to_nii', max_shear_angle)
-    inorm = pe.Node(
-        minc.INormalize(const2=inormalize_const2, range=inormalize_range),
-        'inorm')
+    inorm = pe.Node(minc.INormalize(range=inormalize_range), 'inorm')
+    const2 = inorm_settings(inormalize_const2)
+    if len(const2) > 1:
+        wf.connect(_sweep_node(INORM_SWEEP, ['const2'], [(v,) for v in const2]), 'const2',
+                   inorm, 'const2')
+    else:
+        inorm.inputs.const2 = const2[0]
     inorm_mnc_to_nii = toniigz_workflow('inorm_mnc_to_nii', max_shear_angle)
-    bet = pe.Node(
-        fsl.BET(mask=True,
-                frac=bet_frac,
-                vertical_gradient=bet_vertical_gradient),
-        'bet')
-    mask = pe.Node(fsl.ImageMaths(), 'mask')
-    masknormalized = pe.Node(fsl.ImageMaths(), 'masknormalized')
+    bet = pe.Node(fsl.BET(mask=True), 'bet')
+    betvalues = bet_settings(bet_frac, bet_vertical_gradient)
+    if len(betvalues) > 1:
+        wf.connect([(_sweep_node(BET_SWEEP, ['frac', 'vertical_gradient'], betvalues),
+                     bet, [('frac', 'frac'), ('vertical_gradient', 'vertical_gradient')])])
+    else:
+        bet.inputs.frac, bet.inputs.vertical_gradient = betvalues[0]
+    # masks nu and normalized with one load of the mask
+    mask = pe.Node(ApplyMask(), 'mask')
     outputspec = pe.Node(
         IdentityInterface(fields=['nu_bet', 'nu', 'normalized', 'brain_mask', 'normalized_brain']),
         'outputspec')
@@ -83,11 +143,10 @@ def preproc_workflow(bet_frac,
     wf.connect(inorm_mnc_to_nii, 'outputspec.out_file', bet, 'in_file')
     wf.connect(nu_correct, 'out_file', nuc_mnc_to_nii, 'inputspec.in_file')
     wf.connect(nuc_mnc_to_nii, 'outputspec.out_file', mask, 'in_file')
+    wf.connect(inorm_mnc_to_nii, 'outputspec.out_file', mask, 'in_file2')
     wf.connect(bet, 'mask_file', mask, 'mask_file')
     wf.connect(mask, 'out_file', outputspec, 'nu_bet')
-    wf.connect(inorm_mnc_to_nii, 'outputspec.out_file', masknormalized, 'in_file')
-    wf.connect(bet, 'mask_file', masknormalized, 'mask_file')
-    wf.connect(masknormalized, 'out_file', outputspec, 'normalized_brain')
+    wf.connect(mask, 'out_file2', outputspec, 'normalized_brain')
     wf.connect(bet, 'mask_file', outputspec, 'brain_mask')
     wf.connect(inorm_mnc_to_nii,
                'outputspec.out_file',
@@ -97,19 +156,46 @@ def preproc_workflow(bet_frac,
     return wf
 
 
-def ants_workflow(debug=False, num_threads=1):
-    wf = pe.Workflow(name='ants')
-    inputspec = pe.Node(
-        IdentityInterface(
-            fields=['normalized', 'normalized_brain', 'model', 'tags', 'model_brain', 'model_brain_mask']),
-        'inputspec')
-    converttags = pe.Node(
-        pndni_utils.ConvertPoints(out_format='ants'), 'converttags')
-    linreg = pe.Node(ants_registration_affine_node(verbose=True, num_threads=num_threads), 'linreg')
-    nlreg = pe.Node(ants_registration_syn_no_affine_node(verbose=True, num_threads=num_threads), 'nlreg')
+def _registration_nodes(prefix, debug, num_threads):
+    linreg = pe.Node(ants_registration_affine_node(verbose=True, num_threads=num_threads), f'{prefix}linreg')
+    nlreg = pe.Node(ants_registration_syn_no_affine_node(verbose=True, num_threads=num_threads), f'{prefix}nlreg')
     if debug:
         linreg.inputs.number_of_iterations = [[1, 1, 1, 1], [1, 1, 1, 1]]
         nlreg.inputs.number_of_iterations = [[1, 1, 1, 1]]
+    return linreg, nlreg
+
+
+def _registration(wf, inputspec, fixed, fixed_brain, moving, moving_brain, transforms,
+                  longitudinal, debug, num_threads):
+    """Register moving to fixed, or if longitudinal take the transforms
+    from inputspec and only warp moving. Returns the (node, field) of the
+    linear, nonlinear, and inverse transforms and the warped image"""
+    if longitudinal:
+        warp = pe.Node(resampling.ApplyTransforms(dimension=3, num_threads=num_threads), 'warpmodel')
+        wf.connect([(inputspec, warp, [(moving, 'input_image'), (fixed, 'reference_image'),
+                                       (transforms[1], 'transforms')])])
+        return [(inputspec, t) for t in transforms] + [(warp, 'output_image')]
+    linreg, nlreg = _registration_nodes('', debug, num_threads)
+    wf.connect([(inputspec, linreg, [(fixed_brain, 'fixed_image'), (moving_brain, 'moving_image')]),
+                (linreg, nlreg, [('composite_transform', 'initial_moving_transform')]),
+                (inputspec, nlreg, [(fixed, 'fixed_image'), (moving, 'moving_image')])])
+    return [(linreg, 'composite_transform'), (nlreg, 'composite_transform'),
+            (nlreg, 'inverse_composite_transform'), (nlreg, 'warped_image')]
+
+
+def ants_workflow(debug=False, num_threads=1, longitudinal=False):
+    """If longitudinal, the transforms are inputs (see template_workflow)
+    and the model is only warped"""
+    wf = pe.Workflow(name='ants')
+    inputfields = ['normalized', 'normalized_brain', 'model', 'tags', 'model_brain', 'model_brain_mask']
+    if longitudinal:
+        inputfields.extend(TRANSFORMS)
+    inputspec = pe.Node(IdentityInterface(fields=inputfields), 'inputspec')
+    converttags = pe.Node(
+        pndni_utils.ConvertPoints(out_format='ants'), 'converttags')
+    linear, transform, inverse, warped = _registration(
+        wf, inputspec, 'normalized', 'normalized_brain', 'model', 'model_brain', TRANSFORMS,
+        longitudinal, debug, num_threads)
     trinvmerge = pe.Node(Merge(1), 'trinvmerge')
     trpoints = pe.Node(resampling.ApplyTransformsToPoints(dimension=3, num_threads=num_threads),
                        'trpoints')
@@ -132,12 +218,7 @@ def ants_workflow(debug=False, num_threads=1):
         ]),
         'outputspec')
     wf.connect([
-        (inputspec, linreg, [('normalized_brain', 'fixed_image'),
-                             ('model_brain', 'moving_image')]),
-        (linreg, nlreg, [('composite_transform', 'initial_moving_transform')]),
-        (inputspec,
-         nlreg, [('normalized', 'fixed_image'), ('model', 'moving_image')]),
-        (nlreg, trinvmerge, [('inverse_composite_transform', 'in1')]),
+        (inverse[0], trinvmerge, [(inverse[1], 'in1')]),
         (trinvmerge, trpoints, [('out', 'transforms')]),
         (inputspec, converttags, [('tags', 'in_file')]),
         (converttags, trpoints, [('out_file', 'input_file')]),
@@ -147,13 +228,11 @@ def ants_workflow(debug=False, num_threads=1):
          trbrain,
          [('model_brain_mask', 'input_image'),
           ('normalized', 'reference_image')]),
-        (nlreg, trbrain, [('composite_transform', 'transforms')]),
-        (linreg, outputspec, [('composite_transform', 'linear_transform')]),
-        (nlreg,
-         outputspec,
-         [('composite_transform', 'transform'),
-          ('inverse_composite_transform', 'inverse_transform'),
-          ('warped_image', 'warped_model')]),
+        (transform[0], trbrain, [(transform[1], 'transforms')]),
+        (linear[0], outputspec, [(linear[1], 'linear_transform')]),
+        (transform[0], outputspec, [(transform[1], 'transform')]),
+        (inverse[0], outputspec, [(inverse[1], 'inverse_transform')]),
+        (warped[0], outputspec, [(warped[1], 'warped_model')]),
         (trbrain,
          outputspec, [('output_image', 'transformed_model_brain_mask')]),
     ])
@@ -223,17 +302,18 @@ def segment_lobes_workflow(num_threads=1):
     return wf
 
 
-def subcortical_workflow(debug=False, num_threads=1):
+def subcortical_workflow(debug=False, num_threads=1, longitudinal=False):
+    """If longitudinal, the transforms are inputs (see template_workflow)
+    and the model is only warped"""
     wf = pe.Workflow(name='subcortical')
-    inputspec = pe.Node(
-        IdentityInterface(
-            fields=['normalized', 'normalized_brain', 'subcortical_model', 'subcortical_model_brain', 'subcortical_atlas']),
-        'inputspec')
-    linreg = pe.Node(ants_registration_affine_node(verbose=True, num_threads=num_threads), 'linreg')
-    nlreg = pe.Node(ants_registration_syn_no_affine_node(verbose=True, num_threads=num_threads), 'nlreg')
-    if debug:
-        linreg.inputs.number_of_iterations = [[1, 1, 1, 1], [1, 1, 1, 1]]
-        nlreg.inputs.number_of_iterations = [[1, 1, 1, 1]]
+    inputfields = ['normalized', 'normalized_brain', 'subcortical_model', 'subcortical_model_brain',
+                   'subcortical_atlas']
+    if longitudinal:
+        inputfields.extend(SUBCORTICAL_TRANSFORMS)
+    inputspec = pe.Node(IdentityInterface(fields=inputfields), 'inputspec')
+    linear, transform, inverse, warped = _registration(
+        wf, inputspec, 'normalized', 'normalized_brain', 'subcortical_model', 'subcortical_model_brain',
+        SUBCORTICAL_TRANSFORMS, longitudinal, debug, num_threads)
 
     tratlas = pe.Node(
         resampling.ApplyTransforms(dimension=3, interpolation='MultiLabel', num_threads=num_threads),
@@ -248,23 +328,13 @@ def subcortical_workflow(debug=False, num_threads=1):
         ]),
         'outputspec')
 
-    wf.connect([(inputspec, linreg, [('normalized_brain', 'fixed_image'),
-                                     ('subcortical_model_brain', 'moving_image')]),
-                (inputspec,
-                 nlreg,
-                 [('normalized', 'fixed_image'),
-                  ('subcortical_model', 'moving_image')]),
-                (linreg, nlreg, [('composite_transform', 'initial_moving_transform')]),
-                (inputspec, tratlas, [('subcortical_atlas', 'input_image'),
+    wf.connect([(inputspec, tratlas, [('subcortical_atlas', 'input_image'),
                                       ('normalized', 'reference_image')]),
-                (nlreg, tratlas, [('composite_transform', 'transforms')]),
-                (linreg, outputspec, [('composite_transform', 'subcortical_linear_transform')]),
-                (nlreg,
-                 outputspec,
-                 [('composite_transform', 'subcortical_transform'),
-                  ('inverse_composite_transform',
-                   'subcortical_inverse_transform'),
-                  ('warped_image', 'warped_subcortical_model')]),
+                (transform[0], tratlas, [(transform[1], 'transforms')]),
+                (linear[0], outputspec, [(linear[1], 'subcortical_linear_transform')]),
+                (transform[0], outputspec, [(transform[1], 'subcortical_transform')]),
+                (inverse[0], outputspec, [(inverse[1], 'subcortical_inverse_transform')]),
+                (warped[0], outputspec, [(warped[1], 'warped_subcortical_model')]),
                 (tratlas,
                  outputspec, [('output_image', 'native_subcortical_atlas')])])
     return wf
@@ -290,6 +360,111 @@ def icv_workflow(num_threads=1):
     return wf
 
 
+def session_preproc_workflow(name,
+                             bet_frac,
+                             bet_vertical_gradient,
+                             inormalize_const2,
+                             inormalize_range,
+                             max_shear_angle):
+    """The part of main_workflow before registration, for the sessions of
+    a longitudinal subject"""
+    wf = pe.Workflow(name=name)
+    inputspec = pe.Node(IdentityInterface(fields=['T1']), 'inputspec')
+    outputspec = pe.Node(IdentityInterface(fields=PREPROC_OUTPUTS), 'outputspec')
+    forceqform = pe.Node(pndni_utils.ForceQForm(out_file='T1_qform.nii.gz', maxangle=max_shear_angle), 'forceqc_T1')
+    pp = preproc_workflow(bet_frac,
+                          bet_vertical_gradient,
+                          inormalize_const2,
+                          inormalize_range,
+                          max_shear_angle)
+    wf.connect([(inputspec, forceqform, [('T1', 'in_file')]),
+                (forceqform, outputspec, [('out_file', 'T1')]),
+                (forceqform, pp, [('out_file', 'inputspec.T1')]),
+                (pp, outputspec, [(f'outputspec.{field}', field) for field in PREPROC_OUTPUTS[1:]])])
+    return wf
+
+
+def _compose(wf, name, transforms, iterate):
+    """A MapNode composing the (node, field) transforms for each element of
+    the list given by transforms[iterate].
+
+    transforms are in the order of antsApplyTransforms, where
+    -t T1 -t T2 maps a point x of the reference space to T2(T1(x)) (e.g.
+    the transform from the fixed to the moving image of a registration,
+    then one from that moving image to another). CompositeTransformUtil
+    --assemble adds its inputs to an ITK CompositeTransform, which applies
+    the last transform added first, so they are assembled in reverse
+    order"""
+    merge = pe.MapNode(Merge(len(transforms)), iterfield=[f'in{len(transforms) - iterate}'],
+                       name=f'{name}merge')
+    compose = pe.MapNode(CompositeTransformUtil(process='assemble', out_file='transform.h5'),
+                         iterfield=['in_file'], name=name)
+    wf.connect([(node, merge, [(field, f'in{i}')])
+                for i, (node, field) in enumerate(reversed(transforms), 1)])
+    wf.connect(merge, 'out', compose, 'in_file')
+    return compose
+
+
+def template_workflow(subcortical=False, debug=False, num_threads=1):
+    """Build an unbiased template of the sessions of a subject (by affinely
+    registering each session to their average and averaging again), register
+    the model (and subcortical model) to it, and affinely register the
+    template to each session. The outputs are lists with the transforms from
+    the model to each session, composed of the two"""
+    wf = pe.Workflow(name='template')
+    inputfields = ['normalized', 'normalized_brain', 'model', 'model_brain']
+    outputfields = ['template', 'template_brain'] + TRANSFORMS
+    if subcortical:
+        inputfields.extend(['subcortical_model', 'subcortical_model_brain'])
+        outputfields.extend(SUBCORTICAL_TRANSFORMS)
+    inputspec = pe.Node(IdentityInterface(fields=inputfields), 'inputspec')
+    outputspec = pe.Node(IdentityInterface(fields=outputfields), 'outputspec')
+    initial = pe.Node(AverageImages(dimension=3, normalize=True, output_average_image='initial.nii.gz'),
+                      'initial')
+    align = pe.MapNode(ants_registration_affine_node(verbose=True, num_threads=num_threads),
+                       iterfield=['moving_image'], name='align')
+    tosession = pe.MapNode(ants_registration_affine_node(verbose=True, num_threads=num_threads),
+                           iterfield=['fixed_image'], name='tosession')
+    if debug:
+        align.inputs.number_of_iterations = [[1, 1, 1, 1], [1, 1, 1, 1]]
+        tosession.inputs.number_of_iterations = [[1, 1, 1, 1], [1, 1, 1, 1]]
+    wf.connect([(inputspec, initial, [('normalized_brain', 'images')]),
+                (initial, align, [('output_average_image', 'fixed_image')]),
+                (inputspec, align, [('normalized_brain', 'moving_image')])])
+    for image in ['', '_brain']:
+        warp = pe.MapNode(resampling.ApplyTransforms(dimension=3, num_threads=num_threads),
+                          iterfield=['input_image', 'transforms'], name=f'warp{image}')
+        average = pe.Node(AverageImages(dimension=3, normalize=True,
+                                        output_average_image=f'template{image}.nii.gz'),
+                          f'template{image}')
+        wf.connect([(inputspec, warp, [(f'normalized{image}', 'input_image')]),
+                    (initial, warp, [('output_average_image', 'reference_image')]),
+                    (align, warp, [('composite_transform', 'transforms')]),
+                    (warp, average, [('output_image', 'images')]),
+                    (average, outputspec, [('output_average_image', f'template{image}')])])
+    template = wf.get_node('template')
+    template_brain = wf.get_node('template_brain')
+    wf.connect([(inputspec, tosession, [('normalized_brain', 'fixed_image')]),
+                (template_brain, tosession, [('output_average_image', 'moving_image')])])
+    for prefix, transforms in [('', TRANSFORMS)] + ([('subcortical_', SUBCORTICAL_TRANSFORMS)] if subcortical else []):
+        linreg, nlreg = _registration_nodes(prefix, debug, num_threads)
+        wf.connect([(template_brain, linreg, [('output_average_image', 'fixed_image')]),
+                    (inputspec, linreg, [(f'{prefix}model_brain', 'moving_image')]),
+                    (linreg, nlreg, [('composite_transform', 'initial_moving_transform')]),
+                    (template, nlreg, [('output_average_image', 'fixed_image')]),
+                    (inputspec, nlreg, [(f'{prefix}model', 'moving_image')])])
+        # session -> template -> model, and the inverse model -> template -> session
+        composed = [_compose(wf, f'{prefix}complinear', [(tosession, 'composite_transform'),
+                                                        (linreg, 'composite_transform')], 0),
+                    _compose(wf, f'{prefix}comptransform', [(tosession, 'composite_transform'),
+                                                           (nlreg, 'composite_transform')], 0),
+                    _compose(wf, f'{prefix}compinverse', [(nlreg, 'inverse_composite_transform'),
+                                                         (tosession, 'inverse_composite_transform')], 1)]
+        for compose, field in zip(composed, transforms):
+            wf.connect(compose, 'out_file', outputspec, field)
+    return wf
+
+
 def main_workflow(statslabels,
                   bet_frac,
                   bet_vertical_gradient,
@@ -300,9 +475,17 @@ def main_workflow(statslabels,
                   icv=False,
                   debug=False,
                   max_shear_angle=1e-6,
-                  num_threads=1):
+                  num_threads=1,
+                  longitudinal=False):
+    """If longitudinal, the outputs of session_preproc_workflow and the
+    transforms of template_workflow are inputs, instead of preprocessing and
+    registering T1"""
     wf = pe.Workflow(name='main')
     inputfields = ['T1', 'model', 'tags', 'atlas', 'model_brain_mask', 'model_brain']
+    if longitudinal:
+        inputfields.extend(PREPROC_OUTPUTS[1:] + TRANSFORMS)
+        if subcortical:
+            inputfields.extend(SUBCORTICAL_TRANSFORMS)
     outputfields = [
         'T1',
         'nu',
@@ -336,24 +519,33 @@ def main_workflow(statslabels,
     inputspec = pe.Node(IdentityInterface(fields=inputfields), 'inputspec')
     outputspec = pe.Node(IdentityInterface(fields=outputfields),
                          name='outputspec')
-    forceqform = pe.Node(pndni_utils.ForceQForm(out_file='T1_qform.nii.gz', maxangle=max_shear_angle), 'forceqc_T1')
-    pp = preproc_workflow(bet_frac,
-                          bet_vertical_gradient,
-                          inormalize_const2,
-                          inormalize_range,
-                          max_shear_angle)
-    ants = ants_workflow(debug=debug, num_threads=num_threads)
+    if longitudinal:
+        pp = pe.Workflow(name='preproc')
+        pp.add_nodes([pe.Node(IdentityInterface(fields=PREPROC_OUTPUTS[1:]), 'outputspec')])
+        wf.connect([(inputspec, pp, [(field, f'outputspec.{field}') for field in PREPROC_OUTPUTS[1:]]),
+                    (inputspec, outputspec, [('T1', 'T1')])])
+    else:
+        forceqform = pe.Node(pndni_utils.ForceQForm(out_file='T1_qform.nii.gz', maxangle=max_shear_angle),
+                             'forceqc_T1')
+        pp = preproc_workflow(bet_frac,
+                              bet_vertical_gradient,
+                              inormalize_const2,
+                              inormalize_range,
+                              max_shear_angle)
+        wf.connect([(inputspec, forceqform, [('T1', 'in_file')]),
+                    (forceqform, outputspec, [('out_file', 'T1')]),
+                    (forceqform, pp, [('out_file', 'inputspec.T1')])])
+    ants = ants_workflow(debug=debug, num_threads=num_threads, longitudinal=longitudinal)
+    if longitudinal:
+        wf.connect([(inputspec, ants, [(field, f'inputspec.{field}') for field in TRANSFORMS])])
     classify = classify_workflow(max_shear_angle)
     segment = segment_lobes_workflow(num_threads=num_threads)
     stats = image_stats_wf(['volume', 'mean'], statslabels, 'stats')
     brainstats = image_stats_wf(['volume', 'mean'],
                                 [OrderedDict(index=1, name='brain')],
                                 'brainstats')
-    wf.connect(inputspec, 'T1', forceqform, 'in_file')
-    wf.connect(forceqform, 'out_file', outputspec, 'T1')
 
     wf.connect([
-        (forceqform, pp, [('out_file', 'inputspec.T1')]),
         (inputspec,
          ants,
          [('model', 'inputspec.model'),
@@ -405,7 +597,10 @@ def main_workflow(statslabels,
         if subcort_statslabels is None:
             raise ValueError(
                 'subcort_statslabels must not be None if subcortical is True')
-        subcort = subcortical_workflow(debug=debug, num_threads=num_threads)
+        subcort = subcortical_workflow(debug=debug, num_threads=num_threads, longitudinal=longitudinal)
+        if longitudinal:
+            wf.connect([(inputspec, subcort, [(field, f'inputspec.{field}')
+                                              for field in SUBCORTICAL_TRANSFORMS])])
         subcort_stats = image_stats_wf(['volume', 'mean'],
                                        subcort_statslabels,
                                        'subcortical_stats')
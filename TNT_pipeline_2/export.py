@@ -0,0 +1,144 @@
+from collections import deque
+import os
+import shutil
+import threading
+
+from nipype.interfaces.base import (BaseInterfaceInputSpec,
+                                    TraitedSpec,
+                                    SimpleInterface,
+                                    File,
+                                    traits)
+from nipype.utils.filemanip import split_filename
+
+from . import logger
+from .utils import StatusCallback
+
+
+class DeferredExportInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc='Input file name')
+    out_file = File(mandatory=True, desc='Output file name')
+    check_extension = traits.Bool(True, usedefault=True,
+                                  desc='Ensure that the input and output file extensions match')
+    clobber = traits.Bool(desc='Permit overwriting existing files')
+
+
+class DeferredExportOutputSpec(TraitedSpec):
+    out_file = File(desc='Output file name, which is written by an ExportQueue')
+
+
+class DeferredExport(SimpleInterface):
+    """Check the arguments as nipype's ExportFile does, but leave copying
+    in_file to out_file to an ExportQueue, so nodes should be run with
+    run_without_submitting=True"""
+    input_spec = DeferredExportInputSpec
+    output_spec = DeferredExportOutputSpec
+
+    def _run_interface(self, runtime):
+        if not self.inputs.clobber and os.path.exists(self.inputs.out_file):
+            raise FileExistsError(self.inputs.out_file)
+        if not os.path.isabs(self.inputs.out_file):
+            raise ValueError('Out_file must be an absolute path.')
+        if (self.inputs.check_extension and
+                split_filename(self.inputs.in_file)[2] != split_filename(self.inputs.out_file)[2]):
+            raise RuntimeError(f'{self.inputs.in_file} and {self.inputs.out_file} have different extensions')
+        self._results['out_file'] = self.inputs.out_file
+        return runtime
+
+
+def _export(in_file, out_file):
+    """Copy in_file to out_file, which never exists partially written"""
+    tmp = os.path.join(os.path.dirname(out_file), f'.{os.path.basename(out_file)}.part')
+    shutil.copy2(in_file, tmp)
+    os.replace(tmp, out_file)
+
+
+class ExportQueue(StatusCallback):
+    """Copy the files of the DeferredExport nodes in background threads once
+    the nodes have finished, with at most n_threads copies and max_bytes
+    (unless a single file is larger) in flight.
+
+    Files are queued in the order their nodes finish, and the threads take
+    the next file once it fits within max_bytes, so the callback (which is
+    called by the scheduler) never waits for copies.
+
+    An instance is a nipype status callback, so it must be passed as (or
+    chained to) the status_callback plugin argument. close (or exiting the
+    context manager) waits for every copy, and raises an error if any copy
+    failed."""
+
+    def __init__(self, n_threads=2, max_bytes=2 * 1024 ** 3):
+        self.max_bytes = max_bytes
+        self.n_files = 0
+        self.errors = []
+        self._pending = deque()
+        self._in_flight = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._threads = [threading.Thread(target=self._run, name=f'ExportQueue-{i}', daemon=True)
+                         for i in range(n_threads)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, in_file, out_file):
+        """Queue copying in_file to out_file, without waiting"""
+        size = os.path.getsize(in_file)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('ExportQueue is closed')
+            self._pending.append((in_file, out_file, size))
+            self._cond.notify_all()
+
+    def _next(self):
+        """Wait for the next file which fits within max_bytes, or return None
+        once the queue is closed and empty"""
+        with self._cond:
+            while True:
+                if self._pending:
+                    size = self._pending[0][2]
+                    if not self._in_flight or self._in_flight + size <= self.max_bytes:
+                        self._in_flight += size
+                        return self._pending.popleft()
+                elif self._closed:
+                    return None
+                self._cond.wait()
+
+    def _run(self):
+        while True:
+            item = self._next()
+            if item is None:
+                return
+            self._copy(*item)
+
+    def _copy(self, in_file, out_file, size):
+        exported = False
+        try:
+            _export(in_file, out_file)
+            exported = True
+        except Exception as e:
+            logger.error(f'Unable to export {in_file} to {out_file}: {e}')
+            self.errors.append((out_file, e))
+        finally:
+            with self._cond:
+                self._in_flight -= size
+                self.n_files += exported
+                self._cond.notify_all()
+
+    def __call__(self, node, status):
+        if status == 'end' and isinstance(node.interface, DeferredExport):
+            self.submit(node.inputs.in_file, node.inputs.out_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+        logger.info(f'Exported {self.n_files} files')
+        if self.errors:
+            raise RuntimeError(f'Unable to export {len(self.errors)} files, e.g. {self.errors[0][0]}')
@@ -1,12 +1,23 @@
 from nipype.pipeline import engine as pe
 from nipype.interfaces.io import ExportFile
 from pndniworkflows.interfaces.io import CombineStats
+from .combine import combine_incremental, combine_streaming
+from .interfaces import CombineStatsTables
+from .summary import write_summary, load_tsv, load_parquet
 from .utils import _update_workdir
 
 
+ROW_KEYS = ['subject', 'session', 'acquisition', 'reconstruction', 'rec']
+INVARIANTS = {'datatype': 'anat', 'extension': 'tsv'}
+INDEX = 'name'
+IGNORE = {'index'}
+
+
 def group_workflow(args):
     groupdir = args.output_folder / 'group'
     groupdir.mkdir(exist_ok=True)
+    if args.columnar_stats:
+        return _columnar_group_workflow(args, groupdir)
     outfile = groupdir / 'group.tsv'
     # if outfile.exists():
     #     raise FileExistsError(f'{outfile} exists')
@@ -14,21 +25,75 @@ def group_workflow(args):
     combine = pe.Node(
         CombineStats(bids_dir=str(args.output_folder),
                      validate=not args.skip_validation,
-                     row_keys=[
-                         'subject',
-                         'session',
-                         'acquisition',
-                         'reconstruction',
-                         'rec'
-                     ],
-                     invariants={
-                         'datatype': 'anat', 'extension': 'tsv'
-                     },
-                     index='name',
-                     ignore={'index'}),
+                     row_keys=ROW_KEYS,
+                     invariants=INVARIANTS,
+                     index=INDEX,
+                     ignore=IGNORE),
         'combine')
     write = pe.Node(ExportFile(out_file=outfile, check_extension=True),
                     'write')
     wf.connect(combine, 'out_tsv', write, 'in_file')
     _update_workdir(wf, args.working_directory)
     return wf
+
+
+def get_stats_tables(output_folder):
+    """The columnar stats tables in the subject folders at the top of
+    output_folder (not those of a parameter sweep)"""
+    return sorted(str(p) for p in output_folder.glob('sub-*/**/*_stats.parquet'))
+
+
+def _columnar_group_workflow(args, groupdir):
+    tables = get_stats_tables(args.output_folder)
+    if not tables:
+        raise RuntimeError(f'No columnar stats tables found in {args.output_folder}. '
+                           'Was the participant level run with --columnar_stats?')
+    outfile = groupdir / 'group.parquet'
+    wf = pe.Workflow('group')
+    combine = pe.Node(CombineStatsTables(in_files=tables), 'combine')
+    write = pe.Node(ExportFile(out_file=outfile, check_extension=True),
+                    'write')
+    wf.connect(combine, 'out_file', write, 'in_file')
+    _update_workdir(wf, args.working_directory)
+    return wf
+
+
+def incremental_group(args):
+    groupdir = args.output_folder / 'group'
+    groupdir.mkdir(exist_ok=True)
+    return combine_incremental(args.output_folder,
+                               groupdir / 'group.tsv',
+                               groupdir / 'group_index.json',
+                               ROW_KEYS,
+                               INVARIANTS,
+                               INDEX,
+                               IGNORE,
+                               n_proc=args.n_proc)
+
+
+def streaming_group(args):
+    groupdir = args.output_folder / 'group'
+    groupdir.mkdir(exist_ok=True)
+    combine_streaming(args.output_folder,
+                      groupdir / 'group.tsv',
+                      ROW_KEYS,
+                      INVARIANTS,
+                      INDEX,
+                      IGNORE,
+                      n_proc=args.n_proc)
+
+
+def summary_group(args):
+    """Write group_summary.tsv and group_outliers.tsv from the
+    group table"""
+    groupdir = args.output_folder / 'group'
+    if args.columnar_stats:
+        in_file, loader = groupdir / 'group.parquet', load_parquet
+    else:
+        in_file, loader = groupdir / 'group.tsv', load_tsv
+    write_summary(in_file,
+                  groupdir / 'group_summary.tsv',
+                  groupdir / 'group_outliers.tsv',
+                  ROW_KEYS + ['run'],
+                  threshold=args.outlier_threshold,
+                  loader=loader)
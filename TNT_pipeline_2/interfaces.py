@@ -0,0 +1,249 @@
+import csv
+import os
+from pathlib import Path
+import shutil
+
+from nipype.interfaces.base import (BaseInterfaceInputSpec,
+                                    TraitedSpec,
+                                    SimpleInterface,
+                                    File,
+                                    isdefined,
+                                    traits)
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError('pyarrow is required for columnar stats tables. '
+                          'Install it with "pip install pyarrow"') from e
+    return pyarrow, pyarrow.parquet
+
+
+def _remove(path):
+    path = Path(path)
+    if path.exists() or path.is_symlink():
+        path.unlink()
+
+
+def _link_or_copy(src, dst):
+    _remove(dst)
+    try:
+        os.link(str(src), str(dst))
+    except OSError:
+        shutil.copyfile(str(src), str(dst))
+
+
+class WriteLabelFilesInputSpec(BaseInterfaceInputSpec):
+    out_files = traits.List(traits.Str(), mandatory=True,
+                            desc='Absolute paths of the label files')
+    strings = traits.List(traits.Str(), mandatory=True,
+                          desc='Contents of each file in out_files')
+
+
+class WriteLabelFilesOutputSpec(TraitedSpec):
+    out_files = traits.List(traits.Str())
+
+
+class WriteLabelFiles(SimpleInterface):
+    """Write each distinct label table once and hard link
+    (or copy, if linking is not possible) it to every other
+    path with the same contents"""
+    input_spec = WriteLabelFilesInputSpec
+    output_spec = WriteLabelFilesOutputSpec
+
+    def _run_interface(self, runtime):
+        if len(self.inputs.out_files) != len(self.inputs.strings):
+            raise ValueError('out_files and strings must have the same length')
+        written = {}
+        for out_file, string in zip(self.inputs.out_files, self.inputs.strings):
+            if not os.path.isabs(out_file):
+                raise ValueError(f'{out_file} must be an absolute path')
+            Path(out_file).parent.mkdir(parents=True, exist_ok=True)
+            if string in written:
+                _link_or_copy(written[string], out_file)
+            else:
+                _remove(out_file)
+                with open(out_file, 'w', newline='') as f:
+                    f.write(string)
+                written[string] = out_file
+        self._results['out_files'] = list(self.inputs.out_files)
+        return runtime
+
+
+class ApplyMaskInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True,
+                   desc='Image to mask, on the grid of mask_file')
+    mask_file = File(exists=True, mandatory=True)
+    in_file2 = File(exists=True,
+                    desc='Another image to mask with the same mask')
+
+
+class ApplyMaskOutputSpec(TraitedSpec):
+    out_file = File(exists=True)
+    out_file2 = File(exists=True)
+
+
+class ApplyMask(SimpleInterface):
+    """Set every voxel of in_file (and in_file2) outside of mask_file (i.e.
+    where it is zero) to zero, as fslmaths -mas does, loading the mask once.
+    The data type and header of each image are kept"""
+    input_spec = ApplyMaskInputSpec
+    output_spec = ApplyMaskOutputSpec
+
+    def _run_interface(self, runtime):
+        import nibabel
+        import numpy as np
+        mask = np.asanyarray(nibabel.load(self.inputs.mask_file).dataobj)
+        mask = mask.reshape(mask.shape[:3]) == 0
+        in_files = [('out_file', self.inputs.in_file)]
+        if isdefined(self.inputs.in_file2):
+            in_files.append(('out_file2', self.inputs.in_file2))
+        for output, in_file in in_files:
+            img = nibabel.load(in_file)
+            if img.shape[:3] != mask.shape:
+                raise ValueError(f'{in_file} and {self.inputs.mask_file} have different shapes')
+            data = np.asanyarray(img.dataobj).copy()
+            data[mask] = 0
+            name = os.path.basename(in_file).split('.')[0] + '_masked.nii.gz'
+            if output == 'out_file2' and name == os.path.basename(self._results['out_file']):
+                name = name.replace('_masked', '_masked2')
+            out_file = os.path.join(runtime.cwd, name)
+            type(img)(data, img.affine, img.header).to_filename(out_file)
+            self._results[output] = out_file
+        return runtime
+
+
+class StatsTableInputSpec(BaseInterfaceInputSpec):
+    in_files = traits.List(File(exists=True), mandatory=True,
+                           desc='Stats TSV files from image_stats_wf')
+    descs = traits.List(traits.Str(), mandatory=True,
+                        desc='The "desc" entity of each file in in_files')
+    entities = traits.Dict(traits.Str(), traits.Any(), mandatory=True,
+                           desc='BIDS entities identifying the scan')
+    out_file = File('stats.parquet', usedefault=True)
+
+
+class StatsTableOutputSpec(TraitedSpec):
+    out_file = File(exists=True)
+
+
+class StatsTable(SimpleInterface):
+    """Combine the stats files of one scan into a long-format Parquet table,
+    with one row per stats file and label"""
+    input_spec = StatsTableInputSpec
+    output_spec = StatsTableOutputSpec
+
+    def _run_interface(self, runtime):
+        pa, pq = _import_pyarrow()
+        if len(self.inputs.in_files) != len(self.inputs.descs):
+            raise ValueError('in_files and descs must have the same length')
+        entities = sorted(self.inputs.entities.keys())
+        rows = []
+        statcols = []
+        for in_file, desc in zip(self.inputs.in_files, self.inputs.descs):
+            with open(in_file, 'r', newline='') as f:
+                for row in csv.DictReader(f, delimiter='\t'):
+                    for col in row.keys():
+                        if col not in ('index', 'name') and col not in statcols:
+                            statcols.append(col)
+                    rows.append((desc, row))
+        columns = {}
+        for key in entities:
+            columns[key] = pa.array([str(self.inputs.entities[key])] * len(rows),
+                                    type=pa.string())
+        columns['desc'] = pa.array([desc for desc, _ in rows], type=pa.string())
+        columns['index'] = pa.array([_to_value(row.get('index'), int) for _, row in rows],
+                                    type=pa.int64())
+        columns['name'] = pa.array([row.get('name') for _, row in rows], type=pa.string())
+        for col in statcols:
+            columns[col] = pa.array([_to_value(row.get(col), float) for _, row in rows],
+                                    type=pa.float64())
+        table = pa.Table.from_arrays(list(columns.values()), names=list(columns.keys()))
+        out_file = os.path.abspath(self.inputs.out_file)
+        pq.write_table(table, out_file)
+        self._results['out_file'] = out_file
+        return runtime
+
+
+def _to_value(value, type_):
+    if value is None or value == 'n/a' or value == '':
+        return None
+    return type_(float(value)) if type_ is int else type_(value)
+
+
+class CombineStatsTablesInputSpec(BaseInterfaceInputSpec):
+    in_files = traits.List(File(exists=True), mandatory=True,
+                           desc='Parquet tables created by StatsTable')
+    out_file = File('combined.parquet', usedefault=True)
+
+
+class CombineStatsTablesOutputSpec(TraitedSpec):
+    out_file = File(exists=True)
+
+
+class CombineStatsTables(SimpleInterface):
+    """Append per-scan Parquet tables into one table. Only one input table is
+    held in memory at a time. Columns missing from a table are filled with
+    nulls"""
+    input_spec = CombineStatsTablesInputSpec
+    output_spec = CombineStatsTablesOutputSpec
+
+    def _run_interface(self, runtime):
+        pa, pq = _import_pyarrow()
+        fields = {}
+        for in_file in self.inputs.in_files:
+            for field in pq.read_schema(in_file):
+                fields.setdefault(field.name, field)
+        schema = pa.schema(list(fields.values()))
+        out_file = os.path.abspath(self.inputs.out_file)
+        writer = pq.ParquetWriter(out_file, schema)
+        try:
+            for in_file in self.inputs.in_files:
+                table = pq.read_table(in_file)
+                arrays = []
+                for field in schema:
+                    if field.name in table.column_names:
+                        arrays.append(table.column(field.name).cast(field.type))
+                    else:
+                        arrays.append(pa.array([None] * table.num_rows, type=field.type))
+                writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+        finally:
+            writer.close()
+        self._results['out_file'] = out_file
+        return runtime
+
+
+class QCSnapshotsInputSpec(BaseInterfaceInputSpec):
+    reportlets = traits.List(traits.Dict(), mandatory=True,
+                             desc='Reportlets from the QC configuration')
+    names = traits.List(traits.Str(), mandatory=True,
+                        desc='Names of the files in in_files, as used by reportlets')
+    in_files = traits.List(File(exists=True), mandatory=True)
+    affine_tolerance = traits.Float(1e-3, usedefault=True,
+                                    desc='Absolute tolerance when checking that an image '
+                                    'and a label image are on the same grid')
+
+
+class QCSnapshotsOutputSpec(TraitedSpec):
+    out_files = traits.List(File(exists=True),
+                            desc='Snapshots, in the order of snapshots.snapshot_outputinfo')
+
+
+class QCSnapshots(SimpleInterface):
+    """Render the image reportlets of the QC configuration (see
+    snapshots.render_reportlets)"""
+    input_spec = QCSnapshotsInputSpec
+    output_spec = QCSnapshotsOutputSpec
+
+    def _run_interface(self, runtime):
+        from .snapshots import render_reportlets
+        if len(self.inputs.names) != len(self.inputs.in_files):
+            raise ValueError('names and in_files must have the same length')
+        self._results['out_files'] = render_reportlets(
+            self.inputs.reportlets,
+            dict(zip(self.inputs.names, self.inputs.in_files)),
+            runtime.cwd,
+            affine_tolerance=self.inputs.affine_tolerance)
+        return runtime
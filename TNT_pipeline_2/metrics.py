@@ -0,0 +1,173 @@
+import os
+import threading
+import time
+
+from . import logger
+from .trace import subject_workflow
+from .utils import StatusCallback
+
+
+PREFIX = 'tnt_pipeline_2'
+NODE_STATES = ['pending', 'running', 'completed', 'failed']
+
+
+def subject_nodes(wf):
+    """The nodes of each T1_* workflow of wf, by itername, in the graph which
+    nipype runs: identity nodes are removed and iterables are expanded (map
+    nodes are expanded while running, and are done when their subnodes are)"""
+    from nipype.pipeline.engine.utils import generate_expanded_graph
+    nodes = {}
+    for node in generate_expanded_graph(wf._create_flat_graph()).nodes():
+        subject = subject_workflow(node.itername)
+        if subject.startswith('T1_'):
+            nodes.setdefault(subject, set()).add(node.itername)
+    return nodes
+
+
+def _value(value):
+    if value is None:
+        return 'NaN'
+    return repr(float(value))
+
+
+def format_metrics(metrics):
+    """Format metrics, a list of (name, help, [(labels, value)]), as
+    Prometheus text, where labels is a dict. All metrics are gauges"""
+    lines = []
+    for name, help, samples in metrics:
+        lines.append(f'# HELP {PREFIX}_{name} {help}')
+        lines.append(f'# TYPE {PREFIX}_{name} gauge')
+        for labels, value in samples:
+            labelstr = ','.join(f'{k}="{v}"' for k, v in sorted(labels.items()))
+            if labelstr:
+                labelstr = '{' + labelstr + '}'
+            lines.append(f'{PREFIX}_{name}{labelstr} {_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsWriter(StatusCallback):
+    """Keep the progress of a run in out_file, in the Prometheus text format
+    (e.g. for the textfile collector of node-exporter, which reads files
+    ending in .prom). The file is replaced atomically every interval seconds
+    by a background thread.
+
+    nodes are the names of the nodes of each T1_* workflow (see
+    subject_nodes). A subject is completed when all its nodes have finished,
+    and failed as soon as one fails. The throughput is the number of completed subjects
+    per hour since the start, and the ETA is the time to finish the
+    remaining subjects at that rate (NaN until a subject completes). The
+    processors and memory reserved by the running nodes are compared to
+    n_procs and memory_gb if they are known.
+
+    An instance is a nipype status callback, so it must be passed as (or
+    chained to) the status_callback plugin argument. The thread is started
+    by start and stopped, after a final write, by stop (or when used as a
+    context manager).
+    """
+
+    def __init__(self, out_file, nodes, n_procs=None, memory_gb=None, interval=10.0):
+        self.out_file = out_file
+        self.nodes = {subject: set(names) for subject, names in nodes.items()}
+        self.n_procs = n_procs
+        self.memory_gb = memory_gb
+        self.interval = interval
+        self.t0 = time.time()
+        self._running = {}
+        self._completed = {}
+        self._failed = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='MetricsWriter', daemon=True)
+
+    def __call__(self, node, status):
+        # the names of the expanded copies of a node differ only in itername
+        name = getattr(node, 'itername', node.fullname)
+        with self._lock:
+            if status == 'start':
+                self._running[name] = (getattr(node, 'n_procs', 1), getattr(node, 'mem_gb', 0.0))
+                return
+            self._running.pop(name, None)
+            subject = subject_workflow(name)
+            if status == 'end':
+                self._completed.setdefault(subject, set()).add(name)
+            elif status == 'exception':
+                self._failed.setdefault(subject, set()).add(name)
+
+    def metrics(self, t=None):
+        """The metrics at t (default now), as for format_metrics"""
+        t = time.time() if t is None else t
+        with self._lock:
+            running = list(self._running.items())
+            completed = {s: len(names & self._completed.get(s, set())) for s, names in self.nodes.items()}
+            failed = {s: len(self._failed[s]) for s in self.nodes if s in self._failed}
+        # map node subnodes belong to no workflow
+        running_subjects = [subject_workflow(name) for name, _ in running]
+        running_subjects = [s for s in running_subjects if s in self.nodes]
+        subjects = {'completed': 0, 'failed': 0, 'running': 0, 'pending': 0}
+        for subject, names in self.nodes.items():
+            if failed.get(subject):
+                subjects['failed'] += 1
+            elif completed[subject] >= len(names):
+                subjects['completed'] += 1
+            elif subject in running_subjects or completed[subject]:
+                subjects['running'] += 1
+            else:
+                subjects['pending'] += 1
+        nodes = {'running': len(running_subjects),
+                 'completed': sum(completed.values()),
+                 'failed': sum(failed.values())}
+        nodes['pending'] = max(sum(len(names) for names in self.nodes.values()) - sum(nodes.values()), 0)
+        elapsed = t - self.t0
+        rate = subjects['completed'] / elapsed * 3600 if elapsed > 0 else 0.0
+        remaining = subjects['running'] + subjects['pending']
+        eta = remaining / rate * 3600 if rate > 0 else (0.0 if not remaining else None)
+        return [
+            ('subjects', 'Number of T1 workflows in each state',
+             [({'state': state}, n) for state, n in sorted(subjects.items())]),
+            ('nodes', 'Number of nodes of the T1 workflows in each state',
+             [({'state': state}, nodes[state]) for state in NODE_STATES]),
+            ('processors', 'Processors reserved by the running nodes, and available',
+             [({'kind': 'reserved'}, sum(n_procs for _, (n_procs, _) in running)),
+              ({'kind': 'available'}, self.n_procs)]),
+            ('memory_gb', 'Memory reserved by the running nodes, and available',
+             [({'kind': 'reserved'}, sum(mem_gb for _, (_, mem_gb) in running)),
+              ({'kind': 'available'}, self.memory_gb)]),
+            ('throughput_subjects_per_hour', 'Completed T1 workflows per hour since the start',
+             [({}, rate)]),
+            ('eta_seconds', 'Estimated seconds until every T1 workflow has finished',
+             [({}, eta)]),
+            ('elapsed_seconds', 'Seconds since the start', [({}, elapsed)]),
+            ('last_update_timestamp_seconds', 'Time of this update', [({}, t)]),
+        ]
+
+    def write(self):
+        """Write the metrics to out_file"""
+        tmpname = os.path.join(os.path.dirname(str(self.out_file)),
+                               f'.{os.path.basename(str(self.out_file))}.tmp')
+        with open(tmpname, 'w') as f:
+            f.write(format_metrics(self.metrics()))
+        os.replace(tmpname, str(self.out_file))
+
+    def _run(self):
+        while True:
+            try:
+                self.write()
+            except Exception as e:
+                logger.warning(f'Unable to write metrics to {self.out_file}: {e}')
+            if self._stop.wait(self.interval):
+                return
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.write()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -1,11 +1,12 @@
-from nipype.pipeline import engine as pe
-from nipype import IdentityInterface
-from nipype.interfaces.io import ExportFile
-from pndniworkflows.interfaces import io
-from pndniworkflows.utils import first_nonunique
 from pathlib import Path
 
 
+# the output folder of each setting of a parameter sweep is a nested BIDS
+# derivatives dataset in this folder, which pybids never indexes as part
+# of the output folder
+SWEEP_DIR = Path('derivatives', 'sweep')
+
+
 def get_outputinfo(model_space,
                    subcortical,
                    subcortical_model_space,
@@ -186,6 +187,53 @@ def get_outputinfo(model_space,
     return outputinfo
 
 
+STATS_OUTPUTS = ['stats', 'brainstats', 'subcortical_stats', 'icv_stats']
+
+
+def get_outputlabels(bidslayout,
+                     entities,
+                     model_space,
+                     atlas_labels_str,
+                     tissue_labels_str,
+                     tissue_and_atlas_labels_str,
+                     subcortical=False,
+                     subcortical_model_space=None,
+                     subcortical_labels_str=None,
+                     intracranial_volume=False):
+    """Return a dictionary mapping output names to (label file, label string)
+    pairs for every output that needs a BIDS label file"""
+    outputinfo = get_outputinfo(model_space,
+                                subcortical,
+                                subcortical_model_space,
+                                intracranial_volume)
+    outputlabels = {}
+    labeloutputs = [('classified', tissue_labels_str),
+                    ('transformed_atlas', atlas_labels_str),
+                    ('segmented', tissue_and_atlas_labels_str),
+                    ('features', tissue_labels_str)]
+    if subcortical:
+        labeloutputs.append(
+            ('native_subcortical_atlas', subcortical_labels_str))
+    for sourcename, label_str in labeloutputs:
+        tmpparams = outputinfo[sourcename].copy()
+        tmpparams['extension'] = 'tsv'
+        tmpparams['presuffix'] = tmpparams['suffix']
+        tmpparams['suffix'] = 'labels'
+        tmplabelpath = bidslayout.build_path({
+            **tmpparams, **entities
+        },
+                                             strict=True,
+                                             validate=False)
+        if tmplabelpath is None:
+            raise RuntimeError('Unable to build path with {}'.format({
+                **tmpparams, **entities
+            }))
+        outputlabels[sourcename] = (str(
+            Path(bidslayout.root, tmplabelpath).resolve()),
+                                    label_str)
+    return outputlabels
+
+
 def io_out_workflow(bidslayout,
                     entities,
                     output_folder,
@@ -197,7 +245,27 @@ def io_out_workflow(bidslayout,
                     subcortical_model_space=None,
                     subcortical_labels_str=None,
                     intracranial_volume=False,
-                    debug=False):
+                    debug=False,
+                    write_labels=True,
+                    columnar_stats=False,
+                    deferred_export=False,
+                    qc_snapshots=False):
+    """If deferred_export, the files are exported by DeferredExport nodes,
+    which run without occupying a slot and leave copying to an ExportQueue.
+    If qc_snapshots, the QC snapshots (see snapshots.snapshot_outputinfo)
+    are also inputs"""
+    # imported here so get_outputinfo (used by qc.make_config) does not load nipype
+    from nipype.pipeline import engine as pe
+    from nipype import IdentityInterface, Merge
+    from nipype.interfaces.io import ExportFile
+    from pndniworkflows.utils import first_nonunique
+    from .interfaces import WriteLabelFiles, StatsTable
+    from .export import DeferredExport
+
+    def export_node(name, **kwargs):
+        if deferred_export:
+            return pe.Node(DeferredExport(**kwargs), name, run_without_submitting=True)
+        return pe.Node(ExportFile(**kwargs), name)
 
     if subcortical and (subcortical_model_space is None
                         or subcortical_labels_str is None):
@@ -209,6 +277,11 @@ def io_out_workflow(bidslayout,
                                 subcortical,
                                 subcortical_model_space,
                                 intracranial_volume)
+    if qc_snapshots:
+        from .qc import make_config
+        from .snapshots import snapshot_outputinfo
+        conf = make_config(model_space, subcortical, subcortical_model_space, intracranial_volume)
+        outputinfo.update(snapshot_outputinfo(conf['reportlets']))
     inputspec = pe.Node(IdentityInterface(fields=list(outputinfo.keys())),
                         'inputspec')
     outputfilenames = {}
@@ -225,46 +298,55 @@ def io_out_workflow(bidslayout,
         tmppath = Path(bidslayout.root, tmppath).resolve()
         tmppath.parent.mkdir(exist_ok=True, parents=True)
         outputfilenames[sourcename] = str(tmppath)
-    outputlabels = {}
-    labeloutputs = [('classified', tissue_labels_str),
-                    ('transformed_atlas', atlas_labels_str),
-                    ('segmented', tissue_and_atlas_labels_str),
-                    ('features', tissue_labels_str)]
-    if subcortical:
-        labeloutputs.append(
-            ('native_subcortical_atlas', subcortical_labels_str))
-    for sourcename, label_str in labeloutputs:
-        tmpparams = outputinfo[sourcename].copy()
-        tmpparams['extension'] = 'tsv'
-        tmpparams['presuffix'] = tmpparams['suffix']
-        tmpparams['suffix'] = 'labels'
-        tmplabelpath = bidslayout.build_path({
-            **tmpparams, **entities
-        },
-                                             strict=True,
-                                             validate=False)
-        if tmplabelpath is None:
-            raise RuntimeError('Unable to build path with {}'.format({
-                **tmpparams, **entities
-            }))
-        outputlabels[sourcename] = (str(
-            Path(bidslayout.root, tmplabelpath).resolve()),
-                                    label_str)
+    outputlabels = get_outputlabels(
+        bidslayout,
+        entities,
+        model_space,
+        atlas_labels_str,
+        tissue_labels_str,
+        tissue_and_atlas_labels_str,
+        subcortical=subcortical,
+        subcortical_model_space=subcortical_model_space,
+        subcortical_labels_str=subcortical_labels_str,
+        intracranial_volume=intracranial_volume)
     duplicate = first_nonunique(
         list(outputfilenames.values()) + list(outputlabels.values()))
     if duplicate is not None:
         raise RuntimeError(
             'Duplicate output files detected! {}'.format(duplicate))
     for sourcename in outputinfo.keys():
-        node = pe.Node(ExportFile(out_file=outputfilenames[sourcename],
-                                  check_extension=not debug),
-                       name='write' + sourcename)
+        node = export_node('write' + sourcename,
+                           out_file=outputfilenames[sourcename],
+                           check_extension=not debug)
         wf.connect(inputspec, sourcename, node, 'in_file')
-        if sourcename in outputlabels:
-            labelnode = pe.Node(
-                io.WriteFile(out_file=outputlabels[sourcename][0],
-                             string=outputlabels[sourcename][1],
-                             newline=''),
-                'write' + sourcename + 'label')
-            wf.add_nodes([labelnode])
+    # in debug mode the stats files are placeholders and cannot be parsed
+    if columnar_stats and not debug:
+        statsnames = [name for name in STATS_OUTPUTS if name in outputinfo]
+        tablepath = bidslayout.build_path({
+            'suffix': 'stats', 'extension': 'parquet', **entities
+        },
+                                          strict=True,
+                                          validate=False)
+        if tablepath is None:
+            raise RuntimeError('Unable to build stats table path with {}'.format(entities))
+        tablepath = str(Path(bidslayout.root, tablepath).resolve())
+        if tablepath in outputfilenames.values():
+            raise RuntimeError(f'Duplicate output files detected! {tablepath}')
+        statsmerge = pe.Node(Merge(len(statsnames)), 'statsmerge')
+        for i, name in enumerate(statsnames, start=1):
+            wf.connect(inputspec, name, statsmerge, f'in{i}')
+        statstable = pe.Node(
+            StatsTable(descs=[outputinfo[name]['desc'] for name in statsnames],
+                       entities=entities),
+            'statstable')
+        writestatstable = export_node('writestatstable', out_file=tablepath, check_extension=True)
+        wf.connect(statsmerge, 'out', statstable, 'in_files')
+        wf.connect(statstable, 'out_file', writestatstable, 'in_file')
+    if write_labels:
+        labelfiles, labelstrings = zip(*outputlabels.values())
+        labelnode = pe.Node(
+            WriteLabelFiles(out_files=list(labelfiles),
+                            strings=list(labelstrings)),
+            'writelabels')
+        wf.add_nodes([labelnode])
     return wf
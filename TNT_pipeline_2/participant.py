@@ -1,16 +1,30 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import os
 from nipype.pipeline import engine as pe
-from nipype import Rename, IdentityInterface
+from nipype import Rename, IdentityInterface, Merge
+from nipype.interfaces.utility import Split
 from pndniworkflows import utils
 from pathlib import Path
 from bids import BIDSLayout
 
-from .core_workflows import main_workflow, forceqform_workflow
-from . import output
-from .utils import _update_workdir, read_json, adjust_node_name
+from .core_workflows import (main_workflow, forceqform_workflow, sweep_settings,
+                             bet_settings, inorm_settings, BET_SWEEP, INORM_SWEEP, SWEEP_SHARED,
+                             session_preproc_workflow, template_workflow, PREPROC_OUTPUTS,
+                             TRANSFORMS, SUBCORTICAL_TRANSFORMS)
+from . import output, qc
+from .interfaces import WriteLabelFiles, QCSnapshots, ApplyMask
+from .snapshots import reportlet_inputs, snapshot_outputinfo
+from .utils import _update_workdir, read_json, write_json, adjust_node_name, get_resource_data
+from .cache import file_hash
 from nipype.interfaces import fsl
 from . import logger
 
 
+# hashes of the T1s, relative to the output folder
+HASH_FILE = Path('logs', 'T1_hashes.json')
+
+
 def participant_workflow(args):
     fsl.FSLCommand.set_default_output_type('NIFTI_GZ')
     inbidslayout = BIDSLayout(args.input_dataset,
@@ -27,22 +41,59 @@ def participant_workflow(args):
             qformfiles.append('intracranial_mask')
         qformwf = forceqform_workflow(qformfiles, args.max_shear_angle)
         for qformfile in qformfiles:
-            setattr(qformwf.inputs.inputspec, qformfile, getattr(args, qformfile))
+            if args.prefetch_dir is None:
+                setattr(qformwf.inputs.inputspec, qformfile, getattr(args, qformfile))
+            else:
+                wf.connect(_prefetch_node(f'prefetch_{qformfile}', getattr(args, qformfile), args),
+                           'out_file', qformwf, f'inputspec.{qformfile}')
         t1inputspec = qformfiles + ['model_brain']
-        maskmodel = pe.Node(fsl.ImageMaths(), 'maskmodel')
+        maskmodel = pe.Node(ApplyMask(), 'maskmodel')
         wf.connect([(qformwf, maskmodel, [('outputspec.model', 'in_file'),
                                           ('outputspec.model_brain_mask', 'mask_file')])])
         if args.subcortical:
-            masksubcortmodel = pe.Node(fsl.ImageMaths(), 'masksubcortmodel')
+            masksubcortmodel = pe.Node(ApplyMask(), 'masksubcortmodel')
             wf.connect([(qformwf, masksubcortmodel, [('outputspec.subcortical_model', 'in_file'),
                                                      ('outputspec.subcortical_model_brain_mask', 'mask_file')])])
             t1inputspec.append('subcortical_model_brain')
     else:
         t1inputspec = []
-    for T1_scan, T1_entities in _get_scans(
-            inbidslayout, args.bids_filter,
-            subject_list=args.participant_labels):
-        tmpwf = t1_workflow(T1_scan, T1_entities, outbidslayout, args, t1inputspec)
+    labelfiles = []
+    sweep_layouts = _sweep_layouts(args)
+    scans = _get_scans(inbidslayout, args.bids_filter, subject_list=args.participant_labels)
+    aliases = {}
+    if args.deduplicate:
+        hashes = hash_scans([T1_scan for T1_scan, _ in scans],
+                            Path(args.output_folder, HASH_FILE), n_proc=args.n_proc)
+        scans, aliases = _deduplicate(scans, hashes)
+    subject_wfs = {}
+    # the Prefetch node of each T1 and the output of the node reading it
+    prefetch_gates = []
+    if args.longitudinal:
+        for subject, subject_scans in _longitudinal_subjects(scans).items():
+            subject_wf, names = longitudinal_workflow(subject, subject_scans, args)
+            for qformfile in ['model'] + (['subcortical_model'] if args.subcortical else []):
+                wf.connect(qformwf, f'outputspec.{qformfile}', subject_wf, f'template.inputspec.{qformfile}')
+            wf.connect(maskmodel, 'out_file', subject_wf, 'template.inputspec.model_brain')
+            if args.subcortical:
+                wf.connect(masksubcortmodel, 'out_file', subject_wf, 'template.inputspec.subcortical_model_brain')
+            subject_wfs[subject] = subject_wf, [T1_scan for T1_scan, _ in subject_scans], names
+    for T1_scan, T1_entities in scans:
+        longitudinal = T1_entities['subject'] in subject_wfs
+        tmpwf = t1_workflow(T1_scan, T1_entities, outbidslayout, args,
+                            t1inputspec + _longitudinal_inputs(args) if longitudinal else t1inputspec,
+                            sweep_layouts=sweep_layouts, longitudinal=longitudinal,
+                            aliases=aliases.get(T1_scan, []))
+        for layout in (outbidslayout,) if sweep_layouts is None else sweep_layouts:
+            for entities in [T1_entities] + aliases.get(T1_scan, []):
+                labelfiles.extend(_get_outputlabels(layout, entities, args))
+        if longitudinal:
+            subject_wf, subject_scans, names = subject_wfs[T1_entities['subject']]
+            index = subject_scans.index(T1_scan)
+            _connect_longitudinal(wf, subject_wf, names[index], index, tmpwf, args)
+            prefetch_gates.append((f'{subject_wf.name}.prefetch_{names[index][len("preproc_"):]}',
+                                   f'{subject_wf.name}.{names[index]}.outputspec.T1'))
+        else:
+            prefetch_gates.append((f'{tmpwf.name}.prefetch', f'{tmpwf.name}.main.outputspec.T1'))
         if not args.debug_io:
             for qformfile in qformfiles:
                 wf.connect(qformwf, f'outputspec.{qformfile}', tmpwf, f'inputspec.{qformfile}')
@@ -51,9 +102,20 @@ def participant_workflow(args):
                 wf.connect(masksubcortmodel, 'out_file', tmpwf, 'inputspec.subcortical_model_brain')
         else:
             wf.add_nodes([tmpwf])
+    if args.prefetch_dir is not None and not args.debug_io:
+        from .prefetch import gate_prefetch
+        gate_prefetch(wf, prefetch_gates, args.prefetch_ahead)
+    if labelfiles:
+        # The label tables are identical for every scan, so they are written
+        # once by a single node and linked to each scan's derivatives
+        outfiles, strings = zip(*labelfiles)
+        writelabels = pe.Node(WriteLabelFiles(out_files=list(outfiles),
+                                              strings=list(strings)),
+                              'writelabels')
+        wf.add_nodes([writelabels])
     _update_workdir(wf, args.working_directory)
     if args.resource_input_file is not None:
-        _set_resource_data(wf, args.resource_input_file)
+        _set_resource_data(wf, args.resource_input_file, args.resource_statistic)
     return wf
 
 
@@ -72,8 +134,9 @@ def _get_all_nodes(wf, name=None):
             yield ('.'.join(name + [node.name]), node)
 
 
-def _set_resource_data(wf, fname):
-    data = read_json(fname)
+def _set_resource_data(wf, fname, statistic=None):
+    statistic, data = get_resource_data(read_json(fname), statistic)
+    logger.info(f'Using the {statistic} processor and memory usage of each node from {fname}')
     for fullname, node in _get_all_nodes(wf):
         nameadj = adjust_node_name(fullname)
         if nameadj in data:
@@ -86,14 +149,183 @@ def _set_resource_data(wf, fname):
             logger.info(f'Set {node} (fullname {fullname}) _mem_gb to {node._mem_gb}')
 
 
-def t1_workflow(T1_scan, entities, outbidslayout, args, inputfiles):
-    wf = pe.Workflow(name='T1_' +
-                     '_'.join((f'{key}-{val}'
-                               for key, val in entities.items())))
-    io_out_wf = output.io_out_workflow(
+def _get_outputlabels(outbidslayout, entities, args):
+    return output.get_outputlabels(
+        outbidslayout,
+        entities,
+        args.model_space,
+        args.atlas_labels.string,
+        args.tissue_labels.string,
+        args.tissue_and_atlas_labels.string,
+        subcortical=args.subcortical,
+        subcortical_model_space=args.subcortical_model_space,
+        subcortical_labels_str=args.subcortical_labels.string,
+        intracranial_volume=args.intracranial_volume).values()
+
+
+def hash_scans(filenames, hash_file, n_proc=None):
+    """The sha256 of each file, hashed by n_proc threads. The hashes are
+    saved in hash_file, and reused for files whose size and modification time
+    have not changed"""
+    try:
+        known = read_json(hash_file)
+    except FileNotFoundError:
+        known = {}
+
+    def get_hash(fname):
+        path = os.path.realpath(fname)
+        stat = os.stat(path)
+        info = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+        old = known.get(path, {})
+        if {key: old.get(key) for key in info} == info:
+            return path, old
+        return path, {**info, 'sha256': file_hash(path)}
+
+    with ThreadPoolExecutor(n_proc) as executor:
+        hashes = list(executor.map(get_hash, filenames))
+    known.update(hashes)
+    Path(hash_file).parent.mkdir(parents=True, exist_ok=True)
+    tmp = Path(f'{hash_file}.{os.getpid()}.tmp')
+    write_json(known, tmp)
+    os.replace(str(tmp), str(hash_file))
+    return [info['sha256'] for _, info in hashes]
+
+
+def _deduplicate(scans, hashes):
+    """Keep the first of the scans with the same hash. Returns the scans
+    kept and the entities of the duplicates of each"""
+    groups = OrderedDict()
+    for scan, sha256 in zip(scans, hashes):
+        groups.setdefault(sha256, []).append(scan)
+    aliases = {}
+    for group in groups.values():
+        if len(group) > 1:
+            logger.info(f'Processing {group[0][0]} once for the identical '
+                        f'{", ".join(T1_scan for T1_scan, _ in group[1:])}')
+            aliases[group[0][0]] = [entities for _, entities in group[1:]]
+    return [group[0] for group in groups.values()], aliases
+
+
+def _longitudinal_subjects(scans):
+    """The scans of each subject with more than one scan"""
+    subjects = {}
+    for T1_scan, entities in scans:
+        subjects.setdefault(entities['subject'], []).append((T1_scan, entities))
+    return {subject: subject_scans for subject, subject_scans in subjects.items()
+            if len(subject_scans) > 1}
+
+
+def _prefetch_node(name, in_file, args):
+    """A node copying in_file to args.prefetch_dir (see prefetch.Prefetch)"""
+    from .prefetch import Prefetch
+    return pe.Node(Prefetch(in_file=str(in_file), scratch_dir=str(args.prefetch_dir)), name,
+                   run_without_submitting=True, overwrite=True)
+
+
+def _longitudinal_inputs(args):
+    return PREPROC_OUTPUTS + TRANSFORMS + (SUBCORTICAL_TRANSFORMS if args.subcortical else [])
+
+
+def longitudinal_workflow(subject, scans, args):
+    """Preprocess each scan of subject and build the subject template (see
+    core_workflows.template_workflow). Returns the workflow and the name of
+    the session_preproc_workflow of each scan"""
+    wf = pe.Workflow(name=f'longitudinal_sub-{subject}')
+    template_wf = template_workflow(subcortical=args.subcortical, debug=args.debug,
+                                    num_threads=args.ants_n_proc)
+    names = []
+    for field in ['normalized', 'normalized_brain']:
+        merge = pe.Node(Merge(len(scans)), f'merge_{field}')
+        wf.connect(merge, 'out', template_wf, f'inputspec.{field}')
+    for i, (T1_scan, entities) in enumerate(scans, 1):
+        name = 'preproc_' + '_'.join(f'{key}-{val}' for key, val in entities.items() if key != 'subject')
+        session_wf = session_preproc_workflow(name,
+                                              args.bet_frac,
+                                              args.bet_vertical_gradient,
+                                              args.inormalize_const2,
+                                              args.inormalize_range,
+                                              args.max_shear_angle)
+        if args.prefetch_dir is None:
+            session_wf.inputs.inputspec.T1 = T1_scan
+        else:
+            wf.connect(_prefetch_node(f'prefetch_{name[len("preproc_"):]}', T1_scan, args),
+                       'out_file', session_wf, 'inputspec.T1')
+        for field in ['normalized', 'normalized_brain']:
+            wf.connect(session_wf, f'outputspec.{field}', wf.get_node(f'merge_{field}'), f'in{i}')
+        names.append(name)
+    return wf, names
+
+
+def _connect_longitudinal(wf, subject_wf, name, index, t1_wf, args):
+    """Connect the preprocessed scan and its transforms from subject_wf (see
+    longitudinal_workflow) to t1_wf"""
+    transforms = TRANSFORMS + (SUBCORTICAL_TRANSFORMS if args.subcortical else [])
+    wf.connect([(subject_wf, t1_wf,
+                 [(f'{name}.outputspec.{field}', f'inputspec.{field}') for field in PREPROC_OUTPUTS] +
+                 [((f'template.outputspec.{field}', _select, index), f'inputspec.{field}')
+                  for field in transforms])])
+
+
+def sweep_label(setting):
+    """The name of the output folder of a setting of a parameter sweep"""
+    const2 = '-'.join(f'{v:g}' for v in setting['const2'])
+    return f'frac-{setting["frac"]:g}_vg-{setting["vertical_gradient"]:g}_const2-{const2}'
+
+
+def _sweep_layouts(args):
+    """The output layout of each setting of a parameter sweep, or None if
+    only one setting is given"""
+    settings = sweep_settings(args.bet_frac, args.bet_vertical_gradient, args.inormalize_const2)
+    if len(settings) == 1:
+        return None
+    layouts = []
+    for setting in settings:
+        folder = Path(args.output_folder) / output.SWEEP_DIR / sweep_label(setting)
+        folder.mkdir(parents=True, exist_ok=True)
+        layouts.append(utils.get_BIDSLayout_with_conf(folder, validate=False))
+    logger.info(f'Parameter sweep of {len(settings)} settings in {Path(args.output_folder) / output.SWEEP_DIR}')
+    return layouts
+
+
+def _select(values, *index):
+    for i in index:
+        values = values[i]
+    return values
+
+
+def _connect_sweep(wf, main_wf, io_out_wfs, fields, args):
+    """Join the outputs of every setting of a parameter sweep and connect
+    each setting to its own io_out workflow"""
+    sources = {field: (main_wf, f'outputspec.{field}') for field in fields}
+    joined = {field: [] for field in fields}
+    nbet = len(bet_settings(args.bet_frac, args.bet_vertical_gradient))
+    # BET is inside the expansion of inorm, so it is joined first
+    for joinsource, n in [(BET_SWEEP, nbet), (INORM_SWEEP, len(inorm_settings(args.inormalize_const2)))]:
+        if n == 1:
+            continue
+        # outputs computed before the swept node are not expanded, so are not joined
+        joinfields = [field for field in fields if field not in SWEEP_SHARED[joinsource]]
+        join = pe.JoinNode(IdentityInterface(fields=joinfields), joinsource=joinsource,
+                           joinfield=joinfields, name=f'join_{joinsource}')
+        for field in joinfields:
+            wf.connect(*sources[field], join, field)
+            sources[field] = (join, field)
+            joined[field].insert(0, joinsource)
+    for k, io_out_wf in enumerate(io_out_wfs):
+        i, j = divmod(k, nbet)
+        for field in fields:
+            source, sourcefield = sources[field]
+            index = [i if joinsource == INORM_SWEEP else j for joinsource in joined[field]]
+            if index:
+                sourcefield = (sourcefield, _select, *index)
+            wf.connect([(source, io_out_wf, [(sourcefield, f'inputspec.{field}')])])
+
+
+def _io_out_workflow(outbidslayout, output_folder, entities, args):
+    return output.io_out_workflow(
         outbidslayout,
         entities,
-        args.output_folder,
+        output_folder,
         args.model_space,
         args.atlas_labels.string,
         args.tissue_labels.string,
@@ -102,7 +334,36 @@ def t1_workflow(T1_scan, entities, outbidslayout, args, inputfiles):
         subcortical_model_space=args.subcortical_model_space,
         subcortical_labels_str=args.subcortical_labels.string,
         intracranial_volume=args.intracranial_volume,
-        debug=args.debug_io)
+        debug=args.debug_io,
+        write_labels=False,
+        columnar_stats=args.columnar_stats,
+        deferred_export=args.export_threads > 0,
+        qc_snapshots=args.qc_snapshots and not args.debug_io)
+
+
+def t1_workflow(T1_scan, entities, outbidslayout, args, inputfiles, sweep_layouts=None,
+                longitudinal=False, aliases=()):
+    """If sweep_layouts is given (a layout for each of the settings of a
+    parameter sweep), the outputs of each setting are saved to its layout
+    instead of outbidslayout. If longitudinal, the preprocessed T1 and its
+    transforms are inputs (see longitudinal_workflow). The outputs are also
+    saved with the entities of each of aliases (T1s identical to T1_scan)"""
+    wf = pe.Workflow(name='T1_' +
+                     '_'.join((f'{key}-{val}'
+                               for key, val in entities.items())))
+    if sweep_layouts is None:
+        io_out_wf = _io_out_workflow(outbidslayout, args.output_folder, entities, args)
+    else:
+        io_out_wfs = []
+        for i, layout in enumerate(sweep_layouts):
+            io_out_wf = _io_out_workflow(layout, layout.root, entities, args)
+            io_out_wf.name = f'io_out_sweep{i}'
+            io_out_wfs.append(io_out_wf)
+    alias_io_out_wfs = []
+    for i, alias in enumerate(aliases):
+        alias_io_out_wf = _io_out_workflow(outbidslayout, args.output_folder, alias, args)
+        alias_io_out_wf.name = f'io_out_alias{i}'
+        alias_io_out_wfs.append(alias_io_out_wf)
 
     if args.debug_io:
         renametr = pe.Node(
@@ -187,20 +448,33 @@ def t1_workflow(T1_scan, entities, outbidslayout, args, inputfiles):
             subcort_statslabels=args.subcortical_labels.labels,
             icv=args.intracranial_volume,
             max_shear_angle=args.max_shear_angle,
-            num_threads=args.ants_n_proc)
+            num_threads=args.ants_n_proc,
+            longitudinal=longitudinal)
         main_wf.inputs.inputspec.tags = args.tags
-        main_wf.inputs.inputspec.T1 = T1_scan
+        if not longitudinal:
+            if args.prefetch_dir is None:
+                main_wf.inputs.inputspec.T1 = T1_scan
+            else:
+                wf.connect(_prefetch_node('prefetch', T1_scan, args), 'out_file', main_wf, 'inputspec.T1')
         connectspec = [(f'{connectname}', f'inputspec.{connectname}')
                        for connectname in inputfiles]
         wf.connect([(inputspec, main_wf, connectspec)])
-        connectspec = [(f'outputspec.{connectname}',
-                        f'inputspec.{connectname}')
-                       for connectname in output.get_outputinfo(
-                           args.model_space,
-                           args.subcortical,
-                           args.subcortical_model_space,
-                           args.intracranial_volume).keys()]
-        wf.connect([(main_wf, io_out_wf, connectspec)])
+        outputnames = list(output.get_outputinfo(
+            args.model_space,
+            args.subcortical,
+            args.subcortical_model_space,
+            args.intracranial_volume).keys())
+        if sweep_layouts is None:
+            connectspec = [(f'outputspec.{connectname}',
+                            f'inputspec.{connectname}')
+                           for connectname in outputnames]
+            wf.connect([(main_wf, io_out_wf, connectspec)])
+            for alias_io_out_wf in alias_io_out_wfs:
+                wf.connect([(main_wf, alias_io_out_wf, connectspec)])
+        else:
+            _connect_sweep(wf, main_wf, io_out_wfs, outputnames, args)
+        if args.qc_snapshots:
+            _add_qc_snapshots(wf, main_wf, [io_out_wf] + alias_io_out_wfs, args)
 
     crashdump_dir = outbidslayout.build_path({
         'rootdir': 'logs', **entities
@@ -219,6 +493,32 @@ def t1_workflow(T1_scan, entities, outbidslayout, args, inputfiles):
     return wf
 
 
+def _add_qc_snapshots(wf, main_wf, io_out_wfs, args):
+    """Render the QC images while the outputs of main_wf are still in
+    the page cache, and save them with the outputs of each of io_out_wfs,
+    so qcpages does not have to read the images"""
+    conf = qc.make_config(args.model_space,
+                          args.subcortical,
+                          args.subcortical_model_space,
+                          args.intracranial_volume)
+    names = reportlet_inputs(conf['reportlets'])
+    snapshotnames = list(snapshot_outputinfo(conf['reportlets']))
+    snapshotfiles = pe.Node(Merge(len(names)), 'snapshotfiles')
+    for i, name in enumerate(names, start=1):
+        wf.connect(main_wf, f'outputspec.{name}', snapshotfiles, f'in{i}')
+    qcsnapshots = pe.Node(
+        QCSnapshots(reportlets=conf['reportlets'],
+                    names=names,
+                    affine_tolerance=conf['global_reportlet_settings']['affine_absolute_tolerance']),
+        'qcsnapshots')
+    wf.connect(snapshotfiles, 'out', qcsnapshots, 'in_files')
+    splitsnapshots = pe.Node(Split(splits=[1] * len(snapshotnames), squeeze=True), 'splitsnapshots')
+    wf.connect(qcsnapshots, 'out_files', splitsnapshots, 'inlist')
+    for io_out_wf in io_out_wfs:
+        wf.connect([(splitsnapshots, io_out_wf, [(f'out{i}', f'inputspec.{name}')
+                                                 for i, name in enumerate(snapshotnames, start=1)])])
+
+
 def _get_scans(bidslayout, bids_filter, subject_list=None):
     t1wfilter = {
         'suffix': 'T1w', 'datatype': 'anat', 'extension': ['nii', 'nii.gz']
@@ -0,0 +1,153 @@
+from concurrent.futures import ThreadPoolExecutor
+import fcntl
+import hashlib
+import os
+import shutil
+import threading
+
+from nipype.interfaces.base import (BaseInterfaceInputSpec,
+                                    TraitedSpec,
+                                    SimpleInterface,
+                                    File,
+                                    traits)
+
+from . import logger
+from .utils import StatusCallback
+
+
+def local_path(scratch_dir, path):
+    """The path of the copy of path in scratch_dir. Files with the same name
+    in different directories have different copies"""
+    key = hashlib.sha1(os.path.realpath(path).encode()).hexdigest()[:16]
+    return os.path.join(str(scratch_dir), key, os.path.basename(path))
+
+
+def fetch(path, scratch_dir):
+    """Copy path to scratch_dir (see local_path), unless an up-to-date copy
+    (with the same size and modification time) exists, and return the copy.
+    Concurrent fetches of the same file, by threads or processes, wait for
+    the first to finish"""
+    dst = local_path(scratch_dir, path)
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    with open(dst + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            stat = os.stat(path)
+            try:
+                dststat = os.stat(dst)
+            except FileNotFoundError:
+                dststat = None
+            if dststat is None or (dststat.st_size, dststat.st_mtime_ns) != (stat.st_size, stat.st_mtime_ns):
+                tmp = f'{dst}.part'
+                shutil.copy2(path, tmp)
+                os.replace(tmp, dst)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return dst
+
+
+class PrefetchInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True)
+    scratch_dir = traits.Str(mandatory=True,
+                             desc='Absolute path of the directory to copy in_file to')
+    after = traits.Any(nohash=True, desc='Ignored, connected to delay the node (see gate_prefetch)')
+
+
+class PrefetchOutputSpec(TraitedSpec):
+    out_file = File(exists=True)
+
+
+class Prefetch(SimpleInterface):
+    """Copy in_file to scratch_dir (see fetch), so that the nodes reading it
+    read the local copy. It is normally already copied, or being copied, by a
+    Prefetcher, whose copy fetch waits for. Nodes should be run with
+    run_without_submitting=True, so they do not hold a processor while
+    waiting, and overwrite=True, so the file is fetched again if the scratch
+    directory has been cleared"""
+    input_spec = PrefetchInputSpec
+    output_spec = PrefetchOutputSpec
+
+    def _run_interface(self, runtime):
+        if not os.path.isabs(self.inputs.scratch_dir):
+            raise ValueError(f'{self.inputs.scratch_dir} must be an absolute path')
+        self._results['out_file'] = fetch(self.inputs.in_file, self.inputs.scratch_dir)
+        return runtime
+
+
+def prefetch_files(wf):
+    """The input files of the Prefetch nodes of wf, in the order in which
+    the nodes can run (see gate_prefetch)"""
+    import networkx as nx
+    files = []
+    for node in nx.topological_sort(wf._create_flat_graph()):
+        if isinstance(node.interface, Prefetch) and node.inputs.in_file not in files:
+            files.append(node.inputs.in_file)
+    return files
+
+
+def gate_prefetch(wf, gates, ahead):
+    """Delay each Prefetch node of wf until the file ahead places earlier has
+    been read, so that at most ahead files are fetched before the nodes
+    reading them start. gates lists, in the order in which the files are
+    processed, the names (relative to wf) of each Prefetch node and of an
+    output of the first node reading its file, e.g.
+    ('T1_sub-1.prefetch', 'T1_sub-1.main.outputspec.T1')"""
+    for (prefetch, _), (_, output) in zip(gates[ahead:], gates):
+        src = output.split('.')
+        dst = prefetch.split('.')
+        common = 0
+        while src[common] == dst[common]:
+            common += 1
+        parent = wf.get_node('.'.join(src[:common])) if common else wf
+        parent.connect(parent.get_node(src[common]), '.'.join(src[common + 1:]),
+                       parent.get_node(dst[common]), '.'.join(dst[common + 1:] + ['after']))
+
+
+class Prefetcher(StatusCallback):
+    """Copy files to scratch_dir in background threads, at most ahead files
+    after the last file whose Prefetch node has started (see gate_prefetch
+    for the order of the nodes).
+
+    An instance is a nipype status callback, so it must be passed as (or
+    chained to) the status_callback plugin argument. Pending copies are
+    cancelled by close (or when used as a context manager)."""
+
+    def __init__(self, files, scratch_dir, ahead=2, n_threads=2):
+        self.files = list(files)
+        self.scratch_dir = scratch_dir
+        self.ahead = ahead
+        self._index = {f: i for i, f in enumerate(self.files)}
+        self._executor = ThreadPoolExecutor(max_workers=n_threads)
+        self._futures = []
+        self._lock = threading.Lock()
+        self.schedule(ahead - 1)
+
+    def schedule(self, last):
+        """Start copying every file up to index last which is not copied"""
+        with self._lock:
+            for path in self.files[len(self._futures):last + 1]:
+                self._futures.append(self._executor.submit(self._fetch, path))
+
+    def _fetch(self, path):
+        try:
+            fetch(path, self.scratch_dir)
+        except OSError as e:
+            # the Prefetch node copies it instead
+            logger.warning(f'Unable to prefetch {path}: {e}')
+
+    def __call__(self, node, status):
+        if status == 'start' and isinstance(node.interface, Prefetch):
+            index = self._index.get(node.inputs.in_file)
+            if index is not None:
+                self.schedule(index + self.ahead)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        for future in self._futures:
+            future.cancel()
+        self._executor.shutdown(wait=True)
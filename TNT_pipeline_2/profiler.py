@@ -0,0 +1,170 @@
+import json
+import os
+from pathlib import Path
+import threading
+import time
+
+from . import logger
+
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+GiB = float(1 << 30)
+
+
+def _read_stat(pid):
+    """Return the parent pid, CPU time (in clock ticks), and RSS (in pages)
+    of pid from /proc/<pid>/stat"""
+    with open(f'/proc/{pid}/stat', 'r') as f:
+        stat = f.read()
+    # the command name may contain spaces and parentheses
+    fields = stat[stat.rindex(')') + 2:].split()
+    return int(fields[1]), int(fields[11]) + int(fields[12]), int(fields[21])
+
+
+def _read_io(pid):
+    """Return the bytes read from and written to storage by pid"""
+    read = write = 0
+    try:
+        with open(f'/proc/{pid}/io', 'r') as f:
+            for line in f:
+                key, _, val = line.partition(':')
+                if key == 'read_bytes':
+                    read = int(val)
+                elif key == 'write_bytes':
+                    write = int(val)
+    except (PermissionError, FileNotFoundError, ProcessLookupError):
+        pass
+    return read, write
+
+
+def process_tree(root):
+    """Return {pid: (cpu ticks, rss pages)} for root and all its descendants"""
+    stats = {}
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            ppid, ticks, rss = _read_stat(entry)
+        except (FileNotFoundError, ProcessLookupError, ValueError, IndexError):
+            # the process exited while reading
+            continue
+        pid = int(entry)
+        stats[pid] = (ticks, rss)
+        children.setdefault(ppid, []).append(pid)
+    out = {}
+    todo = [root]
+    while todo:
+        pid = todo.pop()
+        if pid in stats:
+            out[pid] = stats[pid]
+        todo.extend(children.get(pid, []))
+    return out
+
+
+def node_name(cwd, workflow_name):
+    """The name of the node whose directory is cwd, e.g.
+    <working directory>/participant/T1_.../main/bet gives
+    participant.T1_....main.bet. Map node directories are attributed to
+    the map node. Returns None if cwd is not in a node directory"""
+    parts = Path(cwd).parts
+    if workflow_name not in parts:
+        return None
+    parts = parts[parts.index(workflow_name):]
+    if 'mapflow' in parts:
+        parts = parts[:parts.index('mapflow')]
+    if len(parts) < 2:
+        return None
+    return '.'.join(parts)
+
+
+class ProcProfiler(object):
+    """Sample the CPU usage, RSS, and storage I/O of this process and its
+    descendants from /proc every interval seconds, in a background thread.
+
+    Each process is attributed to a node by its working directory. For every
+    node with at least one process, a line of JSON is appended to out_file
+    with the node name, time, CPU usage in percent (cpus), total RSS
+    (rss_GiB), bytes read and written since the previous sample
+    (read_bytes and write_bytes), and number of processes (nproc). This file
+    can be read by utils.load_resources_file.
+
+    CPU time and I/O of processes which start and exit between two samples
+    are not recorded.
+    """
+
+    def __init__(self, out_file, interval=1.0, workflow_name='participant', pid=None):
+        if not os.path.isdir('/proc'):
+            raise RuntimeError('The proc profiler requires /proc')
+        self.out_file = out_file
+        self.interval = interval
+        self.workflow_name = workflow_name
+        self.pid = os.getpid() if pid is None else pid
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='ProcProfiler', daemon=True)
+        self._previous = {}
+        self._previous_time = None
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _run(self):
+        with open(self.out_file, 'w') as f:
+            while True:
+                try:
+                    for sample in self.sample():
+                        f.write(json.dumps(sample) + '\n')
+                    f.flush()
+                except Exception as e:
+                    logger.warning(f'Profiler sample failed: {e}')
+                if self._stop.wait(self.interval):
+                    return
+
+    def sample(self):
+        """Return one sample of every node. The first call only records
+        the baseline of each process"""
+        now = time.time()
+        nodes = {}
+        current = {}
+        for pid, (ticks, rss) in process_tree(self.pid).items():
+            try:
+                name = node_name(os.readlink(f'/proc/{pid}/cwd'), self.workflow_name)
+            except (FileNotFoundError, ProcessLookupError, PermissionError):
+                continue
+            read, write = _read_io(pid)
+            current[pid] = (ticks, read, write)
+            if name is None:
+                continue
+            # new processes started after the previous sample
+            prevticks, prevread, prevwrite = self._previous.get(pid, (0, 0, 0))
+            node = nodes.setdefault(name, [0, 0, 0, 0, 0])
+            node[0] += ticks - prevticks
+            node[1] += rss
+            node[2] += read - prevread
+            node[3] += write - prevwrite
+            node[4] += 1
+        previous_time, self._previous_time = self._previous_time, now
+        self._previous = current
+        if previous_time is None:
+            return []
+        dt = now - previous_time
+        return [{'name': name,
+                 'time': now,
+                 'cpus': 100.0 * ticks / CLOCK_TICKS / dt,
+                 'rss_GiB': rss * PAGE_SIZE / GiB,
+                 'read_bytes': read,
+                 'write_bytes': write,
+                 'nproc': nproc}
+                for name, (ticks, rss, read, write, nproc) in sorted(nodes.items())]
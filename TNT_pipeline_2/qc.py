@@ -1,4 +1,15 @@
-from . import output
+from contextlib import contextmanager
+import copy
+import fcntl
+import html
+import json
+import os
+from pathlib import Path
+import re
+import shutil
+import zlib
+
+from . import combine, logger, output
 
 
 def make_config(model_space,
@@ -194,3 +205,299 @@ def make_config(model_space,
         },
     ])
     return conf
+
+
+MANIFEST = 'qc_manifest.json'
+MANIFEST_VERSION = 1
+SHARD_DIR = 'shards'
+# reportlets which do not read any images or tables, so a page with only
+# these is quick to create
+INDEX_REPORTLETS = ('crash', 'rating')
+# lock file of the QC directory, held while pages are moved into it
+LOCK_FILE = '.lock'
+
+
+@contextmanager
+def _locked(qc_dir):
+    with open(str(Path(qc_dir) / LOCK_FILE), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def page_filename(template, key):
+    """Fill in a page_filename_template. Optional parts, in square brackets,
+    are dropped if any of their fields are missing"""
+    def fill(match):
+        try:
+            return match.group(1).format(**key)
+        except KeyError:
+            return ''
+    return re.sub(r'\[([^\]]*)\]', fill, template).format(**key)
+
+
+def _path_entities(relpath):
+    entities = {}
+    for part in relpath.parts:
+        for keyval in part.split('_'):
+            k, sep, v = keyval.partition('-')
+            if sep and k in combine.ENTITY_NAMES:
+                entities.setdefault(combine.ENTITY_NAMES[k], v.split('.')[0])
+    return entities
+
+
+def find_page_files(output_folder, page_keys, exclude=('QC', 'group', output.SWEEP_DIR.parts[0])):
+    """Return a dictionary mapping each page key (a tuple with the
+    page_keys entities of a scan) to the fingerprints of all files
+    (including crash files) with those entities. The folders in exclude
+    (QC pages, group tables, and parameter sweeps) are skipped"""
+    output_folder = Path(output_folder)
+    pages = {}
+    for fname in output_folder.glob('**/*'):
+        relpath = fname.relative_to(output_folder)
+        if relpath.parts[0] in exclude or not fname.is_file():
+            continue
+        entities = _path_entities(relpath)
+        if 'subject' not in entities:
+            continue
+        key = tuple(entities.get(k) for k in page_keys)
+        pages.setdefault(key, {})[str(relpath)] = combine._fingerprint(fname)
+    return pages
+
+
+def _restrict_config(conf, subjects):
+    conf = copy.deepcopy(conf)
+    for spec in conf['files'].values():
+        spec['filter']['subject'] = sorted(subjects)
+    return conf
+
+
+def _index_config(conf):
+    """A copy of conf with only the INDEX_REPORTLETS, with which qc_all
+    creates the same index as with conf, but quickly"""
+    conf = copy.deepcopy(conf)
+    conf['reportlets'] = [r for r in conf['reportlets'] if r['type'] in INDEX_REPORTLETS]
+    return conf
+
+
+def write_index(output_folder, qc_dir, conf, **kwargs):
+    """Create the index of every page with qc_all. It is run in a staging
+    directory, and its pages are discarded"""
+    from PipelineQC.main import qc_all
+    staging = qc_dir / '.index'
+    if staging.exists():
+        shutil.rmtree(str(staging))
+    qc_all([output_folder], staging, _index_config(conf), **kwargs)
+    with _locked(qc_dir):
+        os.replace(str(staging / conf['index_filename']), str(qc_dir / conf['index_filename']))
+    shutil.rmtree(str(staging))
+
+
+def write_page_index(qc_dir, conf, pages):
+    """Write the index from pages, which maps the file name of each page to
+    its entities, as a table of links with a column per page key. Unlike
+    write_index, no files are read"""
+    keys = [key for key in conf['page_keys'] if any(key in entities for entities in pages.values())]
+
+    def cell(value):
+        return f'<td>{html.escape(value)}</td>'
+
+    rows = []
+    for page, entities in sorted(pages.items(), key=lambda item: item[0]):
+        rows.append('<tr>' + ''.join(cell(entities.get(key, '')) for key in keys) +
+                    f'<td><a href="{html.escape(page)}">{html.escape(page)}</a></td></tr>')
+    header = '<tr>' + ''.join(f'<th>{html.escape(key)}</th>' for key in keys) + '<th>page</th></tr>'
+    tmpname = Path(qc_dir) / f'{conf["index_filename"]}.tmp'
+    with open(tmpname, 'w') as f:
+        f.write('<!DOCTYPE html>\n<html>\n<head><meta charset="utf-8"><title>QC</title></head>\n'
+                '<body>\n<table>\n' + '\n'.join([header] + rows) + '\n</table>\n</body>\n</html>\n')
+    with _locked(qc_dir):
+        os.replace(str(tmpname), str(Path(qc_dir) / conf['index_filename']))
+
+
+def current_pages(output_folder, conf):
+    """Map the file name of each page to its entities and the fingerprints
+    of its files"""
+    pages = {}
+    for key, files in find_page_files(output_folder, conf['page_keys']).items():
+        entities = {k: v for k, v in zip(conf['page_keys'], key) if v is not None}
+        pages[page_filename(conf['page_filename_template'], entities)] = {
+            'entities': entities, 'files': files}
+    return pages
+
+
+def _move(src, dest):
+    """Move src to dest. Directories are merged, since other subjects' files
+    may be in the same directory of dest"""
+    if src.is_dir() and not src.is_symlink() and dest.is_dir():
+        for entry in src.iterdir():
+            _move(entry, dest / entry.name)
+        src.rmdir()
+        return
+    if dest.is_dir() and not dest.is_symlink():
+        shutil.rmtree(str(dest))
+    os.replace(str(src), str(dest))
+
+
+def _qc_subjects(output_folder, qc_dir, conf, subjects, staging, keep_index=False, **kwargs):
+    """Run qc_all for subjects only. qc_all writes its own index, which would
+    only list these subjects' pages, so run it in a staging directory and
+    move the pages across. The index is also moved if keep_index, i.e. if
+    subjects are every subject. The pages are moved while holding the lock
+    of qc_dir, since shards may finish at the same time"""
+    from PipelineQC.main import qc_all
+    if staging.exists():
+        shutil.rmtree(str(staging))
+    qc_all([output_folder], staging, _restrict_config(conf, subjects), **kwargs)
+    with _locked(qc_dir):
+        for entry in staging.iterdir():
+            if entry.name == conf['index_filename'] and not keep_index:
+                continue
+            _move(entry, qc_dir / entry.name)
+    shutil.rmtree(str(staging))
+
+
+def incremental_qc(output_folder, qc_dir, conf, **kwargs):
+    """Run PipelineQC's qc_all only for subjects with a page whose input files
+    are new or have changed since the last call, and rebuild the index
+    (see write_index).
+
+    The files contributing to each page are recorded in qc_dir/qc_manifest.json.
+    If it is missing, or was created with a different configuration, every
+    page is rebuilt. kwargs are passed to qc_all.
+    """
+    qc_dir = Path(qc_dir)
+    qc_dir.mkdir(exist_ok=True)
+    manifest_file = qc_dir / MANIFEST
+    settings = {'version': MANIFEST_VERSION, 'conf': conf}
+    previous = {}
+    if manifest_file.exists():
+        with open(manifest_file, 'r') as f:
+            stored = json.load(f)
+        if stored['settings'] == settings:
+            previous = stored['pages']
+        else:
+            logger.info(f'{manifest_file} was created with a different configuration. '
+                        'Rebuilding all QC pages')
+    current = current_pages(output_folder, conf)
+    stale = [page for page, info in current.items()
+             if previous.get(page) != info or not (qc_dir / page).exists()]
+    from .interfaces import _remove
+    for page in set(previous) - set(current):
+        _remove(qc_dir / page)
+    subjects = {current[page]['entities']['subject'] for page in stale}
+    logger.info(f'Rebuilding {len(stale)} of {len(current)} QC pages '
+                f'({len(subjects)} subjects)')
+    # if every subject is rebuilt, the index of qc_all is complete
+    complete = subjects == {info['entities']['subject'] for info in current.values()}
+    if subjects:
+        _qc_subjects(output_folder, qc_dir, conf, subjects, qc_dir / '.incremental',
+                     keep_index=complete, **kwargs)
+    if not subjects or not complete:
+        write_index(output_folder, qc_dir, conf, **kwargs)
+    tmpname = f'{manifest_file}.tmp'
+    with open(tmpname, 'w') as f:
+        json.dump({'settings': settings, 'pages': current}, f)
+    os.replace(tmpname, str(manifest_file))
+    return stale
+
+
+def parse_shard(value):
+    """Parse INDEX/COUNT, where 0 <= INDEX < COUNT"""
+    index, sep, count = value.partition('/')
+    try:
+        index, count = int(index), int(count)
+    except ValueError:
+        raise ValueError(f'Invalid shard {value}. Expected INDEX/COUNT') from None
+    if not sep or count < 1 or not 0 <= index < count:
+        raise ValueError(f'Invalid shard {value}. Expected INDEX/COUNT with 0 <= INDEX < COUNT')
+    return index, count
+
+
+def in_shard(subject, shard):
+    """Pages are assigned to shards by subject, so that each shard can
+    filter the files passed to qc_all by subject. crc32 is used because it is
+    stable across processes, unlike hash"""
+    index, count = shard
+    return zlib.crc32(subject.encode()) % count == index
+
+
+def _shard_name(shard):
+    return 'shard-{}-of-{}'.format(*shard)
+
+
+def _shard_manifests(qc_dir):
+    """The file name and contents of each shard manifest"""
+    manifests = []
+    for manifest_file in sorted((Path(qc_dir) / SHARD_DIR).glob('shard-*.json')):
+        with open(manifest_file, 'r') as f:
+            manifests.append((manifest_file, json.load(f)))
+    return manifests
+
+
+def clear_shard_manifests(qc_dir, count):
+    """Remove the manifests of shards of a different count, which were left
+    by an earlier sharding of the pages"""
+    with _locked(qc_dir):
+        for manifest_file, manifest in _shard_manifests(qc_dir):
+            if manifest['shard'][1] != count:
+                logger.info(f'Removing {manifest_file}, created with {manifest["shard"][1]} shards')
+                os.remove(str(manifest_file))
+
+
+def write_shard_manifest(qc_dir, shard, pages):
+    """Record the pages of shard, a dictionary mapping the file name of each
+    page to its entities"""
+    shard_dir = Path(qc_dir) / SHARD_DIR
+    shard_dir.mkdir(exist_ok=True)
+    manifest_file = shard_dir / f'{_shard_name(shard)}.json'
+    tmpname = f'{manifest_file}.tmp'
+    with open(tmpname, 'w') as f:
+        json.dump({'shard': list(shard), 'pages': pages}, f)
+    with _locked(qc_dir):
+        os.replace(tmpname, str(manifest_file))
+
+
+def sharded_qc(output_folder, qc_dir, conf, shard, **kwargs):
+    """Run PipelineQC's qc_all for the pages in shard (INDEX, COUNT), and
+    record them in qc_dir/shards. The index is created by merge_shards once
+    every shard has finished. The manifests of shards of a different COUNT
+    are removed first. kwargs are passed to qc_all."""
+    qc_dir = Path(qc_dir)
+    qc_dir.mkdir(exist_ok=True)
+    clear_shard_manifests(qc_dir, shard[1])
+    pages = {page: info for page, info in current_pages(output_folder, conf).items()
+             if in_shard(info['entities']['subject'], shard)}
+    subjects = {info['entities']['subject'] for info in pages.values()}
+    logger.info(f'Creating {len(pages)} QC pages ({len(subjects)} subjects) in {_shard_name(shard)}')
+    if subjects:
+        _qc_subjects(output_folder, qc_dir, conf, subjects,
+                     qc_dir / f'.{_shard_name(shard)}', **kwargs)
+    write_shard_manifest(qc_dir, shard, {page: info['entities'] for page, info in pages.items()})
+    return sorted(pages)
+
+
+def merge_shards(qc_dir, conf):
+    """Check that the manifest of every shard exists, and create the index
+    from the pages they record (see write_page_index)"""
+    qc_dir = Path(qc_dir)
+    pages = {}
+    found = set()
+    counts = set()
+    for _, manifest in _shard_manifests(qc_dir):
+        index, count = manifest['shard']
+        found.add(index)
+        counts.add(count)
+        pages.update(manifest['pages'])
+    # shards of another count are only left if shards of two counts were run at once
+    if len(counts) != 1:
+        raise RuntimeError(f'Expected shard manifests with a single shard count in {qc_dir / SHARD_DIR}, '
+                           f'found {sorted(counts)}')
+    count = counts.pop()
+    missing = sorted(set(range(count)) - found)
+    if missing:
+        raise RuntimeError(f'Missing shard manifests for shards {missing} of {count}')
+    write_page_index(qc_dir, conf, pages)
+    return sorted(pages)
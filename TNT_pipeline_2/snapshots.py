@@ -0,0 +1,182 @@
+import copy
+from pathlib import Path
+
+import numpy as np
+
+
+# reportlet types which only depend on images, and can therefore be
+# rendered at the participant level
+IMAGE_REPORTLETS = {'compare': ['image1', 'image2'],
+                    'contour': ['image'],
+                    'overlay': ['image']}
+LABEL_KEY = 'labelimage'
+# relative positions of the slices shown along each axis
+SLICE_POSITIONS = (0.3, 0.45, 0.6)
+# size of each slice in inches
+PANEL_SIZE = 3
+# the full resolution images have at least one pixel per voxel
+MIN_DPI = 100
+# resolution of the low resolution previews, which are shown on the pages
+PREVIEW_DPI = 30
+# suffix of the output names and descs of the previews
+PREVIEW = 'preview'
+# the PipelineQC reportlet showing a pre-rendered image, linked to another
+SNAPSHOT_REPORTLET = 'image'
+
+
+def image_reportlets(reportlets):
+    """Return (index, reportlet) for each reportlet in a QC configuration
+    that can be rendered from images alone"""
+    return [(i, r) for i, r in enumerate(reportlets) if r['type'] in IMAGE_REPORTLETS]
+
+
+def reportlet_inputs(reportlets):
+    """The names of the files needed to render reportlets"""
+    names = set()
+    for _, reportlet in image_reportlets(reportlets):
+        for key in IMAGE_REPORTLETS[reportlet['type']] + [LABEL_KEY]:
+            if key in reportlet:
+                names.add(reportlet[key])
+    return sorted(names)
+
+
+def snapshot_outputinfo(reportlets):
+    """The BIDS entities of each snapshot of reportlets, by output name, in
+    the order returned by render_reportlets. A compare reportlet has a
+    snapshot of each of its images, and each snapshot is a full resolution
+    image followed by its preview"""
+    outputinfo = {}
+    for i, reportlet in image_reportlets(reportlets):
+        for key in IMAGE_REPORTLETS[reportlet['type']]:
+            for suffix in ['', PREVIEW]:
+                outputinfo[f'snapshot{i:02d}{key}{suffix}'] = {
+                    'desc': f'qc{i:02d}{key}{suffix}',
+                    'suffix': 'T1w',
+                    'extension': 'png'
+                }
+    return outputinfo
+
+
+def snapshot_config(conf):
+    """Return a copy of the QC configuration conf in which each image
+    reportlet is replaced by reportlets showing the previews of its
+    snapshots (rendered at the participant level with --qc_snapshots),
+    linked to the full resolution images, so PipelineQC does not read any
+    images and the pages stay small"""
+    conf = copy.deepcopy(conf)
+    reportlets = []
+    for i, reportlet in enumerate(conf['reportlets']):
+        if reportlet['type'] not in IMAGE_REPORTLETS:
+            reportlets.append(reportlet)
+            continue
+        if reportlet['type'] == 'compare':
+            names = [reportlet['name1'], reportlet['name2']]
+        else:
+            names = [reportlet['name']]
+        for key, name in zip(IMAGE_REPORTLETS[reportlet['type']], names):
+            reportlets.append({'type': SNAPSHOT_REPORTLET, 'name': name,
+                               'image': f'snapshot{i:02d}{key}{PREVIEW}',
+                               'link': f'snapshot{i:02d}{key}'})
+    for name, bidsinfo in snapshot_outputinfo(conf['reportlets']).items():
+        conf['files'][name] = {'pattern': 'bids', 'filter': bidsinfo}
+    conf['reportlets'] = reportlets
+    return conf
+
+
+def _load(fname):
+    import nibabel
+    img = nibabel.as_closest_canonical(nibabel.load(str(fname)))
+    data = np.asanyarray(img.dataobj)
+    if data.ndim > 3:
+        data = data.reshape(data.shape[:3])
+    return img.affine, data
+
+
+def slices(data):
+    """Yield the sagittal, coronal, and axial slices shown in a snapshot,
+    oriented for display, of an image in RAS+ orientation"""
+    for axis in range(3):
+        for pos in SLICE_POSITIONS:
+            ind = int(round(pos * (data.shape[axis] - 1)))
+            yield np.rot90(np.take(data, ind, axis=axis))
+
+
+def _window(data):
+    finite = data[np.isfinite(data)]
+    if finite.size == 0:
+        return 0.0, 1.0
+    vmin, vmax = np.percentile(finite, [1, 99])
+    if vmax <= vmin:
+        vmax = vmin + 1.0
+    return vmin, vmax
+
+
+def render(out_file, preview_file, data, labels=None, mode=None):
+    """Save a grid of slices of data to out_file at full resolution, and to
+    preview_file at PREVIEW_DPI. If labels is not None, draw the label
+    boundaries (mode 'contour') or label colors (mode 'overlay') on top"""
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib import pyplot as plt
+    vmin, vmax = _window(data)
+    nrows, ncols = 3, len(SLICE_POSITIONS)
+    fig, axes = plt.subplots(nrows, ncols, figsize=(PANEL_SIZE * ncols, PANEL_SIZE * nrows),
+                             facecolor='black')
+    labelslices = slices(labels) if labels is not None else None
+    for ax, sl in zip(axes.flat, slices(data)):
+        ax.imshow(sl, cmap='gray', vmin=vmin, vmax=vmax, interpolation='nearest')
+        if labelslices is not None:
+            lsl = next(labelslices)
+            if mode == 'contour':
+                for value in np.unique(lsl[lsl > 0]):
+                    ax.contour(lsl == value, levels=[0.5], colors=[_color(value)], linewidths=0.8)
+            elif mode == 'overlay':
+                ax.imshow(np.ma.masked_equal(lsl, 0), cmap='tab20', alpha=0.5,
+                          vmin=0, vmax=max(labels.max(), 1), interpolation='nearest')
+        ax.axis('off')
+    fig.subplots_adjust(left=0, right=1, bottom=0, top=1, wspace=0, hspace=0)
+    dpi = max(MIN_DPI, int(np.ceil(max(data.shape) / PANEL_SIZE)))
+    fig.savefig(str(out_file), facecolor='black', dpi=dpi)
+    fig.savefig(str(preview_file), facecolor='black', dpi=PREVIEW_DPI)
+    plt.close(fig)
+
+
+def _color(value):
+    from matplotlib import cm
+    return cm.tab10(int(value) % 10)
+
+
+def render_reportlets(reportlets, files, out_dir, affine_tolerance=1e-3):
+    """Render the image reportlets of a QC configuration into out_dir.
+
+    files maps the file names used by the reportlets to paths. Returns the
+    paths of the snapshots, in the order of snapshot_outputinfo.
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    outputinfo = snapshot_outputinfo(reportlets)
+    cache = {}
+
+    def load(name):
+        if name not in cache:
+            cache[name] = _load(files[name])
+        return cache[name]
+
+    out_files = []
+    for i, reportlet in image_reportlets(reportlets):
+        labels = None
+        if LABEL_KEY in reportlet:
+            labelaffine, labels = load(reportlet[LABEL_KEY])
+        for key in IMAGE_REPORTLETS[reportlet['type']]:
+            affine, data = load(reportlet[key])
+            if labels is not None and (labels.shape != data.shape or
+                                       not np.allclose(affine, labelaffine, atol=affine_tolerance)):
+                raise ValueError(f'{reportlet[key]} and {reportlet[LABEL_KEY]} '
+                                 'are not on the same grid')
+            out_file = out_dir / f'snapshot{i:02d}{key}.png'
+            preview_file = out_dir / f'snapshot{i:02d}{key}{PREVIEW}.png'
+            render(out_file, preview_file, data, labels=labels, mode=reportlet['type'])
+            out_files.extend([str(out_file), str(preview_file)])
+    if len(out_files) != len(outputinfo):
+        raise RuntimeError('Unexpected number of snapshots')
+    return out_files
@@ -0,0 +1,372 @@
+from contextlib import contextmanager, suppress
+from copy import deepcopy
+import fcntl
+import os
+from pathlib import Path
+import shutil
+import socket
+import uuid
+
+from nipype.interfaces.base import BaseInterface, DynamicTraitedSpec, isdefined
+
+from . import logger
+
+
+# the conversion workflows, whose nodes write files which are read once or
+# twice by the next node
+STAGED_WORKFLOWS = ['to_mnc', 'to_mnc_brain_mask', 'nuc_mnc_to_nii', 'inorm_mnc_to_nii', 'mnc2nii']
+# nodes of STAGED_WORKFLOWS whose outputs are staged (gzip is not, since its
+# outputs are exported)
+STAGED_NODES = ['gunzip', 'convert', 'fix_dircos', 'forceqform']
+# file in each staging directory naming the working directory of its node
+NODE_DIR_FILE = '.node_dir'
+# file in each staging directory with the number of bytes reserved for it
+RESERVED_FILE = '.reserved'
+# file in each run directory naming the host and process of the run
+OWNER_FILE = '.owner'
+
+
+@contextmanager
+def _locked(root):
+    with open(str(root / '.lock'), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _stage_usage(stage):
+    """The size of the files in stage, or the bytes reserved for it if more"""
+    actual = 0
+    for entry in os.scandir(str(stage)):
+        if not entry.name.startswith('.'):
+            try:
+                actual += entry.stat(follow_symlinks=False).st_size
+            except FileNotFoundError:
+                pass
+    try:
+        reserved = int((stage / RESERVED_FILE).read_text())
+    except (FileNotFoundError, ValueError):
+        reserved = 0
+    return max(actual, reserved)
+
+
+def _usage(root):
+    """The bytes used or reserved by the staging directories of every run in
+    root"""
+    total = 0
+    for run_dir in root.iterdir():
+        if run_dir.is_dir():
+            for stage in run_dir.iterdir():
+                if stage.is_dir():
+                    total += _stage_usage(stage)
+    return total
+
+
+def _uncompressed_size(path):
+    """The size of path, uncompressed if it is gzipped (from the size
+    recorded at its end, which is modulo 4 GiB)"""
+    size = os.path.getsize(path)
+    if path.endswith('.gz') and size >= 18:
+        with open(path, 'rb') as f:
+            f.seek(-4, os.SEEK_END)
+            return int.from_bytes(f.read(4), 'little')
+    return size
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _owner():
+    return f'{socket.gethostname()} {os.getpid()}'
+
+
+def _dead(owner_file):
+    """Whether the run whose owner (see _owner) starts owner_file is no
+    longer running on this host. Runs on other hosts are assumed to be
+    running"""
+    try:
+        host, pid = owner_file.read_text().split()[:2]
+        return host == socket.gethostname() and not _alive(int(pid))
+    except (FileNotFoundError, ValueError):
+        return False
+
+
+def _files(value):
+    if isinstance(value, (list, tuple)):
+        for v in value:
+            yield from _files(v)
+    elif isinstance(value, dict):
+        for v in value.values():
+            yield from _files(v)
+    elif isinstance(value, str) and os.path.isfile(value):
+        yield value
+
+
+def _relocate(value, moved):
+    if isinstance(value, (list, tuple)):
+        return [_relocate(v, moved) for v in value]
+    if isinstance(value, dict):
+        return {k: _relocate(v, moved) for k, v in value.items()}
+    if isinstance(value, str) and value in moved:
+        return moved[value]
+    return value
+
+
+def _spill(link):
+    """Replace the symbolic link link to a staged file by the file. The path
+    is valid throughout, so nodes reading it are unaffected"""
+    target = os.readlink(link)
+    tmp = f'{link}.spill'
+    shutil.copy2(target, tmp)
+    os.replace(tmp, link)
+    os.remove(target)
+
+
+def _release(node_dir, prefix):
+    """Spill every file linked from node_dir to a path starting with prefix.
+    A node whose staged file no longer exists (e.g. /dev/shm was cleared
+    after a crash) is invalidated by removing the link and its hash file,
+    so that nipype runs it again. Returns the number of files spilled"""
+    try:
+        entries = list(os.scandir(node_dir))
+    except FileNotFoundError:
+        return 0
+    count = 0
+    for entry in entries:
+        if entry.is_symlink() and os.readlink(entry.path).startswith(prefix):
+            if os.path.exists(entry.path):
+                _spill(entry.path)
+                count += 1
+            else:
+                logger.warning(f'Staged file {os.readlink(entry.path)} of {node_dir} is missing, '
+                               'so the node will be run again')
+                os.remove(entry.path)
+                for other in entries:
+                    if other.name.startswith('_0x') and other.name.endswith('.json'):
+                        with suppress(FileNotFoundError):
+                            os.remove(other.path)
+    return count
+
+
+def _close_run(run_dir):
+    """Spill the files of the staging directories of run_dir, and remove it.
+    Returns the number of files spilled"""
+    count = 0
+    for stage in run_dir.iterdir():
+        if not stage.is_dir():
+            continue
+        node_dir = stage / NODE_DIR_FILE
+        if node_dir.exists():
+            count += _release(node_dir.read_text(), str(run_dir) + os.sep)
+        shutil.rmtree(str(stage))
+    shutil.rmtree(str(run_dir))
+    return count
+
+
+class StagingTier(object):
+    """Place the output files of staged nodes (see stage_workflow) in a fast
+    directory (e.g. /dev/shm), within budget bytes for every run sharing
+    staging_dir. Before a node runs, the size of its outputs is estimated
+    from the (uncompressed) size of its input files and reserved. A node is
+    not staged if its estimate is larger than max_file_size or the
+    reservation does not fit in the budget. Once it has run, its files are
+    linked from the working directory of the node, so its results refer to
+    the working directory. Files which are larger than max_file_size, or do
+    not fit in the budget because the estimate was low, and other files are
+    moved to the working directory. Staged files are spilled (moved) there
+    once a node reading them has finished.
+
+    An instance is a nipype status callback, which spills the files, so it
+    must be passed as (or chained to) the status_callback plugin argument.
+    Unlike other callbacks, it is not a utils.StatusCallback, since the
+    staged nodes use it in the worker processes. The run directory is
+    created by start (or when used as a context manager) and the remaining
+    files are spilled by close.
+
+    The directories of runs which were killed are cleaned up (their files
+    spilled) by the next run using staging_dir on the same host. If
+    journal_dir is given, the working directories of nodes with staged
+    files are recorded there, and the next run with the same journal_dir
+    spills the files of killed runs, or, if they were lost (e.g. the host
+    was restarted), makes nipype run the nodes again.
+    """
+
+    def __init__(self, staging_dir, budget, max_file_size, journal_dir=None):
+        self.root = Path(staging_dir).resolve() / 'tnt_pipeline_2'
+        self.run_dir = self.root / uuid.uuid4().hex
+        self.budget = budget
+        self.max_file_size = max_file_size
+        self.journal = None
+        if journal_dir is not None:
+            self.journal = Path(journal_dir) / f'{self.run_dir.name}.txt'
+        # the process running the workflow, which outlives its workers
+        self.owner = _owner()
+
+    def start(self):
+        """Create the run directory and journal, after cleaning up after
+        killed runs"""
+        self.root.mkdir(parents=True, exist_ok=True)
+        with _locked(self.root):
+            for run_dir in self.root.iterdir():
+                if run_dir.is_dir() and _dead(run_dir / OWNER_FILE):
+                    count = _close_run(run_dir)
+                    logger.warning(f'Removed the staging directory {run_dir} of a killed run, '
+                                   f'spilling {count} files')
+            self.run_dir.mkdir(exist_ok=True)
+            (self.run_dir / OWNER_FILE).write_text(self.owner)
+        if self.journal is not None:
+            self.journal.parent.mkdir(parents=True, exist_ok=True)
+            for journal in self.journal.parent.glob('*.txt'):
+                if journal == self.journal or not _dead(journal):
+                    continue
+                header, *node_dirs = journal.read_text().splitlines()
+                prefix = header.split()[2] + os.sep
+                count = sum(_release(node_dir, prefix) for node_dir in set(node_dirs))
+                logger.warning(f'Repaired the staged files of a killed run ({journal}), '
+                               f'spilling {count} files')
+                journal.unlink()
+            self.journal.write_text(f'{self.owner} {self.run_dir}\n')
+        return self
+
+    def stage(self, estimate=0):
+        """A new staging directory with estimate bytes reserved, or None if
+        they do not fit"""
+        if not self.run_dir.exists():
+            self.start()
+        if estimate > self.max_file_size:
+            return None
+        with _locked(self.root):
+            if _usage(self.root) + estimate > self.budget:
+                return None
+            stage = self.run_dir / uuid.uuid4().hex
+            stage.mkdir()
+            (stage / RESERVED_FILE).write_text(str(estimate))
+        return stage
+
+    def keep(self, stage, node_dir, outputs):
+        """Move the files of stage to node_dir, except the output files which
+        fit in the budget, which are linked instead, and release the
+        reservation. Returns outputs with the paths in node_dir"""
+        (stage / NODE_DIR_FILE).write_text(str(node_dir))
+        moved = {}
+        files = set()
+        for f in _files(outputs):
+            if Path(f).parent == stage:
+                files.add(f)
+            elif str(stage) + os.sep in f:
+                moved[f] = os.path.join(node_dir, os.path.relpath(f, str(stage)))
+        linked = False
+        with _locked(self.root):
+            for path in stage.iterdir():
+                if not path.name.startswith('.') and str(path) not in files:
+                    shutil.move(str(path), os.path.join(node_dir, path.name))
+            (stage / RESERVED_FILE).unlink()
+            usage = _usage(self.root)
+            for path in sorted(files):
+                moved[path] = os.path.join(node_dir, os.path.basename(path))
+                size = os.path.getsize(path)
+                if size <= self.max_file_size and usage <= self.budget:
+                    os.symlink(path, moved[path])
+                    linked = True
+                else:
+                    shutil.move(path, moved[path])
+                    usage -= size
+        if linked and self.journal is not None:
+            with open(str(self.journal), 'a') as f:
+                f.write(f'{node_dir}\n')
+        return _relocate(outputs, moved)
+
+    def release(self, node_dir):
+        """Spill every staged file linked from node_dir. Returns the
+        number of files"""
+        return _release(node_dir, str(self.run_dir) + os.sep)
+
+    def __call__(self, node, status):
+        if status in ('end', 'exception'):
+            for resultfile, _ in getattr(node, 'input_source', {}).values():
+                self.release(os.path.dirname(resultfile))
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Spill the remaining files and remove the staging directories"""
+        if self.run_dir.exists():
+            with _locked(self.root):
+                count = _close_run(self.run_dir)
+            logger.debug(f'Spilled {count} staged files when closing {self.run_dir}')
+        if self.journal is not None and self.journal.exists():
+            self.journal.unlink()
+
+
+class StagedInterface(BaseInterface):
+    """Run interface in a directory of tier, keeping its output files there
+    (see StagingTier). The inputs (and therefore the hash of the node) and
+    outputs are those of interface"""
+    input_spec = DynamicTraitedSpec
+    output_spec = DynamicTraitedSpec
+
+    def __init__(self, interface, tier):
+        super(StagedInterface, self).__init__()
+        self.inputs = interface.inputs
+        self._interface = interface
+        self._tier = tier
+        self._results = {}
+
+    def _get_filecopy_info(self):
+        return type(self._interface)._get_filecopy_info()
+
+    def _check_mandatory_inputs(self):
+        self._interface._check_mandatory_inputs()
+
+    def _check_version_requirements(self, trait_object, permissive=False):
+        return []
+
+    def _outputs(self):
+        return deepcopy(self._interface._outputs())
+
+    def _run_interface(self, runtime):
+        estimate = sum(_uncompressed_size(f) for f in set(_files(self.inputs.get())))
+        stage = self._tier.stage(estimate)
+        try:
+            result = self._interface.run(cwd=runtime.cwd if stage is None else str(stage))
+        except Exception:
+            # keep any logs of the failure with the node
+            if stage is not None:
+                self._tier.keep(stage, runtime.cwd, {})
+            raise
+        outputs = {name: value for name, value in result.outputs.get().items() if isdefined(value)}
+        if stage is not None:
+            outputs = self._tier.keep(stage, runtime.cwd, outputs)
+        self._results = outputs
+        return runtime
+
+    def _list_outputs(self):
+        return self._results
+
+
+def stage_workflow(wf, tier, workflows=STAGED_WORKFLOWS, names=STAGED_NODES):
+    """Stage the outputs of every node of wf named one of names in a
+    workflow named one of workflows in tier. Returns the number of nodes
+    staged"""
+    count = 0
+    for name in wf.list_node_names():
+        node = wf.get_node(name)
+        parts = name.split('.')
+        if (len(parts) > 1 and parts[-2] in workflows and node.name in names and
+                not isinstance(node.interface, StagedInterface)):
+            node._interface = StagedInterface(node.interface, tier)
+            count += 1
+    return count
@@ -0,0 +1,192 @@
+import csv
+import os
+
+import numpy as np
+
+from .combine import MISSING
+
+
+# scale factor making the median absolute deviation a consistent
+# estimator of the standard deviation for normally distributed data
+MAD_SCALE = 1.4826
+# likewise for the mean absolute deviation
+MEANAD_SCALE = 1.2533
+
+
+def load_tsv(fname, id_columns):
+    """Load a group table, returning the id columns, the names of the
+    numeric columns, the ids of each row, and a (rows x columns) array"""
+    with open(fname, 'r', newline='') as f:
+        reader = csv.reader(f, delimiter='\t')
+        header = next(reader)
+        rows = list(reader)
+    idinds = [i for i, col in enumerate(header) if col in id_columns]
+    valinds = [i for i, col in enumerate(header) if col not in id_columns]
+    ids = [tuple(row[i] for i in idinds) for row in rows]
+    values = np.array([[row[i] for i in valinds] for row in rows], dtype=str)
+    return ([header[i] for i in idinds],
+            [header[i] for i in valinds],
+            ids,
+            _to_float(values.reshape(len(rows), len(valinds))))
+
+
+def _first_codes(codes):
+    """Number the distinct rows of codes (a rows x columns integer array) in
+    order of first appearance. Returns the number of each row and the index
+    of the first appearance of each number"""
+    if codes.shape[1] == 0:
+        return np.zeros(len(codes), dtype=np.intp), np.zeros(min(len(codes), 1), dtype=np.intp)
+    dims = codes.max(axis=0) + 1
+    if np.prod(dims.astype(float)) < 2 ** 62:
+        # a single integer per row is much faster to sort
+        codes = np.ravel_multi_index(codes.T, dims)
+        _, first, inverse = np.unique(codes, return_index=True, return_inverse=True)
+    else:
+        _, first, inverse = np.unique(codes, axis=0, return_index=True, return_inverse=True)
+    order = np.argsort(first)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    return rank[inverse.ravel()], first[order]
+
+
+def _encode(table, columns):
+    """Dictionary encode the string columns of table, with nulls as
+    MISSING. Returns a (rows x columns) array of indices and the
+    dictionary of each column"""
+    indices = np.zeros((table.num_rows, len(columns)), dtype=np.int64)
+    dictionaries = []
+    for j, col in enumerate(columns):
+        encoded = table.column(col).combine_chunks().fill_null(MISSING).dictionary_encode()
+        indices[:, j] = encoded.indices.to_numpy(zero_copy_only=False)
+        dictionaries.append(encoded.dictionary.to_pylist())
+    return indices, dictionaries
+
+
+def load_parquet(fname, id_columns=None):
+    """Load a long-format table created by CombineStatsTables, with one
+    column per desc, label name, and statistic. Every string column except
+    desc and name identifies a scan, so id_columns is not used. Rows and
+    columns are in order of first appearance"""
+    from .interfaces import _import_pyarrow
+    pa, pq = _import_pyarrow()
+    table = pq.read_table(fname)
+    idcols = [field.name for field in table.schema
+              if field.type == pa.string() and field.name not in ('desc', 'name')]
+    statcols = [field.name for field in table.schema
+                if pa.types.is_floating(field.type)]
+    if table.num_rows == 0:
+        return idcols, [], [], np.full((0, 0), np.nan)
+    idcodes, iddicts = _encode(table, idcols)
+    rows, firstrows = _first_codes(idcodes)
+    labelcodes, labeldicts = _encode(table, ['desc', 'name'])
+    labels, firstlabels = _first_codes(labelcodes)
+    values = np.full((len(firstrows), len(firstlabels) * len(statcols)), np.nan)
+    for j, stat in enumerate(statcols):
+        values[rows, labels * len(statcols) + j] = table.column(stat).to_numpy()
+    ids = [tuple(d[i] for d, i in zip(iddicts, codes)) for codes in idcodes[firstrows]]
+    columns = ['_'.join([labeldicts[0][desc], labeldicts[1][name], stat])
+               for desc, name in labelcodes[firstlabels] for stat in statcols]
+    return idcols, columns, ids, values
+
+
+def _to_float(values):
+    values = np.where(np.isin(values, [MISSING, '']), 'nan', values)
+    try:
+        return values.astype(float)
+    except ValueError:
+        out = np.full(values.shape, np.nan)
+        for j in range(values.shape[1]):
+            try:
+                out[:, j] = values[:, j].astype(float)
+            except ValueError:
+                pass
+        return out
+
+
+def robust_zscores(values):
+    """Column-wise robust z-scores, (x - median) / (1.4826 * MAD). If the MAD
+    of a column is zero, the mean absolute deviation is used instead. NaNs
+    are ignored, and constant columns have z-scores of zero"""
+    with np.errstate(invalid='ignore', divide='ignore'):
+        median = _nanreduce(np.nanmedian, values)
+        absdev = np.abs(values - median)
+        scale = MAD_SCALE * _nanreduce(np.nanmedian, absdev)
+        meanad = MEANAD_SCALE * _nanreduce(np.nanmean, absdev)
+        scale = np.where(scale > 0, scale, meanad)
+        z = (values - median) / scale
+        z[:, ~(scale > 0)] = 0.0
+        z[np.isnan(values)] = np.nan
+    return median, scale, z
+
+
+def _nanreduce(func, values):
+    # avoid the "All-NaN slice" warnings for empty columns
+    out = np.full(values.shape[1], np.nan)
+    valid = ~np.all(np.isnan(values), axis=0)
+    if np.any(valid):
+        out[valid] = func(values[:, valid], axis=0)
+    return out
+
+
+def summarize(values):
+    """Return per-column summary statistics and per-row outlier z-scores"""
+    with np.errstate(invalid='ignore'):
+        summary = {
+            'n': np.sum(~np.isnan(values), axis=0),
+            'mean': _nanreduce(np.nanmean, values),
+            'sd': _nanreduce(lambda x, axis: np.nanstd(x, axis=axis, ddof=1), values),
+            'min': _nanreduce(np.nanmin, values),
+            'max': _nanreduce(np.nanmax, values),
+        }
+    median, scale, z = robust_zscores(values)
+    summary['median'] = median
+    summary['robust_sd'] = scale
+    return summary, z
+
+
+def write_summary(in_file, summary_file, outliers_file, id_columns,
+                  threshold=3.5, loader=load_tsv):
+    """Write a table of per-column summary statistics and a table of per-scan
+    outlier scores, sorted from most to least unusual.
+
+    The outlier score of a scan is the largest absolute robust z-score
+    across all of its stats. n_outliers is the number of stats with an
+    absolute robust z-score greater than threshold.
+    """
+    idcols, columns, ids, values = loader(in_file, id_columns)
+    summary, z = summarize(values)
+    _write(summary_file,
+           ['column'] + list(summary.keys()),
+           ([col] + [_fmt(summary[k][j]) for k in summary] for j, col in enumerate(columns)))
+    absz = np.abs(z)
+    valid = ~np.all(np.isnan(absz), axis=1)
+    score = np.full(len(ids), np.nan)
+    worst = np.full(len(ids), -1)
+    if np.any(valid):
+        score[valid] = np.nanmax(absz[valid], axis=1)
+        worst[valid] = np.nanargmax(absz[valid], axis=1)
+    with np.errstate(invalid='ignore'):
+        noutliers = np.sum(absz > threshold, axis=1)
+    order = np.argsort(np.where(np.isnan(score), np.inf, -score), kind='stable')
+    _write(outliers_file,
+           idcols + ['outlier_score', 'n_outliers', 'worst_column', 'worst_zscore'],
+           (list(ids[i]) + [_fmt(score[i]),
+                            str(noutliers[i]),
+                            columns[worst[i]] if worst[i] >= 0 else MISSING,
+                            _fmt(z[i, worst[i]]) if worst[i] >= 0 else MISSING]
+            for i in order))
+
+
+def _fmt(value):
+    if np.isnan(value):
+        return MISSING
+    return f'{value:.6g}'
+
+
+def _write(fname, header, rows):
+    tmpname = f'{fname}.tmp'
+    with open(tmpname, 'w', newline='') as f:
+        writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+        writer.writerow(header)
+        writer.writerows(rows)
+    os.replace(tmpname, fname)
@@ -0,0 +1,195 @@
+import json
+import os
+import socket
+import threading
+import time
+
+from . import logger
+from .utils import StatusCallback
+
+
+RESOURCES_PID = 0
+
+
+def subject_workflow(name):
+    """The T1_* workflow of the node name, e.g. participant.T1_sub-1.main.bet
+    gives T1_sub-1. Nodes outside a T1 workflow are grouped by their top
+    level workflow"""
+    parts = name.split('.')
+    for part in parts:
+        if part.startswith('T1_'):
+            return part
+    return parts[0]
+
+
+class _Lanes(object):
+    """Assign each running node the lowest free lane, so nodes that overlap
+    are drawn on different rows"""
+
+    def __init__(self):
+        self.used = set()
+
+    def acquire(self):
+        lane = 0
+        while lane in self.used:
+            lane += 1
+        self.used.add(lane)
+        return lane
+
+    def release(self, lane):
+        self.used.discard(lane)
+
+
+class TraceRecorder(StatusCallback):
+    """Record the start and end of each node as a Chrome trace, which can be
+    opened in Perfetto (https://ui.perfetto.dev) or chrome://tracing.
+
+    Each T1_* workflow is shown as a process, with overlapping nodes on
+    separate rows. Each node records the host, its slot (a row of the host
+    which is free when it starts, so at most the peak number of running nodes
+    are used), and the processors and memory it reserves. A separate
+    "resources" process has counters of the reserved processors and memory,
+    and of the idle processors if n_procs is known.
+
+    An instance is a nipype status callback, so it can be passed as the
+    status_callback plugin argument. The trace is written to out_file by
+    write (or when used as a context manager).
+    """
+
+    def __init__(self, out_file, n_procs=None, memory_gb=None):
+        self.out_file = out_file
+        self.n_procs = n_procs
+        self.memory_gb = memory_gb
+        self.host = socket.gethostname()
+        self.t0 = None
+        self.events = []
+        self._pids = {}
+        self._lanes = {}
+        self._slots = _Lanes()
+        self._running = {}
+        self._reserved = [0, 0.0]
+        self._lock = threading.Lock()
+
+    def __call__(self, node, status):
+        name = node.fullname
+        if status == 'start':
+            self.start(name, n_procs=getattr(node, 'n_procs', 1),
+                       mem_gb=getattr(node, 'mem_gb', 0.0))
+        elif status in ('end', 'exception'):
+            self.end(name, status=status)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.write()
+
+    def _ts(self, t):
+        if self.t0 is None:
+            self.t0 = t
+        return (t - self.t0) * 1e6
+
+    def _pid(self, name):
+        group = subject_workflow(name)
+        if group not in self._pids:
+            pid = len(self._pids) + 1
+            self._pids[group] = pid
+            self._lanes[pid] = _Lanes()
+            self.events.append({'name': 'process_name', 'ph': 'M', 'pid': pid,
+                                'args': {'name': group}})
+        return self._pids[group]
+
+    def _counters(self, ts):
+        cpus, mem = self._reserved
+        counters = [('reserved_processors', {'processors': cpus}),
+                    ('reserved_memory_GB', {'memory_GB': mem}),
+                    ('running_nodes', {'nodes': len(self._running)})]
+        if self.n_procs is not None:
+            counters.append(('idle_processors', {'processors': max(self.n_procs - cpus, 0)}))
+        for name, args in counters:
+            self.events.append({'name': name, 'ph': 'C', 'ts': ts,
+                                'pid': RESOURCES_PID, 'args': args})
+
+    def start(self, name, n_procs=1, mem_gb=0.0, t=None):
+        """Record the start of node name at t (default now)"""
+        t = time.time() if t is None else t
+        with self._lock:
+            ts = self._ts(t)
+            if name in self._running:
+                logger.warning(f'Trace: {name} started twice')
+                return
+            pid = self._pid(name)
+            self._running[name] = {'ts': ts, 'pid': pid, 'tid': self._lanes[pid].acquire(),
+                                   'slot': self._slots.acquire(), 'n_procs': n_procs,
+                                   'mem_gb': mem_gb}
+            self._reserved[0] += n_procs
+            self._reserved[1] += mem_gb
+            self._counters(ts)
+
+    def end(self, name, status='end', t=None):
+        """Record the end of node name at t (default now). status is "end"
+        or "exception" """
+        t = time.time() if t is None else t
+        with self._lock:
+            ts = self._ts(t)
+            if name not in self._running:
+                logger.warning(f'Trace: {name} ended but was not started')
+                return
+            node = self._running.pop(name)
+            self._lanes[node['pid']].release(node['tid'])
+            self._slots.release(node['slot'])
+            self._reserved[0] -= node['n_procs']
+            self._reserved[1] -= node['mem_gb']
+            self.events.append({'name': name.split('.', 1)[-1], 'cat': status, 'ph': 'X',
+                                'ts': node['ts'], 'dur': ts - node['ts'],
+                                'pid': node['pid'], 'tid': node['tid'],
+                                'args': {'node': name, 'host': self.host, 'slot': node['slot'],
+                                         'n_procs': node['n_procs'], 'mem_gb': node['mem_gb'],
+                                         'status': status}})
+            self._counters(ts)
+
+    def to_dict(self):
+        with self._lock:
+            events = [{'name': 'process_name', 'ph': 'M', 'pid': RESOURCES_PID,
+                       'args': {'name': f'resources ({self.host})'}}] + self.events
+            # nodes which had not finished
+            for name, node in self._running.items():
+                events.append({'name': name.split('.', 1)[-1], 'cat': 'running', 'ph': 'B',
+                               'ts': node['ts'], 'pid': node['pid'], 'tid': node['tid'],
+                               'args': {'node': name}})
+            return {'traceEvents': events,
+                    'displayTimeUnit': 'ms',
+                    'otherData': {'host': self.host, 'start_time': self.t0,
+                                  'n_procs': self.n_procs, 'memory_gb': self.memory_gb}}
+
+    def write(self):
+        """Write the trace to out_file"""
+        tmpname = f'{self.out_file}.tmp'
+        with open(tmpname, 'w') as f:
+            json.dump(self.to_dict(), f)
+        os.replace(tmpname, str(self.out_file))
+        logger.info(f'Wrote trace to {self.out_file}')
+
+
+def trace_from_resources(resources, out_file, n_procs=None, memory_gb=None):
+    """Rebuild a trace from the output of utils.load_resources_file for a
+    profiling run. The start and end of each node are its first and last
+    samples, and, since reservations are not recorded, the processors and
+    memory of a node are its measured maximums"""
+    recorder = TraceRecorder(out_file, n_procs=n_procs, memory_gb=memory_gb)
+    events = []
+    for name, data in resources.items():
+        if data.get('start') is None:
+            raise ValueError('The start and end of nodes were not recorded')
+        cpumax = data['cpumax'] or 0.0
+        events.append((data['start'], 1, name, max(-(-cpumax // 100), 1), data['mem']))
+        # at equal times nodes end before others start, so lanes are reused,
+        # unless the node has a single sample
+        events.append((data['end'], 2 if data['end'] == data['start'] else 0, name, None, None))
+    for t, order, name, n_procs, mem_gb in sorted(events, key=lambda e: e[:2]):
+        if order != 1:
+            recorder.end(name, t=t)
+        else:
+            recorder.start(name, n_procs=int(n_procs), mem_gb=mem_gb, t=t)
+    recorder.write()
+    return recorder
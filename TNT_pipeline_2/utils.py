@@ -1,9 +1,12 @@
+import abc
 import errno
 import io
+from itertools import chain, groupby
 from pathlib import Path
-from pndniworkflows import utils
 import json
 import numpy as np
+import re
+import warnings
 
 
 class Labels(object):
@@ -31,6 +34,7 @@ class Labels(object):
         if filename is None:
             filename = cls._get_label_file(getattr(args, base_arg),
                                            f'--{label_arg}')
+        from pndniworkflows import utils
         labels = utils.read_labels(filename)
         return cls.from_labels(labels)
 
@@ -55,6 +59,7 @@ class Labels(object):
     @staticmethod
     def _labels_to_str(labels):
         s = io.StringIO(newline='')
+        from pndniworkflows import utils
         utils.write_labels(s, labels)
         s.seek(0)
         return s.read()
@@ -80,65 +85,451 @@ def write_json(obj, fname):
         json.dump(obj, f, indent=4)
 
 
-def load_resources_file(fname):
-    resources = read_json(fname)
-    keys = ['rss_GiB', 'vms_GiB', 'cpus', 'time']
-    length = len(resources['name'])
-    for k in keys:
-        if len(resources[k]) != length:
-            raise RuntimeError(f'Length of "{k}" in {fname} does not match length of "name"')
-    out = {}
-    for i in range(length):
-        name = resources['name'][i]
-        if name not in out:
-            out[name] = {}
-        for k in keys:
-            if k not in out[name]:
-                out[name][k] = []
-            out[name][k].append(float(resources[k][i]))
-    return out
-
-
-def calc_opt_resources(resources, mintime=1.0, mininterval=0.1):
-    out = {}
-    for name, data in resources.items():
-        out[name] = {}
-        deltatimes = np.diff(data['time'])
-        cpus = np.array(data['cpus'][1:])
-        inds = deltatimes > mininterval
-        if np.any(inds):
-            cpumax = np.max(cpus[inds])
-        else:
-            cpumax = None
-        totaltime = data['time'][-1] - data['time'][0]
-        if totaltime < mintime or cpumax is None:
-            ncpu = 1
-        else:
-            ncpu = max(int(np.ceil(cpumax / 100.0)), 1)
-        out[name]['ncpu'] = ncpu
-        out[name]['cpumax'] = cpumax
-        out[name]['mem'] = np.max(data['rss_GiB'])
-        out[name]['time'] = totaltime
-    out2 = {}
-    for name, data in out.items():
-        nameadj = adjust_node_name(name)
-        if nameadj not in out2:
-            out2[nameadj] = data
+RESOURCE_KEYS = ['rss_GiB', 'vms_GiB', 'cpus', 'time']
+
+
+class _JSONStream(object):
+    """Parse JSON values one at a time from a file with
+    json.JSONDecoder.raw_decode, holding at most one chunk (plus one value)
+    in memory"""
+    WHITESPACE = re.compile(r'\s*')
+    # characters which may continue a number
+    NUMBER = re.compile(r'[0-9.eE+-]*')
+    # numbers and the separators between them
+    NUMBERS = re.compile(r'[\s0-9.eE+,-]*')
+
+    def __init__(self, f, chunk_size=1 << 20):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.fills = 0
+        # characters before buf
+        self.offset = 0
+        self.decode = json.JSONDecoder().raw_decode
+
+    def _fill(self):
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.offset += self.pos
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        self.fills += 1
+        return True
+
+    def _error(self, msg):
+        return ValueError(f'{msg} at "{self.buf[self.pos:self.pos + 20]}"')
+
+    def peek(self):
+        while True:
+            if self.pos < len(self.buf) and not self.buf[self.pos].isspace():
+                return self.buf[self.pos]
+            self.pos = self.WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise self._error(f'Expected "{char}"')
+        self.pos += 1
+
+    def value(self):
+        """Decode the next value, reading chunks until it is complete"""
+        while True:
+            self.peek()
+            try:
+                value, end = self.decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if self._fill():
+                    continue
+                raise self._error('Invalid JSON') from None
+            # a value ending the buffer may continue in the next chunk
+            if self.NUMBER.fullmatch(self.buf, end) and self._fill():
+                continue
+            self.pos = end
+            return value
+
+    def array(self):
+        """Yield the elements of an array in lists, one for each chunk
+        read"""
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        values = []
+        fills = self.fills
+        while True:
+            values.append(self.value())
+            char = self.peek()
+            if char not in (',', ']'):
+                raise self._error('Expected "," or "]"')
+            self.pos += 1
+            if char == ']':
+                yield values
+                return
+            if self.fills != fills:
+                yield values
+                values = []
+                fills = self.fills
+
+    def count_array(self):
+        """Skip an array, returning its number of elements. Runs of numbers
+        are skipped without decoding them, so they are not validated"""
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return 0
+        n = 1
+        while True:
+            end = self.NUMBERS.match(self.buf, self.pos).end()
+            n += self.buf.count(',', self.pos, end)
+            self.pos = end
+            if self.pos == len(self.buf):
+                if not self._fill():
+                    raise self._error('Expected "]"')
+                continue
+            if self.buf[self.pos] != ']':
+                self.value()
+                continue
+            self.pos += 1
+            return n
+
+
+def _iter_columns(stream):
+    """Yield (key, elements) for every array in a JSON object of arrays,
+    where elements is a generator of lists of elements. Each generator must
+    be exhausted (or the array skipped with stream.count_array) before the
+    next"""
+    stream.expect('{')
+    if stream.peek() == '}':
+        return
+    while True:
+        key = stream.value()
+        stream.expect(':')
+        yield key, stream.array()
+        if stream.peek() == ',':
+            stream.pos += 1
         else:
-            for k in data.keys():
-                if data[k] is not None:
-                    if out2[nameadj][k] is None or data[k] > out2[nameadj][k]:
-                        out2[nameadj][k] = data[k]
-    return out2
+            stream.expect('}')
+            return
+
+
+class ResourceStats(object):
+    """Running statistics of the profiling samples of each node, stored in
+    numpy arrays with one element per node.
+
+    Samples of a node must be added in chronological order. cpumax only
+    includes samples taken more than mininterval seconds after the previous
+    sample of the same node, since the CPU usage of shorter intervals is
+    unreliable. Bytes read and written are summed, if they are recorded.
+    """
+    FIELDS = ['n', 'tstart', 'tend', 'tlast', 'cpumax', 'rssmax', 'read', 'write']
+
+    def __init__(self, mininterval=0.1):
+        self.mininterval = mininterval
+        self.names = []
+        self.index = {}
+        self.data = {k: np.full(16, np.nan) for k in self.FIELDS}
+
+    def _node(self, name):
+        if name not in self.index:
+            i = len(self.names)
+            if i == len(self.data['n']):
+                for k in self.FIELDS:
+                    self.data[k] = np.concatenate([self.data[k], np.full(i, np.nan)])
+            self.index[name] = i
+            self.names.append(name)
+            self.data['n'][i] = 0
+        return self.index[name]
+
+    def update(self, name, time, cpus, rss, read=None, write=None):
+        """Add the consecutive samples time, cpus, and rss (numpy arrays)
+        of node name, and optionally the bytes read and written since the
+        previous samples (NaN if unknown)"""
+        if len(time) == 0:
+            return
+        i = self._node(name)
+        d = self.data
+        previous = np.concatenate([[d['tlast'][i]], time[:-1]])
+        with np.errstate(invalid='ignore'):
+            valid = (time - previous) > self.mininterval
+        d['n'][i] += len(time)
+        d['tstart'][i] = np.fmin(d['tstart'][i], time.min())
+        d['tend'][i] = np.fmax(d['tend'][i], time.max())
+        d['tlast'][i] = time[-1]
+        d['rssmax'][i] = np.fmax(d['rssmax'][i], rss.max())
+        if np.any(valid):
+            d['cpumax'][i] = np.fmax(d['cpumax'][i], cpus[valid].max())
+        for k, v in [('read', read), ('write', write)]:
+            if v is not None and not np.all(np.isnan(v)):
+                d[k][i] = np.nan_to_num(d[k][i]) + np.nansum(v)
+
+    def to_dict(self):
+        out = {}
+        for name, i in self.index.items():
+            cpumax = self.data['cpumax'][i]
+            out[name] = {'n': int(self.data['n'][i]),
+                         'cpumax': None if np.isnan(cpumax) else float(cpumax),
+                         'mem': float(self.data['rssmax'][i]),
+                         'time': float(self.data['tend'][i] - self.data['tstart'][i]),
+                         'start': float(self.data['tstart'][i]),
+                         'end': float(self.data['tend'][i])}
+            for k in ['read', 'write']:
+                v = self.data[k][i]
+                out[name][f'{k}_GiB'] = None if np.isnan(v) else float(v) / (1 << 30)
+        return out
+
+
+def _column(fname, offset, chunk_size):
+    """Yield the elements of the array starting offset characters into
+    fname in lists, one for each chunk read"""
+    with open(fname, 'r') as f:
+        while offset:
+            offset -= len(f.read(min(offset, chunk_size)))
+        yield from _JSONStream(f, chunk_size=chunk_size).array()
+
+
+def _split(chunks, sizes):
+    """Yield float64 arrays of the given sizes from the elements of
+    chunks"""
+    buf = np.zeros(0)
+    for size in sizes:
+        while len(buf) < size:
+            buf = np.concatenate([buf, np.asarray(next(chunks), dtype=np.float64)])
+        out, buf = buf[:size], buf[size:]
+        yield out
+
+
+def _read_columnar(fname, stats, chunk_size=1 << 20, max_samples=1 << 16):
+    """nipype's resource monitor summary, a JSON object with one array per
+    key. The samples of each node are contiguous, so the first pass reads
+    the names as (name, count) runs and finds where the arrays start. The
+    second pass streams the time, CPU, and RSS arrays together (each from
+    its own file handle) into stats, at most max_samples at a time"""
+    lengths = {}
+    offsets = {}
+    runs = []
+    with open(fname, 'r') as f:
+        stream = _JSONStream(f, chunk_size=chunk_size)
+        for key, chunks in _iter_columns(stream):
+            offsets[key] = stream.offset + stream.pos
+            if key == 'name':
+                runs = [(name, sum(1 for _ in group))
+                        for name, group in groupby(chain.from_iterable(chunks))]
+                lengths[key] = sum(count for _, count in runs)
+            else:
+                lengths[key] = stream.count_array()
+    length = lengths.get('name', 0)
+    for k in RESOURCE_KEYS:
+        if lengths.get(k, 0) != length:
+            raise RuntimeError(f'Length of "{k}" in {fname} does not match length of "name"')
+    pieces = [(name, min(max_samples, count - start))
+              for name, count in runs for start in range(0, count, max_samples)]
+    columns = [_split(_column(fname, offsets[k], chunk_size), (size for _, size in pieces))
+               for k in ['time', 'cpus', 'rss_GiB']]
+    for (name, _), (time, cpus, rss) in zip(pieces, zip(*columns)):
+        stats.update(name, time, cpus, rss)
+
+
+def _read_ndjson(f, stats, chunk_lines=10000):
+    """One JSON object per line, with keys name, time, cpus, rss_GiB, and
+    optionally read_bytes and write_bytes (since the previous sample of the
+    node), as written by profiler.ProcProfiler. Samples of different nodes
+    may be interleaved, and the samples of a node may be written out of
+    order by different threads. Lines are processed chunk_lines at a time,
+    and the samples of each chunk are sorted by node and time"""
+    def flush(samples):
+        names, inverse = np.unique([s[0] for s in samples], return_inverse=True)
+        values = np.array([s[1:] for s in samples], dtype=np.float64)
+        order = np.lexsort((values[:, 0], inverse))
+        nodes, values = inverse[order], values[order]
+        starts = np.flatnonzero(np.r_[True, nodes[1:] != nodes[:-1]])
+        for start, end in zip(starts, np.r_[starts[1:], len(nodes)]):
+            stats.update(names[nodes[start]], *values[start:end].T)
+
+    samples = []
+    for line in f:
+        if not line.strip():
+            continue
+        sample = json.loads(line)
+        samples.append((sample['name'], sample['time'], sample['cpus'], sample['rss_GiB'],
+                        sample.get('read_bytes', np.nan), sample.get('write_bytes', np.nan)))
+        if len(samples) == chunk_lines:
+            flush(samples)
+            samples = []
+    if samples:
+        flush(samples)
+
+
+def _is_columnar(stream):
+    """Whether the first value of the first object is an array"""
+    stream.expect('{')
+    if stream.peek() != '"':
+        return True
+    stream.value()
+    stream.expect(':')
+    return stream.peek() == '['
+
+
+def load_resources_file(fname, mininterval=0.1, chunk_size=1 << 20):
+    """Read a profiling file, returning the number of samples (n),
+    maximum CPU usage (cpumax, see ResourceStats), maximum RSS (mem),
+    duration (time), times of the first and last samples (start and end), and total GiB read and written (read_GiB and write_GiB,
+    None if not recorded) of each node.
+
+    The file is either nipype's resource monitor summary (a JSON object of
+    arrays), which is read twice, or newline-delimited JSON with one sample
+    per line. Only a chunk of either is held in memory, besides the names of
+    the nodes.
+    """
+    stats = ResourceStats(mininterval=mininterval)
+    with open(fname, 'r') as f:
+        columnar = _is_columnar(_JSONStream(f, chunk_size=chunk_size))
+        f.seek(0)
+        if not columnar:
+            _read_ndjson(f, stats)
+    if columnar:
+        _read_columnar(fname, stats, chunk_size=chunk_size)
+    return stats.to_dict()
+
+
+DEFAULT_STATISTICS = ['p50', 'p95', 'max']
+RESOURCE_FIELDS = ['ncpu', 'cpumax', 'mem', 'time', 'read_GiB', 'write_GiB']
+
+
+def parse_statistic(statistic):
+    """Return the percentile of a statistic, either "max" or "pNN" """
+    if statistic == 'max':
+        return 100.0
+    if statistic.startswith('p'):
+        try:
+            q = float(statistic[1:])
+        except ValueError:
+            q = None
+        if q is not None and 0 <= q <= 100:
+            return q
+    raise ValueError(f'Invalid statistic {statistic}. Expected "max" or "pNN" with 0 <= NN <= 100')
+
+
+def calc_opt_resources(resources, mintime=1.0, statistics=None, statistic='max'):
+    """Calculate the number of processors, memory, and duration of each node
+    from the output of load_resources_file for one or more profiling runs.
+
+    The instances of a node (in every T1 workflow of every run) are summarized
+    by each of statistics ("max" or percentiles such as "p95"). statistic is
+    the one applied by --resource_input_file unless overridden.
+    """
+    if isinstance(resources, dict):
+        resources = [resources]
+    if statistics is None:
+        statistics = DEFAULT_STATISTICS
+    if statistic not in statistics:
+        statistics = list(statistics) + [statistic]
+    instances = {}
+    for run in resources:
+        for name, data in run.items():
+            cpumax = np.nan if data['cpumax'] is None else data['cpumax']
+            if data['time'] < mintime or np.isnan(cpumax):
+                ncpu = 1
+            else:
+                ncpu = max(np.ceil(cpumax / 100.0), 1)
+            io = [np.nan if data.get(k) is None else data[k] for k in ['read_GiB', 'write_GiB']]
+            instances.setdefault(adjust_node_name(name), []).append(
+                [ncpu, cpumax, data['mem'], data['time']] + io)
+    names = sorted(instances)
+    # pad to a (nodes x instances x fields) array so every node is
+    # summarized at once
+    width = max((len(v) for v in instances.values()), default=0)
+    values = np.full((len(names), width, len(RESOURCE_FIELDS)), np.nan)
+    for i, name in enumerate(names):
+        values[i, :len(instances[name])] = instances[name]
+    qs = [parse_statistic(stat) for stat in statistics]
+    with warnings.catch_warnings():
+        # nodes without any valid cpumax
+        warnings.simplefilter('ignore', RuntimeWarning)
+        summary = np.nanpercentile(values, qs, axis=1) if names else None
+    nodes = {}
+    for i, name in enumerate(names):
+        nodes[name] = {'n': len(instances[name])}
+        for j, stat in enumerate(statistics):
+            out = dict(zip(RESOURCE_FIELDS, (None if np.isnan(v) else float(v)
+                                             for v in summary[j, i])))
+            out['ncpu'] = int(np.ceil(out['ncpu']))
+            nodes[name][stat] = out
+    return {'statistic': statistic, 'statistics': list(statistics), 'nodes': nodes}
+
+
+def get_resource_data(data, statistic=None):
+    """Return the resources of each node in a resource file, using statistic,
+    or the statistic recorded in the file if None"""
+    if 'nodes' not in data:
+        # created before statistics were recorded, with the maximum of each node
+        if statistic not in (None, 'max'):
+            raise ValueError(f'Resource file only contains "max", not "{statistic}"')
+        return 'max', data
+    if statistic is None:
+        statistic = data['statistic']
+    if statistic not in data['statistics']:
+        raise ValueError(f'Resource file does not contain "{statistic}". '
+                         f'Available statistics are {data["statistics"]}')
+    return statistic, {name: node[statistic] for name, node in data['nodes'].items()}
 
 
 def adjust_node_name(name):
     namesplit = name.split('.')
     if namesplit[0] == 'participant':
         T1 = namesplit.pop(1)
-        if T1[:3] != 'T1_':
+        if T1.startswith('longitudinal_'):
+            # the nodes of every longitudinal subject and session share a name
+            namesplit.insert(1, 'longitudinal')
+            if len(namesplit) > 2 and namesplit[2].startswith('preproc_'):
+                namesplit[2] = 'preproc'
+        elif T1[:3] != 'T1_':
             return name
         nameadj = '.'.join(namesplit)
     else:
         nameadj = name
     return nameadj
+
+
+class StatusCallback(abc.ABC):
+    """Base class of nipype status callbacks, which are called by the plugin
+    with the node and its status. Run workflows with callbacks with
+    run_workflow so the callbacks are never copied or pickled, which allows
+    them to hold locks, threads, and files"""
+
+    @abc.abstractmethod
+    def __call__(self, node, status):
+        pass
+
+
+class _ChainedCallbacks(StatusCallback):
+    def __init__(self, callbacks):
+        self.callbacks = callbacks
+
+    def __call__(self, node, status):
+        for c in self.callbacks:
+            c(node, status)
+
+
+def chain_callbacks(*callbacks):
+    """Combine nipype status callbacks (called with node and status) into
+    one, ignoring None. Callbacks are called in order"""
+    return _ChainedCallbacks([c for c in callbacks if c is not None])
+
+
+def run_workflow(wf, plugin, plugin_args):
+    """Run wf with the nipype plugin named plugin. nipype keeps the plugin
+    arguments on map nodes, which it copies and pickles, so the status
+    callback is only given to the plugin and dropped from the arguments kept
+    on map nodes"""
+    from nipype.pipeline import plugins
+    plugin_args = plugin_args or {}
+    runner = getattr(plugins, f'{plugin}Plugin')(plugin_args=plugin_args)
+    runner.plugin_args = {k: v for k, v in plugin_args.items() if k != 'status_callback'}
+    return wf.run(plugin=runner)
@@ -0,0 +1,225 @@
+import argparse
+import cProfile
+from copy import deepcopy
+import json
+import os
+from pathlib import Path
+import pstats
+import shutil
+import time
+
+from nipype.interfaces.base import BaseInterface, DynamicTraitedSpec
+from nipype.interfaces.base.traits_extension import BasePath, Directory
+from nipype.interfaces.utility import IdentityInterface, Merge
+
+from .run import _pipeline_args, environment
+from .synthetic import make_empty_dataset
+
+
+DEFAULT_SCANS = [10, 100, 1000, 10000]
+# interfaces which only pass values between nodes, and are not stubbed
+PASSTHROUGH = (IdentityInterface, Merge)
+# (category, file, function) of the nipype functions whose cumulative time
+# is reported with --profile
+PROFILE_CATEGORIES = [('graph', 'workflows.py', '_create_flat_graph'),
+                      ('graph', 'utils.py', 'generate_expanded_graph'),
+                      ('graph', 'workflows.py', '_configure_exec_nodes'),
+                      ('hashing', 'specs.py', 'get_hashval'),
+                      ('pickling', 'filemanip.py', 'savepkl'),
+                      ('pickling', 'filemanip.py', 'loadpkl'),
+                      ('reports', 'utils.py', 'write_node_report')]
+
+
+class StubInterface(BaseInterface):
+    """Replace interface with an interface that does nothing except write an
+    empty file for each file output. The inputs (and therefore the hash) and
+    outputs are those of interface"""
+    input_spec = DynamicTraitedSpec
+    output_spec = DynamicTraitedSpec
+
+    def __init__(self, interface):
+        super(StubInterface, self).__init__()
+        self.inputs = interface.inputs
+        self._interface_class = type(interface)
+        self._output_template = interface._outputs()
+        self._results = {}
+
+    def _get_filecopy_info(self):
+        return self._interface_class._get_filecopy_info()
+
+    def _check_mandatory_inputs(self):
+        pass
+
+    def _check_version_requirements(self, trait_object, permissive=False):
+        return []
+
+    def _outputs(self):
+        return deepcopy(self._output_template)
+
+    def _run_interface(self, runtime):
+        outputs = self._output_template
+        for name in outputs.copyable_trait_names():
+            trait = outputs.trait(name)
+            inner = trait.inner_traits[0].trait_type if trait.inner_traits else None
+            for trait_type, many in [(trait.trait_type, False), (inner, True)]:
+                if isinstance(trait_type, BasePath):
+                    path = os.path.abspath(name if isinstance(trait_type, Directory) else f'{name}.nii.gz')
+                    if isinstance(trait_type, Directory):
+                        os.makedirs(path, exist_ok=True)
+                    else:
+                        open(path, 'w').close()
+                    self._results[name] = [path] if many else path
+                    break
+        return runtime
+
+    def _list_outputs(self):
+        return self._results
+
+
+def stub_workflow(wf):
+    """Replace the interface of every node of wf (except those which only
+    pass values) with a StubInterface. Returns the number of nodes stubbed"""
+    count = 0
+    for name in wf.list_node_names():
+        node = wf.get_node(name)
+        if isinstance(node.interface, PASSTHROUGH):
+            continue
+        node._interface = StubInterface(node.interface)
+        count += 1
+    return count
+
+
+class _Timings(object):
+    """A status callback recording the times of the first start and last end
+    and the summed duration of nodes"""
+
+    def __init__(self):
+        self.first = None
+        self.last = None
+        self.node_s = 0.0
+        self.n_nodes = 0
+        self.n_failed = 0
+        self._start = {}
+
+    def __call__(self, node, status):
+        t = time.time()
+        if status == 'start':
+            if self.first is None:
+                self.first = t
+            self._start[node.fullname] = t
+        else:
+            self.last = t
+            self.node_s += t - self._start.pop(node.fullname, t)
+            self.n_nodes += 1
+            self.n_failed += status == 'exception'
+
+
+def profile_categories(profile):
+    """The cumulative time of each of PROFILE_CATEGORIES in profile"""
+    out = {category: 0.0 for category, _, _ in PROFILE_CATEGORIES}
+    for (fname, _, funcname), (_, _, _, cumtime, _) in pstats.Stats(profile).stats.items():
+        for category, suffix, name in PROFILE_CATEGORIES:
+            if funcname == name and fname.endswith(suffix) and 'nipype' in fname:
+                out[category] += cumtime
+    return out
+
+
+def benchmark_scans(n_scans, out_dir, extra, plugin='MultiProc', n_proc=None, profile=False,
+                    build_only=False):
+    """Build (and unless build_only, run with stubs) the participant workflow
+    for n_scans empty scans, returning the timings"""
+    from TNT_pipeline_2.cli import _update_args
+    from TNT_pipeline_2.participant import participant_workflow
+    from TNT_pipeline_2.utils import run_workflow
+    base = Path(out_dir) / f'scans-{n_scans}'
+    if base.exists():
+        shutil.rmtree(str(base))
+    bids_dir = base / 'bids'
+    make_empty_dataset(bids_dir, n_scans)
+    for d in ['derivatives', 'work']:
+        (base / d).mkdir(parents=True)
+    args = _pipeline_args(bids_dir, base / 'derivatives',
+                          ['--skip_validation', '--working_directory', str(base / 'work')] + extra)
+    _update_args(args)
+    out = {'scans': n_scans}
+    t = time.time()
+    wf = participant_workflow(args)
+    out['build_s'] = time.time() - t
+    out['n_stubbed'] = stub_workflow(wf)
+    if build_only:
+        return out
+    timings = _Timings()
+    plugin_args = {'status_callback': timings}
+    if n_proc is not None and plugin == 'MultiProc':
+        plugin_args['n_procs'] = n_proc
+    profiler = cProfile.Profile() if profile else None
+    t = time.time()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        run_workflow(wf, plugin, plugin_args)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+    end = time.time()
+    out.update({'run_s': end - t,
+                # flattening and expanding the graph, and starting the plugin
+                'setup_s': (timings.first or end) - t,
+                'execution_s': (timings.last or end) - (timings.first or end),
+                'node_s': timings.node_s,
+                'n_nodes': timings.n_nodes,
+                'n_failed': timings.n_failed})
+    if timings.n_nodes:
+        out['run_ms_per_node'] = 1000 * out['run_s'] / timings.n_nodes
+    if profiler is not None:
+        out['profile_s'] = profile_categories(profiler)
+    return out
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.orchestration',
+        description='Time building and running the participant workflow with every interface '
+        'replaced by a stub which writes empty files, so only the cost of nipype and the pipeline '
+        'code is measured. Unrecognized arguments are passed to the pipeline.')
+    parser.add_argument('out_dir', type=Path,
+                        help='Directory for the datasets, working directories, and results')
+    parser.add_argument('--scans', type=int, nargs='+', default=DEFAULT_SCANS,
+                        help='Number of scans of each benchmark')
+    parser.add_argument('--plugin', choices=['MultiProc', 'Linear'], default='MultiProc')
+    parser.add_argument('--n_proc', type=int)
+    parser.add_argument('--profile', action='store_true',
+                        help='Profile the main process and report the time spent building the '
+                        'execution graph, hashing, pickling, and writing reports. '
+                        'With MultiProc, this excludes the work done by the worker processes')
+    parser.add_argument('--build_only', action='store_true', help='Only build the workflow')
+    parser.add_argument('--keep', action='store_true',
+                        help='Keep the datasets and working directories')
+    parser.add_argument('--output', type=Path,
+                        help='Results file (default out_dir/orchestration.json)')
+    return parser
+
+
+def main(argv=None):
+    args, extra = get_parser().parse_known_args(argv)
+    out_dir = args.out_dir.resolve()
+    out_dir.mkdir(parents=True, exist_ok=True)
+    results = {'benchmark': {'plugin': args.plugin, 'n_proc': args.n_proc,
+                             'build_only': args.build_only, 'pipeline_args': extra},
+               'environment': environment(),
+               'sizes': []}
+    output = args.output or out_dir / 'orchestration.json'
+    for n_scans in args.scans:
+        out = benchmark_scans(n_scans, out_dir, extra, plugin=args.plugin, n_proc=args.n_proc,
+                              profile=args.profile, build_only=args.build_only)
+        results['sizes'].append(out)
+        print(f'{n_scans:6d} scans: build {out["build_s"]:.1f} s' +
+              ('' if args.build_only else f', run {out["run_s"]:.1f} s ({out["n_nodes"]} nodes)'))
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=4)
+        if not args.keep:
+            shutil.rmtree(str(out_dir / f'scans-{n_scans}'))
+
+
+if __name__ == '__main__':
+    main()
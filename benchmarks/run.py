@@ -0,0 +1,332 @@
+import argparse
+from collections import OrderedDict
+import json
+import os
+from pathlib import Path
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+import nibabel
+import numpy as np
+
+import TNT_pipeline_2
+from .synthetic import make_dataset
+
+
+STAGES = ['pipeline', 'preproc', 'ants', 'classify', 'stats']
+GiB = float(1 << 30)
+
+
+def stage_of(name):
+    """The stage of the node name, which is the subworkflow of the T1
+    workflow containing it, e.g. participant.T1_sub-1.main.preproc.bet is in
+    preproc. Nodes outside a T1 workflow are in the stage of their top level
+    subworkflow or node"""
+    parts = name.split('.')
+    start = 1
+    for i, part in enumerate(parts):
+        if part.startswith('T1_'):
+            start = i + 1
+            break
+    parts = parts[start:]
+    if parts and parts[0] == 'main' and len(parts) > 1:
+        parts = parts[1:]
+    return parts[0] if parts else name
+
+
+def stage_metrics(trace_file, profile_file):
+    """Wall time, summed node time, number of nodes and failures (from the
+    trace), and CPU time and peak total RSS (from the proc profiler samples)
+    of each stage"""
+    with open(trace_file, 'r') as f:
+        events = [e for e in json.load(f)['traceEvents'] if e['ph'] == 'X']
+    stages = {}
+    for e in events:
+        stage = stages.setdefault(stage_of(e['args']['node']),
+                                  {'start': np.inf, 'end': -np.inf, 'node_s': 0.0,
+                                   'n_nodes': 0, 'n_failed': 0, 'cpu_s': 0.0, 'rss': {}})
+        stage['start'] = min(stage['start'], e['ts'] / 1e6)
+        stage['end'] = max(stage['end'], (e['ts'] + e['dur']) / 1e6)
+        stage['node_s'] += e['dur'] / 1e6
+        stage['n_nodes'] += 1
+        stage['n_failed'] += e['cat'] == 'exception'
+    samples = []
+    with open(profile_file, 'r') as f:
+        for line in f:
+            if line.strip():
+                samples.append(json.loads(line))
+    # every node of a sample has the same time, and its CPU usage is the
+    # average since the previous sample
+    times = sorted({s['time'] for s in samples})
+    previous = dict(zip(times[1:], times[:-1]))
+    for s in samples:
+        stage = stages.get(stage_of(s['name']))
+        if stage is None:
+            continue
+        if s['time'] in previous:
+            stage['cpu_s'] += s['cpus'] / 100.0 * (s['time'] - previous[s['time']])
+        stage['rss'][s['time']] = stage['rss'].get(s['time'], 0.0) + s['rss_GiB']
+    out = OrderedDict()
+    for name in sorted(stages, key=lambda k: stages[k]['start']):
+        stage = stages[name]
+        out[name] = {'wall_s': stage['end'] - stage['start'],
+                     'node_s': stage['node_s'],
+                     'cpu_s': stage['cpu_s'],
+                     'peak_rss_GiB': max(stage['rss'].values(), default=None),
+                     'n_nodes': stage['n_nodes'],
+                     'n_failed': stage['n_failed']}
+    return out
+
+
+def _pipeline_args(bids_dir, out_dir, extra):
+    """The pipeline arguments, used for the defaults of the models and
+    parameters of single stages"""
+    from TNT_pipeline_2.cli import get_parser
+    return get_parser().parse_args([str(bids_dir), str(out_dir), 'participant'] + extra)
+
+
+def _masked(in_file, mask_file, out_file):
+    img = nibabel.load(str(in_file))
+    mask = np.asanyarray(nibabel.load(str(mask_file)).dataobj) > 0
+    nibabel.Nifti1Image(img.get_fdata() * mask, img.affine, img.header).to_filename(str(out_file))
+    return out_file
+
+
+def _mask(label_file, out_file):
+    img = nibabel.load(str(label_file))
+    mask = (np.asanyarray(img.dataobj) > 0).astype(np.uint8)
+    nibabel.Nifti1Image(mask, img.affine).to_filename(str(out_file))
+    return out_file
+
+
+def _label_list(bids_dir):
+    labels = []
+    with open(Path(bids_dir) / 'sourcedata' / 'dseg.tsv', 'r') as f:
+        f.readline()
+        for line in f:
+            index, name = line.rstrip('\n').split('\t')
+            labels.append(OrderedDict(index=int(index), name=name))
+    return labels
+
+
+def stage_workflow(stage, scan, dseg, args, inputs_dir):
+    """A workflow running stage on one scan of a synthetic dataset, with
+    the label image dseg. The inputs of later stages are taken from the
+    dataset (e.g. the scan is used as the normalized image of ants, and
+    since the scans are in the space of the model, the model tags are used
+    as the transformed tags of classify)"""
+    from nipype.pipeline import engine as pe
+    from TNT_pipeline_2 import core_workflows
+    if stage == 'preproc':
+        wf = core_workflows.preproc_workflow(args.bet_frac,
+                                             args.bet_vertical_gradient,
+                                             args.inormalize_const2,
+                                             args.inormalize_range,
+                                             args.max_shear_angle)
+        wf.inputs.inputspec.T1 = str(scan)
+    elif stage == 'ants':
+        wf = core_workflows.ants_workflow(debug=args.debug, num_threads=args.ants_n_proc)
+        stem = Path(scan).name.split('.')[0]
+        wf.inputs.inputspec.normalized = str(scan)
+        wf.inputs.inputspec.normalized_brain = str(
+            _masked(scan, dseg, Path(inputs_dir) / f'{stem}_brain.nii.gz'))
+        wf.inputs.inputspec.model = str(args.model)
+        wf.inputs.inputspec.model_brain = str(
+            _masked(args.model, args.model_brain_mask, Path(inputs_dir) / 'model_brain.nii.gz'))
+        wf.inputs.inputspec.model_brain_mask = str(args.model_brain_mask)
+        wf.inputs.inputspec.tags = str(args.tags)
+    elif stage == 'classify':
+        from pndniworkflows.interfaces import pndni_utils
+        wf = core_workflows.classify_workflow(args.max_shear_angle)
+        stem = Path(scan).name.split('.')[0]
+        wf.inputs.inputspec.nu_bet = str(
+            _masked(scan, dseg, Path(inputs_dir) / f'{stem}_brain.nii.gz'))
+        wf.inputs.inputspec.brain_mask = str(
+            _mask(dseg, Path(inputs_dir) / f'{stem}_brain_mask.nii.gz'))
+        converttags = pe.Node(pndni_utils.ConvertPoints(out_format='minc'), 'converttags')
+        converttags.inputs.in_file = str(args.tags)
+        wf.connect(converttags, 'out_file', wf.get_node('inputspec'), 'trminctags')
+    elif stage == 'stats':
+        from pndniworkflows.postprocessing import image_stats_wf
+        wf = image_stats_wf(['volume', 'mean'], _label_list(Path(dseg).parent.parent), 'stats')
+        wf.inputs.inputspec.in_file = str(scan)
+        wf.inputs.inputspec.index_mask_file = str(dseg)
+    else:
+        raise ValueError(f'Unknown stage {stage}')
+    return wf
+
+
+def _usage():
+    self_, children = (resource.getrusage(who) for who in (resource.RUSAGE_SELF,
+                                                             resource.RUSAGE_CHILDREN))
+    return (time.time(),
+            self_.ru_utime + self_.ru_stime + children.ru_utime + children.ru_stime,
+            # KiB on Linux
+            max(self_.ru_maxrss, children.ru_maxrss) * 1024 / GiB)
+
+
+def run_stage(stage, bids_dir, work_dir, extra, n_proc=None, interval=1.0):
+    """Run stage on every scan of bids_dir in this process, with the proc
+    profiler and a trace"""
+    from nipype.pipeline import engine as pe
+    from TNT_pipeline_2.profiler import ProcProfiler
+    from TNT_pipeline_2.trace import TraceRecorder
+    from TNT_pipeline_2.utils import run_workflow
+    args = _pipeline_args(bids_dir, work_dir, extra)
+    inputs_dir = Path(work_dir) / 'inputs'
+    inputs_dir.mkdir(parents=True, exist_ok=True)
+    wf = pe.Workflow('benchmark', base_dir=str(work_dir))
+    for scan in sorted(Path(bids_dir).glob('sub-*/**/anat/*_T1w.nii.gz')):
+        subject = scan.name.split('_')[0]
+        sub = pe.Workflow('T1_' + scan.name.split('.')[0])
+        sub.add_nodes([stage_workflow(stage, scan, Path(bids_dir) / 'sourcedata' / f'{subject}_dseg.nii.gz',
+                                      args, inputs_dir)])
+        wf.add_nodes([sub])
+    plugin_args = {}
+    if n_proc is not None:
+        plugin_args['n_procs'] = n_proc
+    profile_file = Path(work_dir) / 'profile.ndjson'
+    trace = TraceRecorder(Path(work_dir) / 'trace.json', n_procs=n_proc or os.cpu_count())
+    plugin_args['status_callback'] = trace
+    with ProcProfiler(profile_file, interval=interval, workflow_name='benchmark'), trace:
+        run_workflow(wf, 'MultiProc', plugin_args)
+    return trace.out_file, profile_file
+
+
+def run_pipeline(bids_dir, work_dir, extra, n_proc=None, interval=1.0):
+    """Run the participant level of the pipeline on bids_dir in a new process,
+    with the proc profiler and a trace"""
+    out_dir = Path(work_dir) / 'derivatives'
+    nipype_dir = Path(work_dir) / 'work'
+    for d in [out_dir, nipype_dir]:
+        d.mkdir(parents=True, exist_ok=True)
+    profile_file = Path(work_dir) / 'profile.ndjson'
+    trace_file = Path(work_dir) / 'trace.json'
+    cmd = [sys.executable, '-m', 'TNT_pipeline_2.cli', str(bids_dir), str(out_dir), 'participant',
+           '--working_directory', str(nipype_dir),
+           '--profiler', 'proc',
+           '--profiling_output_file', str(profile_file),
+           '--profiling_interval', str(interval),
+           '--trace_output_file', str(trace_file)]
+    if n_proc is not None:
+        cmd.extend(['--n_proc', str(n_proc)])
+    subprocess.run(cmd + extra, check=True)
+    return trace_file, profile_file
+
+
+def environment():
+    import nipype
+    return {'python': platform.python_version(),
+            'platform': platform.platform(),
+            'host': platform.node(),
+            'cpu_count': os.cpu_count(),
+            'nipype': nipype.__version__,
+            'TNT_pipeline_2': str(Path(TNT_pipeline_2.__file__).parent)}
+
+
+def compare(baseline, results, tolerance=0.2):
+    """Return the stages (and "total") whose wall time increased by more than
+    tolerance (a fraction) relative to baseline, as (stage, baseline wall
+    time, wall time)"""
+    old = dict(baseline['stages'], total=baseline['total'])
+    new = dict(results['stages'], total=results['total'])
+    regressions = []
+    for stage in new:
+        if stage not in old or not old[stage]['wall_s']:
+            continue
+        if new[stage]['wall_s'] > old[stage]['wall_s'] * (1 + tolerance):
+            regressions.append((stage, old[stage]['wall_s'], new[stage]['wall_s']))
+    return regressions
+
+
+def _default_template():
+    data = Path(TNT_pipeline_2.__file__).parent / 'data'
+    template = data / 'SYS_808.nii.gz'
+    if not template.exists():
+        return None, None, None
+    return (template, data / 'SYS808_atlas_labels_nomiddle.nii.gz',
+            data / 'SYS808_atlas_labels_nomiddle_labels.tsv')
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks',
+        description='Run TNT_pipeline_2 on a synthetic dataset and save the wall time, '
+        'CPU time, and peak memory of each stage as JSON. '
+        'Unrecognized arguments are passed to the pipeline.')
+    parser.add_argument('out_dir', type=Path,
+                        help='Directory for the dataset, working directory, and results')
+    parser.add_argument('--stage', choices=STAGES, default='pipeline',
+                        help='"pipeline" runs the participant level. The other stages run '
+                        'a single subworkflow on every scan, with inputs from the dataset.')
+    parser.add_argument('--subjects', type=int, default=2)
+    parser.add_argument('--sessions', type=int, default=1)
+    parser.add_argument('--resolution', type=float, default=1.0, help='Voxel size in mm')
+    parser.add_argument('--noise', type=float, default=0.03,
+                        help='Standard deviation of the noise relative to the maximum intensity')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--phantom', action='store_true',
+                        help='Use a phantom instead of the SYS808 model (the default if it is not installed)')
+    parser.add_argument('--n_proc', type=int)
+    parser.add_argument('--profiling_interval', type=float, default=1.0)
+    parser.add_argument('--output', type=Path,
+                        help='Results file (default out_dir/benchmark.json)')
+    parser.add_argument('--baseline', type=Path,
+                        help='Results of a previous benchmark. Exit with an error if the wall time '
+                        'of any stage increased by more than --tolerance')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    return parser
+
+
+def main(argv=None):
+    args, extra = get_parser().parse_known_args(argv)
+    out_dir = args.out_dir.resolve()
+    bids_dir = out_dir / 'bids'
+    template, atlas, atlas_labels = (None, None, None) if args.phantom else _default_template()
+    if not bids_dir.exists():
+        make_dataset(bids_dir, args.subjects, n_sessions=args.sessions, resolution=args.resolution,
+                     noise=args.noise, template=template, atlas=atlas, atlas_labels=atlas_labels,
+                     seed=args.seed)
+    work_dir = out_dir / args.stage
+    work_dir.mkdir(parents=True, exist_ok=True)
+    start = _usage()
+    if args.stage == 'pipeline':
+        trace_file, profile_file = run_pipeline(bids_dir, work_dir, extra, args.n_proc,
+                                                args.profiling_interval)
+    else:
+        trace_file, profile_file = run_stage(args.stage, bids_dir, work_dir, extra, args.n_proc,
+                                             args.profiling_interval)
+    end = _usage()
+    results = {'benchmark': {'stage': args.stage,
+                             'subjects': args.subjects,
+                             'sessions': args.sessions,
+                             'resolution': args.resolution,
+                             'noise': args.noise,
+                             'seed': args.seed,
+                             'template': None if template is None else str(template),
+                             'n_proc': args.n_proc,
+                             'pipeline_args': extra},
+               'environment': environment(),
+               'total': {'wall_s': end[0] - start[0],
+                         'cpu_s': end[1] - start[1],
+                         'peak_rss_GiB': end[2]},
+               'stages': stage_metrics(trace_file, profile_file)}
+    output = args.output or out_dir / 'benchmark.json'
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=4)
+    for stage, data in results['stages'].items():
+        print(f'{stage:30s} {data["wall_s"]:10.1f} s wall {data["cpu_s"]:10.1f} s CPU')
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            regressions = compare(json.load(f), results, args.tolerance)
+        for stage, old, new in regressions:
+            print(f'Regression in {stage}: {old:.1f} s -> {new:.1f} s')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+import argparse
+import json
+from pathlib import Path
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from .run import environment
+
+
+def commands(tmp_dir):
+    """Commands which should start quickly, as {name: arguments}"""
+    tmp_dir = Path(tmp_dir)
+    prof = tmp_dir / 'prof.ndjson'
+    with open(prof, 'w') as f:
+        for t in range(10):
+            f.write(json.dumps({'name': 'participant.T1_sub-1.a', 'time': float(t),
+                                'cpus': 100.0, 'rss_GiB': 1.0}) + '\n')
+    base = [str(tmp_dir), str(tmp_dir)]
+    return {'import': ['-c', 'import TNT_pipeline_2.cli'],
+            'help': ['-m', 'TNT_pipeline_2.cli', '--help'],
+            'create_resource_file': ['-m', 'TNT_pipeline_2.cli'] + base + [
+                'create_resource_file', '--profiling_input_file', str(prof),
+                '--resource_output_file', str(tmp_dir / 'res.json')],
+            'qc_config_file_out': ['-m', 'TNT_pipeline_2.cli'] + base + [
+                'qcpages', '--qc_config_file_out', str(tmp_dir / 'qc.json')]}
+
+
+def time_command(args, repeat=5):
+    """The wall time of each of repeat runs of python with args"""
+    times = []
+    for _ in range(repeat):
+        t = time.time()
+        subprocess.run([sys.executable] + args, check=True, stdout=subprocess.DEVNULL)
+        times.append(time.time() - t)
+    return times
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.startup',
+        description='Time the startup of commands which do not run a workflow')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', type=Path, help='Save the results as JSON')
+    parser.add_argument('--max_seconds', type=float,
+                        help='Exit with an error if the median time of any command is longer')
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    results = {'environment': environment(), 'commands': {}}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, cmd in commands(tmp_dir).items():
+            times = time_command(cmd, repeat=args.repeat)
+            results['commands'][name] = {'median_s': float(np.median(times)), 'times_s': times}
+            print(f'{name:25s} {np.median(times):8.3f} s')
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+    if args.max_seconds is not None and any(c['median_s'] > args.max_seconds
+                                            for c in results['commands'].values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
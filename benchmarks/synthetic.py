@@ -0,0 +1,140 @@
+import json
+from pathlib import Path
+
+import nibabel
+from nibabel.processing import resample_from_to, resample_to_output
+import numpy as np
+
+
+# shape of the phantom field of view, in mm
+PHANTOM_FOV = (180, 216, 180)
+# (index, name, T1w intensity, semi-axes as a fraction of the field of view)
+PHANTOM_TISSUES = [(1, 'CSF', 0.25, (0.38, 0.40, 0.38)),
+                   (2, 'GM', 0.55, (0.36, 0.38, 0.36)),
+                   (3, 'WM', 0.85, (0.28, 0.30, 0.26))]
+SCALP_INTENSITY = 0.45
+SKULL_INTENSITY = 0.05
+
+
+def phantom(resolution=1.0):
+    """A head phantom of nested ellipsoids (scalp, skull, CSF, GM, and WM)
+    with T1w contrast, returning the image and the tissue labels"""
+    shape = tuple(int(round(f / resolution)) for f in PHANTOM_FOV)
+    affine = np.diag([resolution] * 3 + [1.0])
+    affine[:3, 3] = [-f / 2.0 for f in PHANTOM_FOV]
+    coords = np.meshgrid(*[np.linspace(-0.5, 0.5, n) for n in shape], indexing='ij')
+
+    def ellipsoid(axes):
+        return sum((c / a) ** 2 for c, a in zip(coords, axes)) <= 1.0
+
+    data = np.zeros(shape, dtype=np.float32)
+    labels = np.zeros(shape, dtype=np.uint8)
+    data[ellipsoid((0.46, 0.48, 0.46))] = SCALP_INTENSITY
+    data[ellipsoid((0.42, 0.44, 0.42))] = SKULL_INTENSITY
+    for index, _, intensity, axes in PHANTOM_TISSUES:
+        inside = ellipsoid(axes)
+        data[inside] = intensity
+        labels[inside] = index
+    # ventricles
+    ventricles = ellipsoid((0.05, 0.12, 0.06))
+    data[ventricles] = PHANTOM_TISSUES[0][2]
+    labels[ventricles] = PHANTOM_TISSUES[0][0]
+    return (nibabel.Nifti1Image(data, affine),
+            nibabel.Nifti1Image(labels, affine),
+            [{'index': index, 'name': name} for index, name, _, _ in PHANTOM_TISSUES])
+
+
+def from_template(template, atlas=None, atlas_labels=None, resolution=1.0):
+    """Resample a template (e.g. the SYS808 model) to resolution mm, and its
+    atlas to the resampled template, returning the image and labels as
+    phantom does"""
+    img = nibabel.as_closest_canonical(nibabel.load(str(template)))
+    img = resample_to_output(img, voxel_sizes=[resolution] * 3, order=1)
+    data = img.get_fdata(dtype=np.float32)
+    data /= np.percentile(data, 99.5)
+    img = nibabel.Nifti1Image(data, img.affine)
+    if atlas is None:
+        return img, None, None
+    atlas = resample_from_to(nibabel.load(str(atlas)), img, order=0)
+    labels = []
+    if atlas_labels is not None:
+        with open(atlas_labels, 'r') as f:
+            header = f.readline().rstrip('\n').split('\t')
+            for line in f:
+                row = dict(zip(header, line.rstrip('\n').split('\t')))
+                labels.append({'index': int(row['index']), 'name': row['name']})
+    return img, nibabel.Nifti1Image(np.asanyarray(atlas.dataobj).astype(np.uint8), atlas.affine), labels
+
+
+def corrupt(img, rng, noise=0.03, bias=0.2):
+    """Apply a smooth multiplicative bias field and Rician noise (with
+    standard deviation noise relative to the maximum intensity)"""
+    data = img.get_fdata(dtype=np.float32)
+    coords = np.meshgrid(*[np.linspace(-1, 1, n) for n in data.shape], indexing='ij')
+    field = np.ones(data.shape, dtype=np.float32)
+    for c in coords:
+        field += bias * (rng.uniform(-0.5, 0.5) * c + rng.uniform(-0.5, 0.5) * c ** 2)
+    data = data * field
+    sigma = noise * data.max()
+    data = np.sqrt((data + rng.normal(0, sigma, data.shape)) ** 2 +
+                   rng.normal(0, sigma, data.shape) ** 2)
+    data = np.round(data / data.max() * 4095).astype(np.int16)
+    return nibabel.Nifti1Image(data, img.affine)
+
+
+def make_dataset(out_dir, n_subjects, n_sessions=1, resolution=1.0, noise=0.03, bias=0.2,
+                 template=None, atlas=None, atlas_labels=None, seed=0):
+    """Write a BIDS dataset with one T1w image for each session of each
+    subject to out_dir. The images are a template (if given, otherwise a
+    phantom) resampled to resolution mm, with a different bias field and
+    noise for every image.
+
+    The labels of the template (its atlas) or phantom (tissue types) are
+    saved in sourcedata as sub-*_dseg.nii.gz, with dseg.tsv naming them,
+    for benchmarks which need a label image. Returns the T1w files"""
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    if template is None:
+        img, labels, label_names = phantom(resolution)
+    else:
+        img, labels, label_names = from_template(template, atlas, atlas_labels, resolution)
+    with open(out_dir / 'dataset_description.json', 'w') as f:
+        json.dump({'Name': 'Synthetic TNT_pipeline_2 benchmark', 'BIDSVersion': '1.2.0'}, f, indent=4)
+    if labels is not None:
+        (out_dir / 'sourcedata').mkdir(exist_ok=True)
+        with open(out_dir / 'sourcedata' / 'dseg.tsv', 'w') as f:
+            f.write('index\tname\n')
+            for label in label_names:
+                f.write(f'{label["index"]}\t{label["name"]}\n')
+    rng = np.random.RandomState(seed)
+    files = []
+    for i in range(1, n_subjects + 1):
+        subject = f'sub-{i:0{len(str(n_subjects))}d}'
+        for j in range(1, n_sessions + 1):
+            parts = [subject]
+            anat = out_dir / subject
+            if n_sessions > 1:
+                parts.append(f'ses-{j}')
+                anat = anat / f'ses-{j}'
+            anat = anat / 'anat'
+            anat.mkdir(parents=True, exist_ok=True)
+            fname = anat / ('_'.join(parts + ['T1w']) + '.nii.gz')
+            corrupt(img, rng, noise=noise, bias=bias).to_filename(str(fname))
+            files.append(fname)
+        if labels is not None:
+            labels.to_filename(str(out_dir / 'sourcedata' / f'{subject}_dseg.nii.gz'))
+    return files
+
+
+def make_empty_dataset(out_dir, n_scans):
+    """Write a BIDS dataset of n_scans subjects with empty T1w files, for
+    benchmarks which do not read the images"""
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    with open(out_dir / 'dataset_description.json', 'w') as f:
+        json.dump({'Name': 'Empty TNT_pipeline_2 benchmark', 'BIDSVersion': '1.2.0'}, f, indent=4)
+    for i in range(1, n_scans + 1):
+        subject = f'sub-{i:0{len(str(n_scans))}d}'
+        anat = out_dir / subject / 'anat'
+        anat.mkdir(parents=True)
+        open(anat / f'{subject}_T1w.nii.gz', 'w').close()
@@ -4,7 +4,7 @@ from setuptools import setup, find_packages
 setup(
     name='TNT_pipeline_2',
     version='dev',
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
     install_requires=[
         'nipype>=1.3.1',
         'pybids>=0.9.4',
@@ -15,8 +15,9 @@ setup(
     ],
     setup_requires=['pytest-runner'],
     tests_require=['pytest'],
-    extra_require={
-        'doc': ['Sphinx', 'sphinx-argparse', 'sphinx-rtd-theme']
+    extras_require={
+        'doc': ['Sphinx', 'sphinx-argparse', 'sphinx-rtd-theme'],
+        'parquet': ['pyarrow'],
     },
     entry_points={
         'console_scripts': [
@@ -0,0 +1,125 @@
+import json
+from pathlib import Path
+
+import nibabel
+import numpy as np
+import pytest
+
+from benchmarks import run, synthetic
+from TNT_pipeline_2 import trace
+
+
+def test_make_dataset(tmp_path):
+    files = synthetic.make_dataset(tmp_path, 2, n_sessions=2, resolution=6.0)
+    assert [f.relative_to(tmp_path).as_posix() for f in files] == [
+        'sub-1/ses-1/anat/sub-1_ses-1_T1w.nii.gz',
+        'sub-1/ses-2/anat/sub-1_ses-2_T1w.nii.gz',
+        'sub-2/ses-1/anat/sub-2_ses-1_T1w.nii.gz',
+        'sub-2/ses-2/anat/sub-2_ses-2_T1w.nii.gz']
+    img1 = nibabel.load(str(files[0]))
+    img2 = nibabel.load(str(files[1]))
+    assert img1.shape == (30, 36, 30)
+    assert not np.array_equal(img1.get_fdata(), img2.get_fdata())
+    labels = nibabel.load(str(tmp_path / 'sourcedata' / 'sub-1_dseg.nii.gz')).get_fdata()
+    data = img1.get_fdata()
+    # white matter is brighter than grey matter
+    assert np.median(data[labels == 3]) > np.median(data[labels == 2])
+    assert [line.split('\t')[1] for line in
+            (tmp_path / 'sourcedata' / 'dseg.tsv').read_text().splitlines()[1:]] == ['CSF', 'GM', 'WM']
+
+
+def test_classify_stage(tmp_path):
+    pytest.importorskip('pndniworkflows')
+    files = synthetic.make_dataset(tmp_path / 'bids', 1, resolution=6.0)
+    dseg = tmp_path / 'bids' / 'sourcedata' / 'sub-1_dseg.nii.gz'
+    args = run._pipeline_args(tmp_path / 'bids', tmp_path, [])
+    (tmp_path / 'inputs').mkdir()
+    wf = run.stage_workflow('classify', files[0], dseg, args, tmp_path / 'inputs')
+    assert wf.name == 'classify'
+    inputspec = wf.get_node('inputspec')
+    converttags = wf.get_node('converttags')
+    assert converttags.inputs.out_format == 'minc'
+    assert converttags.inputs.in_file == str(args.tags)
+    assert wf._graph.get_edge_data(converttags, inputspec)['connect'] == [('out_file', 'trminctags')]
+    labels = nibabel.load(str(dseg)).get_fdata()
+    mask = nibabel.load(inputspec.inputs.brain_mask).get_fdata()
+    np.testing.assert_array_equal(mask, labels > 0)
+    brain = nibabel.load(inputspec.inputs.nu_bet).get_fdata()
+    assert np.all(brain[labels == 0] == 0)
+    np.testing.assert_allclose(brain[labels > 0], nibabel.load(str(files[0])).get_fdata()[labels > 0], rtol=1e-3)
+
+
+def test_stage_of():
+    assert run.stage_of('participant.T1_sub-1.main.preproc.to_mnc.convert') == 'preproc'
+    assert run.stage_of('participant.T1_sub-1.main.forceqc_T1') == 'forceqc_T1'
+    assert run.stage_of('participant.T1_sub-1.io_out.datasink') == 'io_out'
+    assert run.stage_of('participant.maskmodel') == 'maskmodel'
+
+
+def test_stage_metrics(tmp_path):
+    recorder = trace.TraceRecorder(tmp_path / 'trace.json')
+    recorder.start('benchmark.T1_sub-1.preproc.bet', t=0.0)
+    recorder.start('benchmark.T1_sub-2.preproc.bet', t=1.0)
+    recorder.end('benchmark.T1_sub-1.preproc.bet', t=3.0)
+    recorder.start('benchmark.T1_sub-1.stats.a', t=3.0)
+    recorder.end('benchmark.T1_sub-2.preproc.bet', t=4.0)
+    recorder.end('benchmark.T1_sub-1.stats.a', t=5.0)
+    recorder.write()
+    samples = [('benchmark.T1_sub-1.preproc.bet', 1.0, 100.0, 1.0),
+               ('benchmark.T1_sub-2.preproc.bet', 2.0, 50.0, 2.0),
+               ('benchmark.T1_sub-1.preproc.bet', 2.0, 200.0, 1.5),
+               ('benchmark.T1_sub-1.stats.a', 4.0, 100.0, 0.5)]
+    with open(tmp_path / 'profile.ndjson', 'w') as f:
+        for name, t, cpus, rss in samples:
+            f.write(json.dumps({'name': name, 'time': t, 'cpus': cpus, 'rss_GiB': rss}) + '\n')
+    out = run.stage_metrics(tmp_path / 'trace.json', tmp_path / 'profile.ndjson')
+    assert list(out) == ['preproc', 'stats']
+    assert out['preproc']['wall_s'] == 4.0
+    assert out['preproc']['node_s'] == 6.0
+    assert out['preproc']['n_nodes'] == 2
+    # the first sample has no previous sample
+    assert out['preproc']['cpu_s'] == pytest.approx(2.5)
+    assert out['preproc']['peak_rss_GiB'] == 3.5
+    assert out['stats']['cpu_s'] == pytest.approx(2.0)
+
+
+def test_compare():
+    baseline = {'stages': {'preproc': {'wall_s': 10.0}, 'ants': {'wall_s': 100.0}},
+                'total': {'wall_s': 110.0}}
+    results = {'stages': {'preproc': {'wall_s': 11.0}, 'ants': {'wall_s': 150.0}},
+               'total': {'wall_s': 161.0}}
+    assert run.compare(baseline, results, tolerance=0.2) == [('ants', 100.0, 150.0),
+                                                             ('total', 110.0, 161.0)]
+
+
+def _add(x, y):
+    return x + y
+
+
+def test_stub_workflow(tmp_path):
+    from nipype import Function, Merge
+    from nipype.interfaces import fsl
+    from nipype.interfaces.ants import Registration
+    from nipype.pipeline import engine as pe
+    from nipype.utils.filemanip import loadpkl
+    from benchmarks import orchestration
+    wf = pe.Workflow('participant', base_dir=str(tmp_path))
+    (tmp_path / 'T1w.nii.gz').touch()
+    bet = pe.Node(fsl.BET(in_file=str(tmp_path / 'T1w.nii.gz'), mask=True), 'bet')
+    reg = pe.Node(Registration(), 'reg')
+    merge = pe.Node(Merge(2), 'merge')
+    add = pe.MapNode(Function(input_names=['x', 'y'], output_names=['out'], function=_add),
+                     iterfield=['x'], name='add')
+    add.inputs.x = [1, 2]
+    add.inputs.y = 3
+    wf.connect([(bet, reg, [('out_file', 'fixed_image'), ('mask_file', 'moving_image')]),
+                (reg, merge, [('composite_transform', 'in1')]),
+                (bet, merge, [('out_file', 'in2')])])
+    wf.add_nodes([add])
+    assert orchestration.stub_workflow(wf) == 3
+    timings = orchestration._Timings()
+    wf.run(plugin='Linear', plugin_args={'status_callback': timings})
+    assert timings.n_nodes == 4
+    assert timings.n_failed == 0
+    result = loadpkl(str(tmp_path / 'participant' / 'merge' / 'result_merge.pklz'))
+    assert [Path(p).name for p in result.outputs.out] == ['composite_transform.nii.gz', 'out_file.nii.gz']
@@ -0,0 +1,69 @@
+import os
+
+from nipype.interfaces.base import (BaseInterfaceInputSpec, TraitedSpec, SimpleInterface,
+                                    File, traits)
+from nipype.pipeline import engine as pe
+
+from TNT_pipeline_2 import cache
+
+
+RUNS = []
+
+
+class _ScaleInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True)
+    factor = traits.Int(mandatory=True)
+    num_threads = traits.Int(1, usedefault=True)
+
+
+class _ScaleOutputSpec(TraitedSpec):
+    out_file = File(exists=True)
+    total = traits.Int()
+
+
+class _Scale(SimpleInterface):
+    input_spec = _ScaleInputSpec
+    output_spec = _ScaleOutputSpec
+
+    def _run_interface(self, runtime):
+        RUNS.append(self.inputs.factor)
+        with open(self.inputs.in_file, 'r') as f:
+            total = int(f.read()) * self.inputs.factor
+        self._results['out_file'] = os.path.join(runtime.cwd, 'scaled.txt')
+        with open(self._results['out_file'], 'w') as f:
+            f.write(str(total))
+        self._results['total'] = total
+        return runtime
+
+
+def _run(base_dir, in_file, factor, cache_dir, num_threads=1):
+    node = pe.Node(_Scale(in_file=str(in_file), factor=factor, num_threads=num_threads),
+                   'bet', base_dir=str(base_dir))
+    wf = pe.Workflow('wf', base_dir=str(base_dir))
+    wf.add_nodes([node])
+    assert cache.cache_workflow(wf, cache_dir) == 1
+    wf.run(plugin='Linear')
+    node = wf.get_node('bet')
+    return node.result.outputs
+
+
+def test_cache_workflow(tmp_path):
+    del RUNS[:]
+    (tmp_path / 'a').mkdir()
+    (tmp_path / 'b').mkdir()
+    (tmp_path / 'a' / 'in.txt').write_text('3')
+    (tmp_path / 'b' / 'other.txt').write_text('3')
+    outputs = _run(tmp_path / 'work1', tmp_path / 'a' / 'in.txt', 2, tmp_path / 'cache')
+    assert outputs.total == 6
+    # a different path and working directory with the same contents, and a
+    # different number of threads, use the cache
+    outputs = _run(tmp_path / 'work2', tmp_path / 'b' / 'other.txt', 2, tmp_path / 'cache', num_threads=4)
+    assert outputs.total == 6
+    assert outputs.out_file == str(tmp_path / 'work2' / 'wf' / 'bet' / 'scaled.txt')
+    assert open(outputs.out_file).read() == '6'
+    assert RUNS == [2]
+    _run(tmp_path / 'work3', tmp_path / 'b' / 'other.txt', 3, tmp_path / 'cache')
+    (tmp_path / 'b' / 'other.txt').write_text('4')
+    _run(tmp_path / 'work4', tmp_path / 'b' / 'other.txt', 3, tmp_path / 'cache')
+    assert RUNS == [2, 3, 3]
+    assert not [p for p in (tmp_path / 'cache').iterdir() if p.name.startswith('tmp-')]
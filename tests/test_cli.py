@@ -1,4 +1,6 @@
+import pytest
 import subprocess
+import sys
 from pkg_resources import resource_filename
 from shutil import copyfile
 from multiprocessing import cpu_count
@@ -19,3 +21,50 @@ def test_cli(tmp_path):
     cmd = ['TNT_pipeline_2', str(indir), str(outdir), 'qcpages',
            '--subcortical', '--intracranial_volume', '--skip_validation']
     subprocess.check_call(cmd)
+
+
+# modules which take long to import, and are only needed by some analysis levels
+SLOW_MODULES = ['nipype', 'bids', 'pndniworkflows', 'PipelineQC', 'pkg_resources', 'matplotlib']
+
+
+def test_startup_imports():
+    code = ('import sys\n'
+            'from TNT_pipeline_2 import cli\n'
+            'cli.get_parser()\n'
+            f'print([m for m in {SLOW_MODULES!r} if m in sys.modules])\n')
+    out = subprocess.check_output([sys.executable, '-c', code])
+    assert out.decode().strip() == '[]'
+
+
+@pytest.mark.parametrize('level', ['create_resource_file', 'qcpages'])
+def test_analysis_level_imports(tmp_path, level):
+    out_file = tmp_path / 'out.json'
+    if level == 'create_resource_file':
+        prof = tmp_path / 'prof.ndjson'
+        prof.write_text('{"name": "participant.T1_sub-1.a", "time": 1.0, "cpus": 100.0, "rss_GiB": 1.0}\n')
+        extra = ['--profiling_input_file', str(prof), '--resource_output_file', str(out_file)]
+    else:
+        extra = ['--qc_config_file_out', str(out_file)]
+    code = ('import sys\n'
+            'from TNT_pipeline_2 import cli\n'
+            f'sys.argv = {["TNT_pipeline_2", str(tmp_path), str(tmp_path), level] + extra!r}\n'
+            'cli.main()\n'
+            f'print([m for m in {SLOW_MODULES!r} if m in sys.modules])\n')
+    out = subprocess.check_output([sys.executable, '-c', code])
+    assert out.decode().strip() == '[]'
+    assert out_file.exists()
+
+
+def test_profiler_requires_output_file(tmp_path):
+    from TNT_pipeline_2 import cli
+    argv = [str(tmp_path), str(tmp_path), 'create_resource_file']
+    args = cli.get_parser().parse_args(argv + ['--profiler', 'proc'])
+    with pytest.raises(ValueError):
+        cli._update_args(args)
+    args = cli.get_parser().parse_args(argv + ['--profiler', 'proc',
+                                               '--profiling_output_file', str(tmp_path / 'prof')])
+    cli._update_args(args)
+    assert args.profiler == 'proc'
+    args = cli.get_parser().parse_args(argv)
+    cli._update_args(args)
+    assert args.profiler == 'nipype'
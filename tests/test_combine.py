@@ -0,0 +1,195 @@
+import csv
+import os
+
+import pytest
+
+from TNT_pipeline_2 import combine
+from TNT_pipeline_2.group import ROW_KEYS, INVARIANTS, INDEX, IGNORE
+
+
+def _write_stats(bids_dir, prefix, desc, rows):
+    parts = dict(p.split('-') for p in prefix.split('_'))
+    anat = bids_dir / f'sub-{parts["sub"]}'
+    if 'ses' in parts:
+        anat = anat / f'ses-{parts["ses"]}'
+    anat = anat / 'anat'
+    anat.mkdir(parents=True, exist_ok=True)
+    fname = anat / f'{prefix}_desc-{desc}_stats.tsv'
+    with open(fname, 'w', newline='') as f:
+        f.write('index\tname\tvolume\tmean\r\n')
+        for row in rows:
+            f.write('\t'.join(str(v) for v in row) + '\r\n')
+    return fname
+
+
+def _read(fname):
+    with open(fname, 'r', newline='') as f:
+        return list(csv.DictReader(f, delimiter='\t'))
+
+
+def _combine(bids_dir, **kwargs):
+    return combine.combine_incremental(bids_dir,
+                                       bids_dir / 'group.tsv',
+                                       bids_dir / 'group_index.json',
+                                       ROW_KEYS,
+                                       INVARIANTS,
+                                       INDEX,
+                                       IGNORE,
+                                       **kwargs)
+
+
+COMBINED = []
+
+
+def _combine_stats(bids_dir, files, row_keys, invariants, index, ignore):
+    """Stands in for CombineStats in the tests of the bookkeeping, naming
+    columns <desc>_<name>_<statistic>"""
+    rows = {}
+    for relname in files:
+        COMBINED.append(os.path.basename(relname))
+        entities = combine.parse_bids_filename(relname)
+        row = rows.setdefault(combine.row_key(entities, row_keys),
+                              {key: entities.get(key, 'n/a') for key in row_keys})
+        for stats in _read(bids_dir / relname):
+            for col, val in stats.items():
+                if col != index and col not in ignore:
+                    row[f'{entities["desc"]}_{stats[index]}_{col}'] = val
+    columns = sorted({col for row in rows.values() for col in row} - set(row_keys))
+    return list(row_keys) + columns, [{col: row.get(col, 'n/a') for col in list(row_keys) + columns}
+                                      for row in rows.values()]
+
+
+@pytest.fixture
+def combine_stats(monkeypatch):
+    COMBINED.clear()
+    monkeypatch.setattr(combine, 'combine_stats', _combine_stats)
+    return COMBINED
+
+
+@pytest.fixture
+def bids_dir(tmp_path):
+    _write_stats(tmp_path, 'sub-1', 'brain', [(1, 'brain', 10, 1.5)])
+    _write_stats(tmp_path, 'sub-1', 'tissuelobes', [(1, 'GM', 2, 3.5), (2, 'WM', 4, 5.5)])
+    _write_stats(tmp_path, 'sub-2_ses-a', 'brain', [(1, 'brain', 20, 2.5)])
+    (tmp_path / 'sub-1' / 'anat' / 'sub-1_desc-tissue_features.tsv').write_text('value\tindex\n')
+    return tmp_path
+
+
+def test_sweep_skipped(bids_dir):
+    import json
+    from bids import BIDSLayout
+    from TNT_pipeline_2 import group
+    from TNT_pipeline_2.output import SWEEP_DIR
+    sweep_dir = bids_dir / SWEEP_DIR / 'frac-0.3_vg-0_const2-0-5000'
+    _write_stats(sweep_dir, 'sub-1', 'brain', [(1, 'brain', 11, 1.5)])
+    for folder in [bids_dir, sweep_dir]:
+        (folder / 'sub-1' / 'anat' / 'sub-1_stats.parquet').touch()
+    (bids_dir / 'dataset_description.json').write_text(
+        json.dumps({'Name': 'out', 'BIDSVersion': '1.2.0', 'PipelineDescription': {'Name': 'test'}}))
+    expected = [bids_dir / 'sub-1' / 'anat' / 'sub-1_desc-brain_stats.tsv',
+                bids_dir / 'sub-1' / 'anat' / 'sub-1_desc-tissuelobes_stats.tsv',
+                bids_dir / 'sub-2' / 'ses-a' / 'anat' / 'sub-2_ses-a_desc-brain_stats.tsv']
+    assert [fname for fname, _ in combine.find_stats_files(bids_dir, INVARIANTS)] == expected
+    assert group.get_stats_tables(bids_dir) == [str(bids_dir / 'sub-1' / 'anat' / 'sub-1_stats.parquet')]
+    # the layout used by CombineStats
+    layout = BIDSLayout(str(bids_dir), validate=False)
+    assert sorted(layout.get(suffix='stats', extension='tsv', return_type='filename')) == \
+        [str(fname) for fname in expected]
+
+
+def test_combine_incremental(bids_dir, combine_stats):
+    _combine(bids_dir)
+    rows = _read(bids_dir / 'group.tsv')
+    assert [(r['subject'], r['session']) for r in rows] == [('1', 'n/a'), ('2', 'a')]
+    assert rows[0]['brain_brain_volume'] == '10'
+    assert rows[0]['tissuelobes_WM_mean'] == '5.5'
+    assert rows[1]['tissuelobes_WM_mean'] == 'n/a'
+
+    combine_stats.clear()
+    _combine(bids_dir)
+    assert combine_stats == []
+    assert _read(bids_dir / 'group.tsv') == rows
+
+    _write_stats(bids_dir, 'sub-3', 'brain', [(1, 'brain', 30, 3.5)])
+    fname = _write_stats(bids_dir, 'sub-2_ses-a', 'brain', [(1, 'brain', 25, 2.5)])
+    os.utime(fname, ns=(1, 1))
+    _combine(bids_dir, n_proc=1)
+    assert sorted(combine_stats) == ['sub-2_ses-a_desc-brain_stats.tsv', 'sub-3_desc-brain_stats.tsv']
+    rows = _read(bids_dir / 'group.tsv')
+    assert [r['brain_brain_volume'] for r in rows] == ['10', '25', '30']
+
+    (bids_dir / 'sub-1' / 'anat' / 'sub-1_desc-tissuelobes_stats.tsv').unlink()
+    combine_stats.clear()
+    _combine(bids_dir)
+    assert combine_stats == ['sub-1_desc-brain_stats.tsv']
+    rows = _read(bids_dir / 'group.tsv')
+    assert 'tissuelobes_WM_mean' not in rows[0]
+    assert len(rows) == 3
+
+
+def test_combine_incremental_rewritten(bids_dir, combine_stats):
+    _combine(bids_dir)
+    # e.g. the default group workflow replaced the table
+    (bids_dir / 'group.tsv').write_text('subject\tsomething\n1\t2\n')
+    combine_stats.clear()
+    _combine(bids_dir)
+    assert len(combine_stats) == 3
+    assert len(_read(bids_dir / 'group.tsv')) == 2
+
+
+def test_combine_incremental_no_pool(bids_dir, combine_stats, monkeypatch):
+    _combine(bids_dir)
+
+    def pool(*args):
+        raise AssertionError('Pool created')
+
+    monkeypatch.setattr(combine, 'Pool', pool)
+    _combine(bids_dir, n_proc=4)
+    _write_stats(bids_dir, 'sub-3', 'brain', [(1, 'brain', 30, 3.5)])
+    _combine(bids_dir, n_proc=4)
+
+
+@pytest.mark.parametrize('n_proc', [1, 2])
+def test_combine_streaming(bids_dir, combine_stats, n_proc):
+    _combine(bids_dir)
+    combine.combine_streaming(bids_dir,
+                              bids_dir / 'streaming.tsv',
+                              ROW_KEYS,
+                              INVARIANTS,
+                              INDEX,
+                              IGNORE,
+                              n_proc=n_proc,
+                              window=1)
+    assert _read(bids_dir / 'streaming.tsv') == _read(bids_dir / 'group.tsv')
+
+
+def _by_key(rows):
+    return {combine.table_key(row, ROW_KEYS): row for row in rows}
+
+
+def test_combine_stats_equivalence(bids_dir, tmp_path_factory):
+    """The tables have the layout of the default group workflow"""
+    from pndniworkflows.interfaces.io import CombineStats
+    (bids_dir / 'dataset_description.json').write_text('{"Name": "test", "BIDSVersion": "1.2.0"}')
+    cwd = tmp_path_factory.mktemp('combinestats')
+    result = CombineStats(bids_dir=str(bids_dir),
+                          validate=False,
+                          row_keys=ROW_KEYS,
+                          invariants=INVARIANTS,
+                          index=INDEX,
+                          ignore=IGNORE).run(cwd=str(cwd))
+    expected = _read(result.outputs.out_tsv)
+    with open(result.outputs.out_tsv, 'r', newline='') as f:
+        header = next(csv.reader(f, delimiter='\t'))
+    # a single batch is the table of CombineStats
+    combine.combine_streaming(bids_dir, bids_dir / 'streaming.tsv', ROW_KEYS, INVARIANTS,
+                              INDEX, IGNORE, n_proc=1)
+    assert _read(bids_dir / 'streaming.tsv') == expected
+    # several batches have the same rows and columns
+    combine.combine_streaming(bids_dir, bids_dir / 'streaming.tsv', ROW_KEYS, INVARIANTS,
+                              INDEX, IGNORE, n_proc=2, window=1)
+    _combine(bids_dir, n_proc=2, window=1)
+    for fname in ['streaming.tsv', 'group.tsv']:
+        rows = _read(bids_dir / fname)
+        assert set(rows[0]) == set(header)
+        assert _by_key(rows) == _by_key(expected)
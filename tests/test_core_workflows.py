@@ -0,0 +1,93 @@
+import shutil
+import subprocess
+
+from nipype import IdentityInterface
+from nipype.pipeline import engine as pe
+import numpy as np
+import pytest
+
+from TNT_pipeline_2 import core_workflows
+
+
+def test_sweep_settings():
+    assert core_workflows.sweep_settings(0.5, 0.0, [0.0, 5000.0]) == [
+        {'const2': (0.0, 5000.0), 'frac': 0.5, 'vertical_gradient': 0.0}]
+    settings = core_workflows.sweep_settings([0.4, 0.6], 0.1, [[0.0, 5000.0], [0.0, 4000.0]])
+    assert [(s['const2'][1], s['frac'], s['vertical_gradient']) for s in settings] == [
+        (5000.0, 0.4, 0.1), (5000.0, 0.6, 0.1), (4000.0, 0.4, 0.1), (4000.0, 0.6, 0.1)]
+
+
+def test_preproc_workflow_sweep():
+    wf = core_workflows.preproc_workflow([0.4, 0.6], [0.0, 0.2], [0.0, 5000.0], 1.0, 0.1)
+    assert wf.get_node(core_workflows.INORM_SWEEP) is None
+    assert wf.get_node('inorm').inputs.const2 == (0.0, 5000.0)
+    sweep = wf.get_node(core_workflows.BET_SWEEP)
+    assert sweep.iterables == [('frac', [0.4, 0.4, 0.6, 0.6]),
+                               ('vertical_gradient', [0.0, 0.2, 0.0, 0.2])]
+    assert sweep.synchronize
+
+
+def test_template_workflow():
+    wf = core_workflows.template_workflow(subcortical=True)
+    outputs = wf.get_node('outputspec').inputs.copyable_trait_names()
+    assert set(outputs) == set(['template', 'template_brain'] + core_workflows.TRANSFORMS +
+                               core_workflows.SUBCORTICAL_TRANSFORMS)
+    # session -> template -> model, assembled in reverse
+    merge = wf.get_node('comptransformmerge')
+    sources = {dest: src.name for src, _, data in wf._graph.in_edges(merge, data=True)
+               for _, dest in data['connect']}
+    assert sources == {'in1': 'nlreg', 'in2': 'tosession'}
+    assert merge.iterfield == ['in2']
+    assert wf.get_node('compinversemerge').iterfield == ['in1']
+
+
+def _write_affine(fname, matrix, translation):
+    params = ' '.join(str(v) for v in list(np.ravel(matrix)) + list(translation))
+    fname.write_text('#Insight Transform File V1.0\n'
+                     '#Transform 0\n'
+                     'Transform: AffineTransform_double_3_3\n'
+                     f'Parameters: {params}\n'
+                     'FixedParameters: 0 0 0\n')
+    return str(fname)
+
+
+def _apply_to_points(tmp_path, points, transforms):
+    in_csv = tmp_path / 'points.csv'
+    out_csv = tmp_path / 'out.csv'
+    np.savetxt(str(in_csv), np.c_[points, np.zeros(len(points))], delimiter=',',
+               header='x,y,z,t', comments='')
+    cmd = ['antsApplyTransformsToPoints', '-d', '3', '-i', str(in_csv), '-o', str(out_csv)]
+    for transform in transforms:
+        cmd.extend(['-t', transform])
+    subprocess.run(cmd, check=True)
+    return np.loadtxt(str(out_csv), delimiter=',', skiprows=1)[:, :3]
+
+
+@pytest.mark.skipif(shutil.which('CompositeTransformUtil') is None or
+                    shutil.which('antsApplyTransformsToPoints') is None,
+                    reason='ANTs is not installed')
+def test_compose(tmp_path):
+    rng = np.random.RandomState(0)
+    first = (np.eye(3) + 0.1 * rng.randn(3, 3), [10.0, -5.0, 2.0])
+    second = (np.eye(3) + 0.1 * rng.randn(3, 3), [-3.0, 4.0, 7.0])
+    firstfile = _write_affine(tmp_path / 'first.txt', *first)
+    secondfile = _write_affine(tmp_path / 'second.txt', *second)
+    wf = pe.Workflow('compose', base_dir=str(tmp_path))
+    inputs = pe.Node(IdentityInterface(fields=['first', 'second']), 'inputs')
+    inputs.inputs.first = [firstfile]
+    inputs.inputs.second = secondfile
+    compose = core_workflows._compose(wf, 'compose', [(inputs, 'first'), (inputs, 'second')], 0)
+    result = wf.run()
+    composed = [n for n in result.nodes() if n.name == 'compose'][0].result.outputs.out_file[0]
+    points = rng.rand(10, 3) * 100
+    sequential = _apply_to_points(tmp_path, points, [firstfile, secondfile])
+    expected = (points @ first[0].T + first[1]) @ second[0].T + second[1]
+    assert np.allclose(sequential, expected, atol=1e-4)
+    assert np.allclose(_apply_to_points(tmp_path, points, [composed]), sequential, atol=1e-4)
+
+
+def test_main_workflow_longitudinal():
+    wf = core_workflows.main_workflow([], 0.5, 0.0, [0.0, 5000.0], 1.0, longitudinal=True)
+    assert wf.get_node('forceqc_T1') is None
+    assert wf.get_node('ants.nlreg') is None
+    assert wf.get_node('ants.warpmodel') is not None
@@ -0,0 +1,85 @@
+from nipype.pipeline import engine as pe
+import pytest
+
+from TNT_pipeline_2 import export
+
+
+def _workflow(tmp_path, n):
+    wf = pe.Workflow('wf', base_dir=str(tmp_path / 'work'))
+    for i in range(n):
+        (tmp_path / f'{i}.txt').write_text(str(i) * (i + 1))
+        wf.add_nodes([pe.Node(export.DeferredExport(in_file=str(tmp_path / f'{i}.txt'),
+                                                    out_file=str(tmp_path / 'out' / f'{i}.txt')),
+                              f'write{i}', run_without_submitting=True)])
+    (tmp_path / 'out').mkdir()
+    return wf
+
+
+def test_ExportQueue(tmp_path):
+    wf = _workflow(tmp_path, 4)
+    # at most 3 bytes are copied at once
+    with export.ExportQueue(n_threads=2, max_bytes=3) as queue:
+        wf.run(plugin='MultiProc', plugin_args={'status_callback': queue, 'n_procs': 2})
+    assert queue.n_files == 4
+    for i in range(4):
+        assert (tmp_path / 'out' / f'{i}.txt').read_text() == str(i) * (i + 1)
+    assert sorted(p.name for p in (tmp_path / 'out').iterdir()) == ['0.txt', '1.txt', '2.txt', '3.txt']
+
+
+def test_DeferredExport(tmp_path):
+    (tmp_path / 'in.nii.gz').write_text('a')
+    (tmp_path / 'exists.nii.gz').write_text('b')
+    with pytest.raises(FileExistsError):
+        export.DeferredExport(in_file=str(tmp_path / 'in.nii.gz'),
+                              out_file=str(tmp_path / 'exists.nii.gz')).run()
+    with pytest.raises(RuntimeError):
+        export.DeferredExport(in_file=str(tmp_path / 'in.nii.gz'),
+                              out_file=str(tmp_path / 'out.nii')).run()
+    res = export.DeferredExport(in_file=str(tmp_path / 'in.nii.gz'),
+                                out_file=str(tmp_path / 'out.nii.gz')).run()
+    assert res.outputs.out_file == str(tmp_path / 'out.nii.gz')
+    assert not (tmp_path / 'out.nii.gz').exists()
+
+
+def test_ExportQueue_error(tmp_path):
+    (tmp_path / 'in.txt').write_text('a')
+    queue = export.ExportQueue()
+    queue.submit(str(tmp_path / 'in.txt'), str(tmp_path / 'missing' / 'out.txt'))
+    with pytest.raises(RuntimeError):
+        queue.close()
+    assert queue.n_files == 0
+
+
+def test_ExportQueue_full(tmp_path, monkeypatch):
+    import threading
+    import time
+    release = threading.Event()
+
+    def slow_export(in_file, out_file):
+        release.wait()
+        _export(in_file, out_file)
+
+    _export = export._export
+    monkeypatch.setattr(export, '_export', slow_export)
+    wf = _workflow(tmp_path, 4)
+    nodes = [wf.get_node(f'write{i}') for i in range(4)]
+    queue = export.ExportQueue(n_threads=2, max_bytes=1)
+    try:
+        # the first file fills the buffer, and the others are queued
+        # without waiting
+        start = time.time()
+        for node in nodes:
+            queue(node, 'end')
+        assert time.time() - start < 0.5
+        deadline = time.time() + 5
+        while queue._in_flight != 1 and time.time() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.1)
+        assert queue._in_flight == 1
+        assert len(queue._pending) == 3
+    finally:
+        release.set()
+        queue.close()
+    assert queue.n_files == 4
+    for i in range(4):
+        assert (tmp_path / 'out' / f'{i}.txt').read_text() == str(i) * (i + 1)
@@ -0,0 +1,87 @@
+import pytest
+
+from TNT_pipeline_2 import interfaces
+
+
+def test_WriteLabelFiles(tmp_path):
+    out_files = [str(tmp_path / 'a' / 'a_labels.tsv'),
+                 str(tmp_path / 'b' / 'b_labels.tsv'),
+                 str(tmp_path / 'c' / 'c_labels.tsv')]
+    strings = ['index\tname\r\n1\tGM\r\n',
+               'index\tname\r\n1\tfrontal\r\n',
+               'index\tname\r\n1\tGM\r\n']
+    (tmp_path / 'c').mkdir()
+    (tmp_path / 'c' / 'c_labels.tsv').write_text('old')
+    res = interfaces.WriteLabelFiles(out_files=out_files, strings=strings).run()
+    assert res.outputs.out_files == out_files
+    for out_file, string in zip(out_files, strings):
+        with open(out_file, 'r', newline='') as f:
+            assert f.read() == string
+    assert (tmp_path / 'a' / 'a_labels.tsv').samefile(tmp_path / 'c' / 'c_labels.tsv')
+    assert not (tmp_path / 'a' / 'a_labels.tsv').samefile(tmp_path / 'b' / 'b_labels.tsv')
+
+
+def _write_stats(fname, rows, header=('index', 'name', 'volume', 'mean')):
+    with open(fname, 'w', newline='') as f:
+        f.write('\t'.join(header) + '\r\n')
+        for row in rows:
+            f.write('\t'.join(str(v) for v in row) + '\r\n')
+
+
+def test_StatsTable_CombineStatsTables(tmp_path):
+    pq = pytest.importorskip('pyarrow.parquet')
+    tables = []
+    for sub in ['1', '2']:
+        stats = tmp_path / f'sub-{sub}_desc-tissuelobes_stats.tsv'
+        _write_stats(stats, [(1, 'GM+frontal', 10.0, 100.5), (2, 'WM+frontal', 20.0, 'n/a')])
+        icv = tmp_path / f'sub-{sub}_desc-ICV_stats.tsv'
+        _write_stats(icv, [(1, 'ICV', 1000.0)], header=('index', 'name', 'volume'))
+        entities = {'subject': sub}
+        if sub == '2':
+            entities['session'] = 'a'
+        out_file = tmp_path / f'sub-{sub}.parquet'
+        res = interfaces.StatsTable(in_files=[str(stats), str(icv)],
+                                    descs=['tissuelobes', 'ICV'],
+                                    entities=entities,
+                                    out_file=str(out_file)).run()
+        tables.append(res.outputs.out_file)
+    table = pq.read_table(tables[0]).to_pydict()
+    assert table == {'subject': ['1', '1', '1'],
+                     'desc': ['tissuelobes', 'tissuelobes', 'ICV'],
+                     'index': [1, 2, 1],
+                     'name': ['GM+frontal', 'WM+frontal', 'ICV'],
+                     'volume': [10.0, 20.0, 1000.0],
+                     'mean': [100.5, None, None]}
+    res = interfaces.CombineStatsTables(in_files=tables,
+                                        out_file=str(tmp_path / 'group.parquet')).run()
+    combined = pq.read_table(res.outputs.out_file).to_pydict()
+    assert combined['subject'] == ['1'] * 3 + ['2'] * 3
+    assert combined['session'] == [None] * 3 + ['a'] * 3
+    assert combined['volume'] == [10.0, 20.0, 1000.0] * 2
+
+
+def test_ApplyMask(tmp_path):
+    import nibabel
+    import numpy as np
+    affine = np.diag([2.0, 2.0, 2.0, 1.0])
+    mask = np.zeros((4, 5, 6), dtype=np.uint8)
+    mask[1:3, 1:4, 2:5] = 1
+    nibabel.Nifti1Image(mask, affine).to_filename(str(tmp_path / 'mask.nii.gz'))
+    a = np.arange(120, dtype=np.int16).reshape(4, 5, 6)
+    b = np.ones((4, 5, 6), dtype=np.float32)
+    nibabel.Nifti1Image(a, affine).to_filename(str(tmp_path / 'a.nii.gz'))
+    (tmp_path / 'b').mkdir()
+    nibabel.Nifti1Image(b, affine).to_filename(str(tmp_path / 'b' / 'a.nii'))
+    res = interfaces.ApplyMask(in_file=str(tmp_path / 'a.nii.gz'), in_file2=str(tmp_path / 'b' / 'a.nii'),
+                               mask_file=str(tmp_path / 'mask.nii.gz')).run(cwd=str(tmp_path))
+    assert res.outputs.out_file == str(tmp_path / 'a_masked.nii.gz')
+    assert res.outputs.out_file2 == str(tmp_path / 'a_masked2.nii.gz')
+    out = nibabel.load(res.outputs.out_file)
+    assert out.get_data_dtype() == np.int16
+    assert np.array_equal(out.affine, affine)
+    assert np.array_equal(np.asanyarray(out.dataobj), a * mask)
+    assert np.array_equal(np.asanyarray(nibabel.load(res.outputs.out_file2).dataobj), b * mask)
+    nibabel.Nifti1Image(mask[:3], affine).to_filename(str(tmp_path / 'small.nii.gz'))
+    with pytest.raises(ValueError):
+        interfaces.ApplyMask(in_file=str(tmp_path / 'a.nii.gz'),
+                             mask_file=str(tmp_path / 'small.nii.gz')).run(cwd=str(tmp_path))
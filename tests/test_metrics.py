@@ -0,0 +1,105 @@
+import math
+
+from nipype.interfaces.utility import Function, IdentityInterface
+from nipype.pipeline import engine as pe
+
+from TNT_pipeline_2 import metrics, utils
+
+
+class _Node(object):
+    def __init__(self, fullname, n_procs=1, mem_gb=0.0):
+        self.fullname = fullname
+        self.n_procs = n_procs
+        self.mem_gb = mem_gb
+
+
+def _parse(text):
+    values = {}
+    for line in text.splitlines():
+        if not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            values[name] = float(value)
+    return values
+
+
+def test_metrics_writer(tmp_path):
+    nodes = {'T1_sub-1': ['participant.T1_sub-1.a', 'participant.T1_sub-1.b'],
+             'T1_sub-2': ['participant.T1_sub-2.a', 'participant.T1_sub-2.b'],
+             'T1_sub-3': ['participant.T1_sub-3.a']}
+    writer = metrics.MetricsWriter(tmp_path / 'm.prom', nodes, n_procs=4)
+    writer.t0 = 0.0
+    a1, b1 = _Node('participant.T1_sub-1.a', n_procs=2, mem_gb=1.5), _Node('participant.T1_sub-1.b')
+    a2 = _Node('participant.T1_sub-2.a')
+    writer(a1, 'start')
+    writer(a2, 'start')
+    values = _parse(metrics.format_metrics(writer.metrics(t=1.0)))
+    assert values['tnt_pipeline_2_subjects{state="running"}'] == 2
+    assert values['tnt_pipeline_2_subjects{state="pending"}'] == 1
+    assert values['tnt_pipeline_2_nodes{state="pending"}'] == 3
+    assert values['tnt_pipeline_2_processors{kind="reserved"}'] == 3
+    assert values['tnt_pipeline_2_processors{kind="available"}'] == 4
+    assert values['tnt_pipeline_2_memory_gb{kind="reserved"}'] == 1.5
+    assert math.isnan(values['tnt_pipeline_2_memory_gb{kind="available"}'])
+    assert math.isnan(values['tnt_pipeline_2_eta_seconds'])
+    writer(a1, 'end')
+    writer(b1, 'start')
+    # a map node subnode finishing does not complete the workflow
+    writer(_Node('_b0'), 'start')
+    writer(_Node('_b0'), 'end')
+    values = _parse(metrics.format_metrics(writer.metrics(t=2.0)))
+    assert values['tnt_pipeline_2_subjects{state="completed"}'] == 0
+    assert values['tnt_pipeline_2_nodes{state="completed"}'] == 1
+    writer(b1, 'end')
+    writer(a2, 'exception')
+    values = _parse(metrics.format_metrics(writer.metrics(t=1800.0)))
+    assert values['tnt_pipeline_2_subjects{state="completed"}'] == 1
+    assert values['tnt_pipeline_2_subjects{state="failed"}'] == 1
+    assert values['tnt_pipeline_2_subjects{state="pending"}'] == 1
+    assert values['tnt_pipeline_2_nodes{state="completed"}'] == 2
+    assert values['tnt_pipeline_2_nodes{state="failed"}'] == 1
+    assert values['tnt_pipeline_2_nodes{state="running"}'] == 0
+    assert values['tnt_pipeline_2_processors{kind="reserved"}'] == 0
+    assert values['tnt_pipeline_2_throughput_subjects_per_hour'] == 2
+    assert values['tnt_pipeline_2_eta_seconds'] == 1800
+
+
+def _identity(x):
+    return x
+
+
+def _fail(x):
+    raise RuntimeError(x)
+
+
+def test_metrics_workflow(tmp_path):
+    wf = pe.Workflow('participant', base_dir=str(tmp_path))
+    wf.config['execution']['crashdump_dir'] = str(tmp_path)
+    for subject, function in [('1', _identity), ('2', _fail)]:
+        sub = pe.Workflow(f'T1_sub-{subject}')
+        # identity nodes are not run, and iterables run twice
+        inputnode = pe.Node(IdentityInterface(fields=['x']), 'inputnode')
+        inputnode.iterables = [('x', [1, 2])]
+        a = pe.Node(Function(input_names=['x'], output_names=['out'], function=_identity), 'a')
+        b = pe.Node(Function(input_names=['x'], output_names=['out'], function=function), 'b')
+        m = pe.MapNode(Function(input_names=['x'], output_names=['out'], function=_identity),
+                       iterfield=['x'], name='m')
+        m.inputs.x = [1, 2, 3]
+        sub.connect([(inputnode, a, [('x', 'x')]), (a, b, [('out', 'x')])])
+        sub.add_nodes([m])
+        wf.add_nodes([sub])
+    nodes = metrics.subject_nodes(wf)
+    assert nodes['T1_sub-1'] == {'participant.T1_sub-1.a.a0', 'participant.T1_sub-1.a.a1',
+                                 'participant.T1_sub-1.b.a0', 'participant.T1_sub-1.b.a1',
+                                 'participant.T1_sub-1.m'}
+    out_file = tmp_path / 'm.prom'
+    with metrics.MetricsWriter(out_file, nodes, interval=0.01) as writer:
+        try:
+            utils.run_workflow(wf, 'MultiProc', {'status_callback': writer, 'n_procs': 2})
+        except RuntimeError:
+            pass
+    values = _parse(out_file.read_text())
+    assert values['tnt_pipeline_2_subjects{state="completed"}'] == 1
+    assert values['tnt_pipeline_2_subjects{state="failed"}'] == 1
+    assert values['tnt_pipeline_2_nodes{state="completed"}'] == 5 + 3
+    assert values['tnt_pipeline_2_eta_seconds'] == 0
+    assert [p.name for p in tmp_path.iterdir() if p.name.endswith('.tmp')] == []
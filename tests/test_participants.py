@@ -226,6 +226,18 @@ def test_io(input_dir,
     get_files([tmp_path], conf)
 
 
+def test_labels_linked(input_dir, tmp_path):
+    run(input_dir, tmp_path, debug_io=True, subcortical=True)
+    labelfiles = {}
+    for labelfile in tmp_path.glob('sub-*/**/*_labels.tsv'):
+        labelfiles.setdefault(labelfile.read_bytes(), []).append(labelfile)
+    # tissue, lobes, tissue+lobes, and subcortex
+    assert len(labelfiles) == 4
+    for files in labelfiles.values():
+        for labelfile in files[1:]:
+            assert labelfile.samefile(files[0])
+
+
 @pytest.mark.parametrize('icv', [False, True])
 @pytest.mark.parametrize('subcortical', [False, True])
 def test_debug_plugin(input_dir, tmp_path, subcortical, icv):
@@ -264,3 +276,72 @@ def test_crash(input_dir, tmp_path):
         assert crashpath.name == 'sub-1'
         assert contents[0].name == 'sub-1_acq-10_rec-11_run-12'
         assert len(list(contents[0].iterdir())) == 1
+
+
+def test_deduplicate(tmp_path, monkeypatch):
+    from TNT_pipeline_2 import participant
+    names = ['a.nii', 'b.nii', 'c.nii', 'd.nii']
+    for name, contents in zip(names, ['1', '2', '1', '1']):
+        (tmp_path / name).write_text(contents)
+    scans = [(str(tmp_path / name), {'subject': name[0]}) for name in names]
+    hash_file = tmp_path / 'logs' / 'T1_hashes.json'
+    hashes = participant.hash_scans([scan for scan, _ in scans], hash_file, n_proc=2)
+    assert hashes[0] == hashes[2] == hashes[3] != hashes[1]
+    kept, aliases = participant._deduplicate(scans, hashes)
+    assert kept == [scans[0], scans[1]]
+    assert aliases == {scans[0][0]: [{'subject': 'c'}, {'subject': 'd'}]}
+    # unchanged files are not hashed again
+    monkeypatch.setattr(participant, 'file_hash', None)
+    assert participant.hash_scans([scan for scan, _ in scans], hash_file) == hashes
+
+
+def _concat(prefix, value):
+    return f'{prefix}_{value}'
+
+
+def _pack(T1, nu, normalized, brain_mask):
+    return [T1, nu, normalized, brain_mask]
+
+
+def test_connect_sweep(tmp_path):
+    from types import SimpleNamespace
+    from nipype import Function, IdentityInterface
+    from nipype.pipeline import engine as pe
+    from TNT_pipeline_2 import core_workflows, participant
+    args = SimpleNamespace(bet_frac=[0.3, 0.5], bet_vertical_gradient=0.0,
+                           inormalize_const2=[[0.0, 5000.0], [0.0, 4000.0]])
+    fields = ['T1', 'nu', 'normalized', 'brain_mask']
+    # a stand-in for main_workflow, with the iterables of preproc_workflow
+    main_wf = pe.Workflow('main')
+    preproc = pe.Workflow('preproc')
+    outputspec = pe.Node(IdentityInterface(fields=fields), 'outputspec')
+    outputspec.inputs.T1 = 'T1'
+    outputspec.inputs.nu = 'nu'
+    inorm = pe.Node(Function(input_names=['prefix', 'value'], output_names=['out'], function=_concat),
+                    'inorm')
+    inorm.inputs.prefix = 'nu'
+    bet = pe.Node(Function(input_names=['prefix', 'value'], output_names=['out'], function=_concat),
+                  'bet')
+    preproc.connect([
+        (core_workflows._sweep_node(core_workflows.INORM_SWEEP, ['const2'],
+                                    [(v[1],) for v in args.inormalize_const2]),
+         inorm, [('const2', 'value')]),
+        (core_workflows._sweep_node(core_workflows.BET_SWEEP, ['frac'], [(v,) for v in args.bet_frac]),
+         bet, [('frac', 'value')]),
+        (inorm, bet, [('out', 'prefix')])])
+    main_wf.connect([(preproc, outputspec, [('inorm.out', 'normalized'), ('bet.out', 'brain_mask')])])
+    wf = pe.Workflow('T1_sub-1', base_dir=str(tmp_path))
+    io_out_wfs = []
+    for k in range(4):
+        io_out_wf = pe.Workflow(f'io_out{k}')
+        # identity nodes are removed from the graph which is run
+        io_out_wf.add_nodes([pe.Node(Function(input_names=fields, output_names=['out'], function=_pack),
+                                     'inputspec')])
+        io_out_wfs.append(io_out_wf)
+    participant._connect_sweep(wf, main_wf, io_out_wfs, fields, args)
+    results = {node.fullname.split('.')[1]: node.result.outputs.out
+               for node in wf.run().nodes() if node.name == 'inputspec'}
+    # the settings are in the order of sweep_settings
+    expected = [(const2, frac) for const2 in [5000.0, 4000.0] for frac in [0.3, 0.5]]
+    assert [results[f'io_out{k}'] for k in range(4)] == [
+        ['T1', 'nu', f'nu_{const2}', f'nu_{const2}_{frac}'] for const2, frac in expected]
@@ -0,0 +1,86 @@
+import os
+
+from nipype.interfaces.utility import IdentityInterface
+from nipype.pipeline import engine as pe
+
+from TNT_pipeline_2 import prefetch
+
+
+def test_fetch(tmp_path):
+    scratch = tmp_path / 'scratch'
+    (tmp_path / 'a').mkdir()
+    (tmp_path / 'b').mkdir()
+    (tmp_path / 'a' / 'T1w.nii.gz').write_text('a')
+    (tmp_path / 'b' / 'T1w.nii.gz').write_text('b')
+    a = prefetch.fetch(str(tmp_path / 'a' / 'T1w.nii.gz'), scratch)
+    b = prefetch.fetch(str(tmp_path / 'b' / 'T1w.nii.gz'), scratch)
+    assert a != b
+    assert os.path.basename(a) == 'T1w.nii.gz'
+    assert open(a).read() == 'a'
+    assert open(b).read() == 'b'
+    # an up-to-date copy is not copied again
+    inode = os.stat(a).st_ino
+    assert prefetch.fetch(str(tmp_path / 'a' / 'T1w.nii.gz'), scratch) == a
+    assert os.stat(a).st_ino == inode
+    (tmp_path / 'a' / 'T1w.nii.gz').write_text('aa')
+    prefetch.fetch(str(tmp_path / 'a' / 'T1w.nii.gz'), scratch)
+    assert open(a).read() == 'aa'
+
+
+def test_Prefetcher(tmp_path):
+    files = []
+    for i in range(5):
+        files.append(str(tmp_path / f'{i}.txt'))
+        (tmp_path / f'{i}.txt').write_text(str(i))
+    scratch = str(tmp_path / 'scratch')
+    wf = pe.Workflow('wf', base_dir=str(tmp_path))
+    nodes = [pe.Node(prefetch.Prefetch(in_file=f, scratch_dir=scratch), f'prefetch{i}',
+                     run_without_submitting=True, overwrite=True)
+             for i, f in enumerate(files)]
+    wf.add_nodes(nodes)
+    assert sorted(prefetch.prefetch_files(wf)) == files
+    with prefetch.Prefetcher(files, scratch, ahead=2, n_threads=1) as prefetcher:
+        prefetcher.schedule(1)
+        for future in prefetcher._futures:
+            future.result()
+        assert [os.path.exists(prefetch.local_path(scratch, f)) for f in files] == [True, True, False, False, False]
+        prefetcher(nodes[1], 'start')
+        assert len(prefetcher._futures) == 4
+        prefetcher._futures[-1].result()
+    assert os.path.exists(prefetch.local_path(scratch, files[3]))
+    assert not os.path.exists(prefetch.local_path(scratch, files[4]))
+    res = nodes[4].run()
+    assert res.outputs.out_file == prefetch.local_path(scratch, files[4])
+    assert open(res.outputs.out_file).read() == '4'
+
+
+def test_gate_prefetch(tmp_path):
+    files = []
+    for i in range(4):
+        files.append(str(tmp_path / f'{i}.txt'))
+        (tmp_path / f'{i}.txt').write_text(str(i))
+    scratch = str(tmp_path / 'scratch')
+    wf = pe.Workflow('participant', base_dir=str(tmp_path / 'work'))
+    gates = []
+    # T1s 0 and 1 are sessions of one workflow, 2 and 3 are separate workflows
+    session_wf = pe.Workflow('longitudinal')
+    for i, f in enumerate(files):
+        sub = session_wf if i < 2 else pe.Workflow(f'T1_{i}')
+        prefetch_node = pe.Node(prefetch.Prefetch(in_file=f, scratch_dir=scratch), f'prefetch{i}',
+                                run_without_submitting=True, overwrite=True)
+        read = pe.Node(IdentityInterface(fields=['T1']), f'read{i}')
+        sub.connect(prefetch_node, 'out_file', read, 'T1')
+        if i >= 2:
+            wf.add_nodes([sub])
+        gates.append((f'{sub.name}.prefetch{i}', f'{sub.name}.read{i}.T1'))
+    wf.add_nodes([session_wf])
+    prefetch.gate_prefetch(wf, gates, 1)
+    # each file is fetched once the previous file has been read
+    assert prefetch.prefetch_files(wf) == files
+    graph = wf._create_flat_graph()
+    edges = {(u.fullname, v.fullname) for u, v in graph.edges()}
+    assert ('participant.longitudinal.read0', 'participant.longitudinal.prefetch1') in edges
+    assert ('participant.longitudinal.read1', 'participant.T1_2.prefetch2') in edges
+    assert ('participant.T1_2.read2', 'participant.T1_3.prefetch3') in edges
+    wf.run(plugin='Linear')
+    assert all(os.path.exists(prefetch.local_path(scratch, f)) for f in files)
@@ -0,0 +1,43 @@
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+from TNT_pipeline_2 import profiler, utils
+
+
+pytestmark = pytest.mark.skipif(not os.path.isdir('/proc'), reason='requires /proc')
+
+
+def test_node_name():
+    assert profiler.node_name('/work/participant/T1_sub-1/main/bet', 'participant') == \
+        'participant.T1_sub-1.main.bet'
+    assert profiler.node_name('/work/participant/T1_sub-1/stats/mapflow/_stats0',
+                              'participant') == 'participant.T1_sub-1.stats'
+    assert profiler.node_name('/work/participant', 'participant') is None
+    assert profiler.node_name('/work/other', 'participant') is None
+
+
+def test_proc_profiler(tmp_path):
+    nodedir = tmp_path / 'participant' / 'T1_sub-1' / 'busy'
+    nodedir.mkdir(parents=True)
+    out_file = tmp_path / 'prof.ndjson'
+    script = ('import time\n'
+              't = time.time()\n'
+              'with open("out.bin", "wb") as f:\n'
+              '    while time.time() - t < 1.5:\n'
+              '        f.write(b"0" * 100000)\n')
+    with profiler.ProcProfiler(out_file, interval=0.2):
+        subprocess.run([sys.executable, '-c', script], cwd=str(nodedir), check=True)
+        time.sleep(0.3)
+    resources = utils.load_resources_file(out_file)
+    assert list(resources.keys()) == ['participant.T1_sub-1.busy']
+    busy = resources['participant.T1_sub-1.busy']
+    assert busy['cpumax'] > 10
+    assert busy['mem'] > 0
+    assert busy['time'] > 0.5
+    assert busy['write_GiB'] is not None
+    opt = utils.calc_opt_resources(resources)['nodes']['participant.busy']['max']
+    assert opt['write_GiB'] == busy['write_GiB']
@@ -0,0 +1,203 @@
+from pathlib import Path
+
+import pytest
+
+from TNT_pipeline_2 import qc
+
+
+def test_page_filename():
+    conf = qc.make_config('test', False, None, False)
+    template = conf['page_filename_template']
+    assert qc.page_filename(template, {'subject': '1'}) == 'sub-1_QC.html'
+    assert (qc.page_filename(template, {'subject': '1', 'session': '2', 'run': '1'})
+            == 'sub-1_ses-2_run-1_QC.html')
+
+
+def _touch(fname, contents='a'):
+    fname.parent.mkdir(parents=True, exist_ok=True)
+    fname.write_text(contents)
+
+
+def _qc_all(calls):
+    """Stands in for qc_all, recording the subjects and reportlet types of
+    each call, and listing its pages in its index. The figures of every page
+    are in one directory"""
+    def qc_all(dirs, output_dir, conf, **kwargs):
+        subjects = conf['files']['T1']['filter'].get(
+            'subject', sorted(p.name[4:] for p in Path(dirs[0]).glob('sub-*')))
+        reportlets = [r['type'] for r in conf['reportlets']]
+        calls.append((subjects, reportlets))
+        output_dir.mkdir(parents=True)
+        pages = [f'sub-{sub}_QC.html' for sub in subjects]
+        for page in pages:
+            (output_dir / page).write_text(' '.join(reportlets))
+            _touch(output_dir / 'figures' / f'{page}.png')
+        (output_dir / 'index.html').write_text(' '.join(pages))
+    return qc_all
+
+
+def test_incremental_qc(tmp_path, monkeypatch):
+    import PipelineQC.main
+    calls = []
+    monkeypatch.setattr(PipelineQC.main, 'qc_all', _qc_all(calls))
+    conf = qc.make_config('test', False, None, False)
+    _touch(tmp_path / 'sub-1' / 'anat' / 'sub-1_T1w.nii')
+    _touch(tmp_path / 'sub-2' / 'anat' / 'sub-2_T1w.nii')
+    _touch(tmp_path / 'sub-2' / 'logs' / 'crash' / 'crash-node.txt')
+    _touch(tmp_path / 'group' / 'group.tsv')
+    qcdir = tmp_path / 'QC'
+    reportlets = [r['type'] for r in conf['reportlets']]
+    assert sorted(qc.incremental_qc(tmp_path, qcdir, conf)) == ['sub-1_QC.html', 'sub-2_QC.html']
+    # every page was rebuilt, so the index of that run is kept
+    assert calls == [(['1', '2'], reportlets)]
+    assert (qcdir / 'index.html').read_text() == 'sub-1_QC.html sub-2_QC.html'
+    assert qc.incremental_qc(tmp_path, qcdir, conf) == []
+    # the index is created by qc_all with the reportlets which do not read images
+    assert calls[1:] == [(['1', '2'], ['crash', 'rating'])]
+    _touch(tmp_path / 'sub-3' / 'anat' / 'sub-3_T1w.nii')
+    _touch(tmp_path / 'sub-2' / 'logs' / 'crash' / 'crash-node2.txt')
+    assert sorted(qc.incremental_qc(tmp_path, qcdir, conf)) == ['sub-2_QC.html', 'sub-3_QC.html']
+    assert calls[2:] == [(['2', '3'], reportlets), (['1', '2', '3'], ['crash', 'rating'])]
+    assert (qcdir / 'index.html').read_text() == 'sub-1_QC.html sub-2_QC.html sub-3_QC.html'
+    for sub in ['1', '2', '3']:
+        assert (qcdir / f'sub-{sub}_QC.html').read_text() == ' '.join(reportlets)
+    assert not (qcdir / '.incremental').exists()
+    assert not (qcdir / '.index').exists()
+
+
+def test_find_page_files(tmp_path):
+    from TNT_pipeline_2.output import SWEEP_DIR
+    _touch(tmp_path / 'sub-1' / 'anat' / 'sub-1_T1w.nii')
+    _touch(tmp_path / 'QC' / 'sub-1_QC.html')
+    _touch(tmp_path / 'group' / 'sub-1_stats.tsv')
+    _touch(tmp_path / SWEEP_DIR / 'frac-0.3_vg-0_const2-0-5000' / 'sub-1' / 'anat' / 'sub-1_T1w.nii')
+    _touch(tmp_path / SWEEP_DIR / 'frac-0.3_vg-0_const2-0-5000' / 'sub-2' / 'anat' / 'sub-2_T1w.nii')
+    pages = qc.find_page_files(tmp_path, ['subject', 'session'])
+    assert list(pages) == [('1', None)]
+    assert list(pages[('1', None)]) == [str(Path('sub-1', 'anat', 'sub-1_T1w.nii'))]
+
+
+def test_render_reportlets(tmp_path):
+    pytest.importorskip('matplotlib')
+    import nibabel
+    import numpy as np
+    from TNT_pipeline_2 import snapshots
+
+    conf = qc.make_config('test', False, None, False)
+    shape = (12, 14, 10)
+    data = np.random.RandomState(0).rand(*shape)
+    labels = np.zeros(shape, dtype=np.int16)
+    labels[3:9, 4:10, 2:8] = 1
+    labels[5:7, 6:8, 4:6] = 2
+    files = {}
+    for name in snapshots.reportlet_inputs(conf['reportlets']):
+        files[name] = str(tmp_path / f'{name}.nii.gz')
+        img = labels if name in ('brain_mask', 'classified', 'transformed_atlas',
+                                 'transformed_model_brain_mask') else data
+        nibabel.Nifti1Image(img, np.eye(4)).to_filename(files[name])
+    out_files = snapshots.render_reportlets(conf['reportlets'], files, tmp_path / 'snapshots')
+    # three compare and three contour reportlets, and one overlay reportlet,
+    # with a full resolution image and a preview of each snapshot
+    assert len(out_files) == 20
+    assert [Path(f).stem for f in out_files] == list(snapshots.snapshot_outputinfo(conf['reportlets']))
+    for out_file in out_files:
+        with open(out_file, 'rb') as f:
+            assert f.read(8) == b'\x89PNG\r\n\x1a\n'
+    from matplotlib.image import imread
+    for full, preview in zip(out_files[::2], out_files[1::2]):
+        assert Path(preview).stem == Path(full).stem + snapshots.PREVIEW
+        assert imread(preview).shape[0] < imread(full).shape[0]
+        assert Path(preview).stat().st_size < Path(full).stat().st_size
+
+
+def test_snapshot_config():
+    from TNT_pipeline_2 import snapshots
+
+    conf = qc.make_config('test', False, None, False)
+    snapconf = snapshots.snapshot_config(conf)
+    types = [r['type'] for r in snapconf['reportlets']]
+    assert types.count(snapshots.SNAPSHOT_REPORTLET) == 10
+    assert types.count('distributions') == 1
+    assert not set(types) & set(snapshots.IMAGE_REPORTLETS)
+    assert snapconf['reportlets'][:2] == [
+        {'type': 'image', 'name': 'T1 weighted input',
+         'image': 'snapshot00image1preview', 'link': 'snapshot00image1'},
+        {'type': 'image', 'name': 'Non-uniformity corrected brain',
+         'image': 'snapshot00image2preview', 'link': 'snapshot00image2'}]
+    for reportlet in snapconf['reportlets']:
+        if reportlet['type'] == snapshots.SNAPSHOT_REPORTLET:
+            assert snapconf['files'][reportlet['image']]['filter']['extension'] == 'png'
+            assert snapconf['files'][reportlet['link']]['filter']['desc'] == \
+                snapconf['files'][reportlet['image']]['filter']['desc'][:-len(snapshots.PREVIEW)]
+    # the images are found with the page files
+    assert qc._path_entities(Path('sub-1/ses-2/anat/sub-1_ses-2_desc-qc00image1_T1w.png')) == {
+        'subject': '1', 'session': '2'}
+    assert snapshots.snapshot_config(snapconf) == snapconf
+    assert conf == qc.make_config('test', False, None, False)
+
+
+def test_parse_shard():
+    assert qc.parse_shard('0/1') == (0, 1)
+    assert qc.parse_shard('3/8') == (3, 8)
+    for bad in ['1/1', '-1/2', '1', 'a/b', '0/0']:
+        with pytest.raises(ValueError):
+            qc.parse_shard(bad)
+
+
+def test_sharded_qc(tmp_path, monkeypatch):
+    import PipelineQC.main
+    calls = []
+    monkeypatch.setattr(PipelineQC.main, 'qc_all', _qc_all(calls))
+    conf = qc.make_config('test', False, None, False)
+    subjects = [str(i) for i in range(20)]
+    for sub in subjects:
+        _touch(tmp_path / f'sub-{sub}' / 'anat' / f'sub-{sub}_T1w.nii')
+    qcdir = tmp_path / 'QC'
+    allpages = []
+    for index in range(3):
+        pages = qc.sharded_qc(tmp_path, qcdir, conf, (index, 3))
+        assert not set(pages) & set(allpages)
+        allpages.extend(pages)
+        if index < 2:
+            with pytest.raises(RuntimeError):
+                qc.merge_shards(qcdir, conf)
+    assert sorted(allpages) == sorted(f'sub-{sub}_QC.html' for sub in subjects)
+    ncalls = len(calls)
+    assert qc.merge_shards(qcdir, conf) == sorted(allpages)
+    # the index is created from the manifests alone
+    assert len(calls) == ncalls
+    index = (qcdir / 'index.html').read_text()
+    for sub in subjects:
+        assert f'<td>{sub}</td><td><a href="sub-{sub}_QC.html">sub-{sub}_QC.html</a></td>' in index
+    assert '<th>subject</th><th>page</th>' in index
+    for page in allpages:
+        assert (qcdir / page).exists()
+        assert (qcdir / 'figures' / f'{page}.png').exists()
+    assert not list(qcdir.glob('.shard-*'))
+    # the manifests of an earlier sharding are removed by the first shard
+    pages = qc.sharded_qc(tmp_path, qcdir, conf, (1, 2))
+    assert sorted(p.name for p in (qcdir / 'shards').iterdir()) == ['shard-1-of-2.json']
+    with pytest.raises(RuntimeError, match=r'shards \[0\] of 2'):
+        qc.merge_shards(qcdir, conf)
+    pages.extend(qc.sharded_qc(tmp_path, qcdir, conf, (0, 2)))
+    assert qc.merge_shards(qcdir, conf) == sorted(allpages) == sorted(pages)
+
+
+def test_shard_locked(tmp_path, monkeypatch):
+    import threading
+    import PipelineQC.main
+    calls = []
+    monkeypatch.setattr(PipelineQC.main, 'qc_all', _qc_all(calls))
+    conf = qc.make_config('test', False, None, False)
+    _touch(tmp_path / 'sub-1' / 'anat' / 'sub-1_T1w.nii')
+    qcdir = tmp_path / 'QC'
+    qcdir.mkdir()
+    thread = threading.Thread(target=qc.sharded_qc, args=(tmp_path, qcdir, conf, (0, 1)))
+    with qc._locked(qcdir):
+        thread.start()
+        thread.join(1.0)
+        # the pages are not moved while another process holds the lock
+        assert thread.is_alive()
+        assert not (qcdir / 'sub-1_QC.html').exists()
+    thread.join()
+    assert (qcdir / 'sub-1_QC.html').exists()
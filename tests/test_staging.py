@@ -0,0 +1,141 @@
+import gzip
+import os
+import subprocess
+import sys
+
+from nipype.interfaces.base import (BaseInterfaceInputSpec, TraitedSpec, SimpleInterface,
+                                    File, traits)
+from nipype.pipeline import engine as pe
+
+from TNT_pipeline_2 import staging
+
+
+LINKS = []
+
+
+class _WriteInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True)
+    size = traits.Int(mandatory=True)
+
+
+class _WriteOutputSpec(TraitedSpec):
+    out_file = File(exists=True)
+
+
+class _Write(SimpleInterface):
+    """Write size bytes after recording whether in_file is staged"""
+    input_spec = _WriteInputSpec
+    output_spec = _WriteOutputSpec
+
+    def _run_interface(self, runtime):
+        LINKS.append(os.path.islink(self.inputs.in_file))
+        self._results['out_file'] = os.path.join(os.getcwd(), 'out.txt')
+        with open(self._results['out_file'], 'w') as f:
+            f.write('x' * self.inputs.size)
+        return runtime
+
+
+def _run(tmp_path, size, budget=1000, max_file_size=100, plugin='Linear'):
+    (tmp_path / 'in.txt').write_text('in')
+    sub = pe.Workflow('to_mnc')
+    convert = pe.Node(_Write(in_file=str(tmp_path / 'in.txt'), size=size), 'convert')
+    sub.add_nodes([convert])
+    wf = pe.Workflow('wf', base_dir=str(tmp_path / 'work'))
+    read = pe.Node(_Write(size=1), 'read')
+    wf.connect(sub, 'convert.out_file', read, 'in_file')
+    tier = staging.StagingTier(tmp_path / 'shm', budget, max_file_size)
+    assert staging.stage_workflow(wf, tier) == 1
+    del LINKS[:]
+    with tier:
+        wf.run(plugin=plugin, plugin_args={'status_callback': tier})
+    assert not tier.run_dir.exists()
+    node_dir = tmp_path / 'work' / 'wf' / 'to_mnc' / 'convert'
+    assert not (node_dir / 'out.txt').is_symlink()
+    assert (node_dir / 'out.txt').read_text() == 'x' * size
+    return LINKS[1] if LINKS else None
+
+
+def test_staging(tmp_path):
+    assert _run(tmp_path, 10)
+
+
+def test_staging_large_file(tmp_path):
+    assert not _run(tmp_path, 200)
+
+
+def test_staging_budget(tmp_path):
+    assert not _run(tmp_path, 10, budget=0)
+
+
+def test_staging_multiproc(tmp_path):
+    # the staged node runs in a worker process
+    _run(tmp_path, 10, plugin='MultiProc')
+
+
+def test_reserve(tmp_path):
+    tier = staging.StagingTier(tmp_path / 'shm', 100, 50)
+    with tier:
+        assert tier.stage(60) is None
+        stage = tier.stage(40)
+        assert stage is not None
+        assert tier.stage(40) is not None
+        # the reservations are used
+        assert tier.stage(40) is None
+        (stage / 'out.txt').write_text('x' * 10)
+        (tmp_path / 'node').mkdir()
+        tier.keep(stage, str(tmp_path / 'node'), {'out_file': str(stage / 'out.txt')})
+        assert (tmp_path / 'node' / 'out.txt').is_symlink()
+        # the reservation is replaced by the size of the file
+        assert tier.stage(40) is not None
+    assert (tmp_path / 'node' / 'out.txt').read_text() == 'x' * 10
+
+
+def test_uncompressed_size(tmp_path):
+    with gzip.open(str(tmp_path / 'a.nii.gz'), 'wb') as f:
+        f.write(b'\0' * 1000)
+    assert staging._uncompressed_size(str(tmp_path / 'a.nii.gz')) == 1000
+
+
+def _dead_owner():
+    proc = subprocess.Popen([sys.executable, '-c', ''])
+    proc.wait()
+    return f'{staging.socket.gethostname()} {proc.pid}'
+
+
+def test_killed_run(tmp_path):
+    # a killed run left a staged file, linked from its node directory
+    root = tmp_path / 'shm' / 'tnt_pipeline_2'
+    stage = root / 'killed' / 'stage'
+    stage.mkdir(parents=True)
+    (root / 'killed' / staging.OWNER_FILE).write_text(_dead_owner())
+    (stage / 'out.txt').write_text('out')
+    node_dir = tmp_path / 'node'
+    node_dir.mkdir()
+    (stage / staging.NODE_DIR_FILE).write_text(str(node_dir))
+    os.symlink(str(stage / 'out.txt'), str(node_dir / 'out.txt'))
+    # a running run
+    (root / 'running').mkdir()
+    (root / 'running' / staging.OWNER_FILE).write_text(staging._owner())
+    with staging.StagingTier(tmp_path / 'shm', 100, 100):
+        names = [p.name for p in root.iterdir() if p.is_dir()]
+        assert 'killed' not in names and 'running' in names
+    assert not (node_dir / 'out.txt').is_symlink()
+    assert (node_dir / 'out.txt').read_text() == 'out'
+
+
+def test_journal(tmp_path):
+    # a killed run whose staged files were lost
+    node_dir = tmp_path / 'node'
+    node_dir.mkdir()
+    (node_dir / '_0x1234.json').write_text('{}')
+    (node_dir / 'result_node.pklz').write_text('')
+    lost = tmp_path / 'shm' / 'tnt_pipeline_2' / 'killed'
+    os.symlink(str(lost / 'stage' / 'out.txt'), str(node_dir / 'out.txt'))
+    journal_dir = tmp_path / 'journal'
+    journal_dir.mkdir()
+    (journal_dir / 'killed.txt').write_text(f'{_dead_owner()} {lost}\n{node_dir}\n')
+    with staging.StagingTier(tmp_path / 'shm', 100, 100, journal_dir=journal_dir) as tier:
+        assert [p.name for p in journal_dir.iterdir()] == [tier.journal.name]
+    # the node is run again
+    assert sorted(p.name for p in node_dir.iterdir()) == ['result_node.pklz']
+    assert list(journal_dir.iterdir()) == []
@@ -0,0 +1,94 @@
+import csv
+
+import numpy as np
+import pytest
+
+from TNT_pipeline_2 import summary
+
+
+def _read(fname):
+    with open(fname, 'r', newline='') as f:
+        return list(csv.DictReader(f, delimiter='\t'))
+
+
+def test_robust_zscores():
+    values = np.array([[1.0, 5.0, 2.0],
+                       [2.0, 5.0, np.nan],
+                       [3.0, 5.0, 2.0],
+                       [4.0, 5.0, 2.0],
+                       [100.0, 5.0, 3.0]])
+    median, scale, z = summary.robust_zscores(values)
+    assert median.tolist() == [3.0, 5.0, 2.0]
+    assert scale[0] == pytest.approx(summary.MAD_SCALE)
+    # zero MAD falls back to the mean absolute deviation
+    assert scale[2] == pytest.approx(summary.MEANAD_SCALE * 0.25)
+    assert z[4, 0] == pytest.approx(97 / summary.MAD_SCALE)
+    assert np.all(z[:, 1] == 0)
+    assert np.isnan(z[1, 2])
+
+
+def test_write_summary(tmp_path):
+    group = tmp_path / 'group.tsv'
+    with open(group, 'w', newline='') as f:
+        f.write('subject\tsession\ta_volume\tb_volume\n')
+        f.write('01\tn/a\t10\t1\n')
+        f.write('02\tn/a\t11\tn/a\n')
+        f.write('03\tn/a\t12\t1\n')
+        f.write('04\tn/a\t50\t1\n')
+        f.write('05\tn/a\tn/a\tn/a\n')
+    summary.write_summary(group, tmp_path / 'summary.tsv', tmp_path / 'outliers.tsv',
+                          ['subject', 'session'])
+    rows = _read(tmp_path / 'summary.tsv')
+    assert [row['column'] for row in rows] == ['a_volume', 'b_volume']
+    assert rows[0]['n'] == '4'
+    assert float(rows[0]['mean']) == pytest.approx(20.75)
+    assert float(rows[0]['median']) == pytest.approx(11.5)
+    assert rows[1]['sd'] == '0'
+    outliers = _read(tmp_path / 'outliers.tsv')
+    assert [row['subject'] for row in outliers] == ['04', '01', '02', '03', '05']
+    assert outliers[0]['n_outliers'] == '1'
+    assert outliers[0]['worst_column'] == 'a_volume'
+    assert float(outliers[0]['worst_zscore']) > 3.5
+    assert outliers[-1]['outlier_score'] == 'n/a'
+    assert outliers[-1]['worst_column'] == 'n/a'
+
+
+def test_load_parquet(tmp_path):
+    pa = pytest.importorskip('pyarrow')
+    import pyarrow.parquet as pq
+    table = pa.Table.from_arrays(
+        [pa.array(['01', '01', '02'], type=pa.string()),
+         pa.array(['brain', 'brain', 'brain'], type=pa.string()),
+         pa.array([1, 2, 1], type=pa.int64()),
+         pa.array(['GM', 'WM', 'GM'], type=pa.string()),
+         pa.array([1.0, 2.0, 3.0], type=pa.float64())],
+        names=['subject', 'desc', 'index', 'name', 'volume'])
+    pq.write_table(table, str(tmp_path / 'group.parquet'))
+    idcols, columns, ids, values = summary.load_parquet(tmp_path / 'group.parquet')
+    assert idcols == ['subject']
+    assert columns == ['brain_GM_volume', 'brain_WM_volume']
+    assert ids == [('01',), ('02',)]
+    np.testing.assert_array_equal(values, [[1.0, 2.0], [3.0, np.nan]])
+
+
+def test_load_parquet_order(tmp_path):
+    pa = pytest.importorskip('pyarrow')
+    import pyarrow.parquet as pq
+    table = pa.Table.from_arrays(
+        [pa.array(['02', '01', '02', '01', '02'], type=pa.string()),
+         pa.array(['b', None, None, None, 'b'], type=pa.string()),
+         pa.array(['brain', 'brain', 'brain', 'lobes', 'lobes'], type=pa.string()),
+         pa.array(['WM', 'GM', 'GM', 'L', 'L'], type=pa.string()),
+         pa.array([1.0, 2.0, 3.0, None, 5.0], type=pa.float64()),
+         pa.array([6.0, 7.0, 8.0, 9.0, 10.0], type=pa.float64())],
+        names=['subject', 'session', 'desc', 'name', 'volume', 'mean'])
+    pq.write_table(table, str(tmp_path / 'group.parquet'), row_group_size=2)
+    idcols, columns, ids, values = summary.load_parquet(tmp_path / 'group.parquet')
+    # rows and labels are in order of first appearance, missing ids are n/a
+    assert idcols == ['subject', 'session']
+    assert ids == [('02', 'b'), ('01', 'n/a'), ('02', 'n/a')]
+    assert columns == ['brain_WM_volume', 'brain_WM_mean', 'brain_GM_volume', 'brain_GM_mean',
+                       'lobes_L_volume', 'lobes_L_mean']
+    np.testing.assert_array_equal(values, [[1.0, 6.0, np.nan, np.nan, 5.0, 10.0],
+                                           [np.nan, np.nan, 2.0, 7.0, np.nan, 9.0],
+                                           [np.nan, np.nan, 3.0, 8.0, np.nan, np.nan]])
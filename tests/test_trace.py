@@ -0,0 +1,123 @@
+import json
+
+import pytest
+
+from nipype.interfaces.utility import Function
+from nipype.pipeline import engine as pe
+
+from TNT_pipeline_2 import trace, utils
+
+
+def test_subject_workflow():
+    assert trace.subject_workflow('participant.T1_sub-1.main.bet') == 'T1_sub-1'
+    assert trace.subject_workflow('group.merge') == 'group'
+
+
+def _slices(data):
+    return [e for e in data['traceEvents'] if e['ph'] == 'X']
+
+
+def test_trace_recorder(tmp_path):
+    out_file = tmp_path / 'trace.json'
+    recorder = trace.TraceRecorder(out_file, n_procs=4)
+    recorder.start('participant.T1_sub-1.a', n_procs=2, mem_gb=1.0, t=0.0)
+    recorder.start('participant.T1_sub-1.b', n_procs=1, mem_gb=2.0, t=1.0)
+    recorder.start('participant.T1_sub-2.a', n_procs=1, mem_gb=2.0, t=1.0)
+    recorder.end('participant.T1_sub-1.a', t=2.0)
+    recorder.start('participant.T1_sub-1.c', t=2.0)
+    recorder.end('participant.T1_sub-1.b', status='exception', t=3.0)
+    recorder.end('participant.T1_sub-2.a', t=3.0)
+    recorder.write()
+    with open(out_file, 'r') as f:
+        data = json.load(f)
+    names = {e['pid']: e['args']['name'] for e in data['traceEvents'] if e['ph'] == 'M'}
+    slices = {(names[e['pid']], e['name']): e for e in _slices(data)}
+    assert set(slices) == {('T1_sub-1', 'T1_sub-1.a'), ('T1_sub-1', 'T1_sub-1.b'),
+                           ('T1_sub-2', 'T1_sub-2.a')}
+    assert slices[('T1_sub-1', 'T1_sub-1.a')]['dur'] == 2e6
+    assert slices[('T1_sub-1', 'T1_sub-1.b')]['tid'] == 1
+    assert slices[('T1_sub-1', 'T1_sub-1.b')]['cat'] == 'exception'
+    assert slices[('T1_sub-2', 'T1_sub-2.a')]['tid'] == 0
+    assert slices[('T1_sub-2', 'T1_sub-2.a')]['args']['slot'] == 2
+    # c reuses the lane of a and is still running
+    running = [e for e in data['traceEvents'] if e['ph'] == 'B']
+    assert [(e['name'], e['tid']) for e in running] == [('T1_sub-1.c', 0)]
+    idle = [(e['ts'], e['args']['processors']) for e in data['traceEvents']
+            if e['name'] == 'idle_processors']
+    assert idle == [(0.0, 2), (1e6, 1), (1e6, 0), (2e6, 2), (2e6, 1), (3e6, 2), (3e6, 3)]
+
+
+def _wait(x):
+    return x
+
+
+def test_trace_workflow(tmp_path):
+    wf = pe.Workflow('participant', base_dir=str(tmp_path))
+    for subject in ['1', '2']:
+        sub = pe.Workflow(f'T1_sub-{subject}')
+        a = pe.Node(Function(input_names=['x'], output_names=['out'], function=_wait), 'a')
+        a.inputs.x = 1
+        b = pe.Node(Function(input_names=['x'], output_names=['out'], function=_wait), 'b')
+        sub.connect(a, 'out', b, 'x')
+        wf.add_nodes([sub])
+    called = []
+    out_file = tmp_path / 'trace.json'
+    with trace.TraceRecorder(out_file) as recorder:
+        callback = utils.chain_callbacks(None, recorder, lambda node, status: called.append(status))
+        wf.run(plugin='Linear', plugin_args={'status_callback': callback})
+    assert called.count('start') == 4
+    with open(out_file, 'r') as f:
+        slices = _slices(json.load(f))
+    assert sorted(e['args']['node'] for e in slices) == [
+        'participant.T1_sub-1.a', 'participant.T1_sub-1.b',
+        'participant.T1_sub-2.a', 'participant.T1_sub-2.b']
+
+
+class _Unpicklable(utils.StatusCallback):
+    def __init__(self):
+        self.called = []
+
+    def __call__(self, node, status):
+        self.called.append(status)
+
+    def __reduce__(self):
+        raise TypeError('callbacks must not be pickled')
+
+
+def test_trace_map_node(tmp_path):
+    # nipype copies and pickles the plugin arguments kept on map nodes
+    wf = pe.Workflow('participant', base_dir=str(tmp_path))
+    sub = pe.Workflow('T1_sub-1')
+    m = pe.MapNode(Function(input_names=['x'], output_names=['out'], function=_wait),
+                   iterfield=['x'], name='m')
+    m.inputs.x = [1, 2]
+    sub.add_nodes([m])
+    wf.add_nodes([sub])
+    unpicklable = _Unpicklable()
+    with trace.TraceRecorder(tmp_path / 'trace.json') as recorder:
+        callback = utils.chain_callbacks(recorder, unpicklable)
+        execgraph = utils.run_workflow(wf, 'MultiProc', {'status_callback': callback, 'n_procs': 2})
+    assert unpicklable.called.count('end') == 3
+    node, = execgraph.nodes()
+    assert node.use_plugin[1] == {'n_procs': 2}
+
+
+def test_StatusCallback():
+    with pytest.raises(TypeError):
+        utils.StatusCallback()
+
+
+def test_trace_from_resources(tmp_path):
+    resources = {'participant.T1_sub-1.a': {'cpumax': 250.0, 'mem': 1.0, 'start': 10.0, 'end': 20.0},
+                 'participant.T1_sub-1.b': {'cpumax': None, 'mem': 1.0, 'start': 25.0, 'end': 25.0},
+                 'participant.T1_sub-2.a': {'cpumax': 90.0, 'mem': 1.0, 'start': 20.0, 'end': 30.0}}
+    out_file = tmp_path / 'trace.json'
+    trace.trace_from_resources(resources, out_file)
+    with open(out_file, 'r') as f:
+        slices = {e['args']['node']: e for e in _slices(json.load(f))}
+    assert slices['participant.T1_sub-1.a']['args']['n_procs'] == 3
+    assert slices['participant.T1_sub-1.a']['dur'] == 10e6
+    assert slices['participant.T1_sub-1.b']['dur'] == 0
+    assert slices['participant.T1_sub-2.a']['ts'] == 10e6
+    assert slices['participant.T1_sub-2.a']['args']['slot'] == 0
+    assert slices['participant.T1_sub-1.b']['args']['slot'] == 1
@@ -1,3 +1,8 @@
+import io
+from itertools import chain
+import json
+
+import numpy as np
 from pndniworkflows.utils import write_labels
 import pytest
 
@@ -62,3 +67,169 @@ def test_get_label_file(tmp_path):
     labelfile.write_text('test')
     out = utils.Labels._get_label_file(testfile, 'teststr')
     assert labelfile == out
+
+
+def _naive_resources(samples, mininterval=0.1):
+    out = {}
+    for name in {s['name'] for s in samples}:
+        node = [s for s in samples if s['name'] == name]
+        times = np.array([s['time'] for s in node])
+        cpus = np.array([s['cpus'] for s in node])
+        inds = np.diff(times) > mininterval
+        out[name] = {'n': len(node),
+                     'cpumax': float(np.max(cpus[1:][inds])) if np.any(inds) else None,
+                     'mem': max(s['rss_GiB'] for s in node),
+                     'time': times[-1] - times[0],
+                     'start': times[0],
+                     'end': times[-1]}
+    return out
+
+
+@pytest.fixture
+def samples():
+    rng = np.random.RandomState(0)
+    samples = []
+    t = 0.0
+    for node in ['participant.T1_sub-1.a', 'participant.T1_sub-2.a', 'participant.b', 'short']:
+        n = 1 if node == 'short' else 200
+        for _ in range(n):
+            t += rng.choice([0.05, 0.5, 1.0])
+            samples.append({'time': t, 'name': node, 'interface': 'Interface',
+                            'rss_GiB': float(rng.rand()), 'vms_GiB': 1.0,
+                            'cpus': float(rng.rand() * 400), 'mapnode': 0, 'params': 'n/a'})
+    return samples
+
+
+@pytest.mark.parametrize('fmt', ['columnar', 'ndjson'])
+def test_load_resources_file(tmp_path, samples, fmt):
+    fname = tmp_path / 'profile.json'
+    with open(fname, 'w') as f:
+        if fmt == 'columnar':
+            json.dump({k: [s[k] for s in samples] for k in samples[0]}, f)
+        else:
+            # interleave the samples of different nodes
+            for s in sorted(samples, key=lambda s: s['time'] % 7):
+                f.write(json.dumps(s) + '\n')
+    # a small chunk size splits values across chunks
+    out = utils.load_resources_file(fname, chunk_size=7)
+    expected = _naive_resources(samples)
+    assert out.keys() == expected.keys()
+    for name in expected:
+        for k in ['n', 'cpumax', 'mem', 'time', 'start', 'end']:
+            assert out[name][k] == pytest.approx(expected[name][k])
+    opt = utils.calc_opt_resources(out)['nodes']
+    assert opt['participant.a']['max']['mem'] == max(expected['participant.T1_sub-1.a']['mem'],
+                                                     expected['participant.T1_sub-2.a']['mem'])
+    assert opt['short']['max']['ncpu'] == 1
+
+
+def test_read_ndjson_order(tmp_path):
+    # the samples of a node are written out of order
+    samples = [(0.0, 10.0), (0.3, 50.0), (0.2, 300.0), (1.5, 20.0), (1.0, 40.0)]
+    lines = [json.dumps({'name': 'a', 'time': t, 'cpus': c, 'rss_GiB': 1.0}) + '\n'
+             for t, c in samples]
+    for chunk_lines in [2, 10]:
+        stats = utils.ResourceStats()
+        utils._read_ndjson(io.StringIO(''.join(lines)), stats, chunk_lines=chunk_lines)
+        out = stats.to_dict()['a']
+        assert out['start'] == 0.0
+        assert out['end'] == 1.5
+        assert out['time'] == 1.5
+    # in order, the sample at 0.3 is only 0.1 s after the previous one
+    assert out['cpumax'] == 300.0
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 1 << 20])
+def test_json_stream(chunk_size):
+    values = [12345, -1.5e-7, 'a,]"b', [1, [2, {'c': ', '}]], None, True, 1e300]
+    text = ' [ ' + ' ,\n'.join(json.dumps(v) for v in values) + ' ] '
+    stream = utils._JSONStream(io.StringIO(text), chunk_size=chunk_size)
+    assert list(chain.from_iterable(stream.array())) == values
+    for text in [text, '[]', '[1]', '[1.5, -2e3,\n3 ]', '["a,]", 1, 2, null, "b"]']:
+        stream = utils._JSONStream(io.StringIO(text), chunk_size=chunk_size)
+        assert stream.count_array() == len(json.loads(text))
+    for bad in ['[1 2]', '[1,]', '[1', '["a]']:
+        stream = utils._JSONStream(io.StringIO(bad), chunk_size=chunk_size)
+        with pytest.raises(ValueError):
+            list(stream.array())
+
+
+def test_read_columnar(tmp_path, samples):
+    fname = tmp_path / 'profile.json'
+    with open(fname, 'w') as f:
+        json.dump({k: [s[k] for s in samples] for k in samples[0]}, f)
+    expected = _naive_resources(samples)
+    # the samples of a node are split between updates
+    for max_samples in [1, 7, 1 << 16]:
+        stats = utils.ResourceStats()
+        utils._read_columnar(fname, stats, chunk_size=5, max_samples=max_samples)
+        out = stats.to_dict()
+        assert out.keys() == expected.keys()
+        for name in expected:
+            for k in ['n', 'cpumax', 'mem', 'time', 'start', 'end']:
+                assert out[name][k] == pytest.approx(expected[name][k])
+
+
+def test_load_resources_file_length(tmp_path, samples):
+    fname = tmp_path / 'profile.json'
+    columns = {k: [s[k] for s in samples] for k in samples[0]}
+    columns['cpus'].pop()
+    with open(fname, 'w') as f:
+        json.dump(columns, f)
+    with pytest.raises(RuntimeError):
+        utils.load_resources_file(fname)
+
+
+def _instance(cpumax, mem, time=10.0):
+    return {'n': 10, 'cpumax': cpumax, 'mem': mem, 'time': time}
+
+
+def test_calc_opt_resources():
+    runs = [{'participant.T1_sub-{}.a'.format(i): _instance(100.0 * i, float(i)) for i in range(1, 11)},
+            {'participant.T1_sub-1.a': _instance(2000.0, 100.0),
+             'participant.b': _instance(None, 1.0),
+             'participant.c': _instance(350.0, 1.0, time=0.5)}]
+    out = utils.calc_opt_resources(runs, statistics=['p50', 'max'], statistic='p50')
+    assert out['statistic'] == 'p50'
+    assert out['statistics'] == ['p50', 'max']
+    a = out['nodes']['participant.a']
+    assert a['n'] == 11
+    io = {'read_GiB': None, 'write_GiB': None}
+    assert a['max'] == {'ncpu': 20, 'cpumax': 2000.0, 'mem': 100.0, 'time': 10.0, **io}
+    assert a['p50'] == {'ncpu': 6, 'cpumax': 600.0, 'mem': 6.0, 'time': 10.0, **io}
+    assert out['nodes']['participant.b']['max']['ncpu'] == 1
+    assert out['nodes']['participant.b']['max']['cpumax'] is None
+    # too short to estimate
+    assert out['nodes']['participant.c']['max']['ncpu'] == 1
+    statistic, data = utils.get_resource_data(out)
+    assert statistic == 'p50'
+    assert data['participant.a']['mem'] == 6.0
+    statistic, data = utils.get_resource_data(out, 'max')
+    assert data['participant.a']['mem'] == 100.0
+    with pytest.raises(ValueError):
+        utils.get_resource_data(out, 'p95')
+
+
+def test_get_resource_data_old_format():
+    old = {'participant.a': {'ncpu': 2, 'cpumax': 150.0, 'mem': 1.0, 'time': 3.0}}
+    assert utils.get_resource_data(old) == ('max', old)
+    with pytest.raises(ValueError):
+        utils.get_resource_data(old, 'p95')
+
+
+def test_parse_statistic():
+    assert utils.parse_statistic('max') == 100.0
+    assert utils.parse_statistic('p95') == 95.0
+    for bad in ['p101', 'mean', 'p', '95']:
+        with pytest.raises(ValueError):
+            utils.parse_statistic(bad)
+
+
+def test_adjust_node_name():
+    assert utils.adjust_node_name('participant.T1_sub-1_ses-1.main.preproc.bet') == 'participant.main.preproc.bet'
+    assert utils.adjust_node_name('participant.maskmodel') == 'participant.maskmodel'
+    assert (utils.adjust_node_name('participant.longitudinal_sub-1.preproc_ses-2.preproc.bet') ==
+            utils.adjust_node_name('participant.longitudinal_sub-2.preproc_ses-1.preproc.bet') ==
+            'participant.longitudinal.preproc.preproc.bet')
+    assert (utils.adjust_node_name('participant.longitudinal_sub-1.template.nlreg') ==
+            'participant.longitudinal.template.nlreg')